@@ -24,6 +24,8 @@ urlpatterns = [
     url(r'createsession', views.create_session),
     # Download
     url(r'^download/(?P<query_type>.+)/(?P<object_id>[0-9a-fA-F]{24})/$', views.file_download),
+    # Plugin progress
+    url(r'^progress/(?P<plugin_id>[0-9a-fA-F]{24})/$', views.plugin_progress),
     # AjaxHandlers
     url(r'^ajaxhandler/(?P<command>.+)/$', views.ajax_handler),
     url(r'addfiles', views.addfiles),
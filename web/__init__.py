@@ -1 +1,3 @@
-from . import checks
\ No newline at end of file
+from . import checks
+
+default_app_config = 'web.apps.WebConfig'
@@ -1,7 +1,29 @@
 from __future__ import unicode_literals
 
+import os
+import sys
+
 from django.apps import AppConfig
 
 
+def serving():
+    """
+    check if this process serves requests, management commands and the runserver reloader parent do not
+    :return: bool
+    """
+    if not sys.argv or not sys.argv[0].endswith('manage.py'):
+        return True
+    if 'runserver' not in sys.argv:
+        return False
+    return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
+
+
 class WebConfig(AppConfig):
     name = 'web'
+
+    def ready(self):
+        if not serving():
+            return
+        # Jobs queued or requeued before a restart run without waiting for a request
+        from web.views import job_queue
+        job_queue.start()
@@ -0,0 +1,282 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Columns VolUtility adds to a plugin output, left out of row fingerprints
+volutility_columns = ['#', 'Diff', 'Extract Keys', 'Extract Injected Code']
+
+# Row fingerprints kept per baseline plugin, bigger outputs only get their diff columns indexed
+max_fingerprints = 250000
+
+# Keys stored in one baseline document, about 5 MB of hashes so a part stays under the 16 MB limit
+max_part_keys = 100000
+
+
+# (plugin, column) pairs diffed against the golden image, columns count from 1 in the plugin output
+PLUGINS_DIFF_PARAM_1 = [
+['mutantscan',7],
+['ssdt',7],
+['callbacks',3],
+['moddump',2],
+['driverirp',8],
+['atoms',8],
+['pslist',3],
+['cmdline',3],
+['dlllist',5],
+['mac_psaux',1],
+['linux_psaux',1],
+['mac_list_files', 2],
+['mac_pid_hash_table',3],
+['mac_pgrp_hash_table',3],
+['mac_pstree',3],
+['mac_psxview',3],
+['mac_mount',1],
+['linux_psxview',3],
+['mac_psenv',1],
+['mac_pslist',3],
+['linux_pslist',3],
+['mac_tasks',3],
+['mac_lsof',1],
+['linux_lsof',3],
+['linux_proc_maps',2],
+['linux_elfs',2],
+]
+
+
+def diff_columns(plugin_name):
+    """
+    The golden image diff columns for a plugin
+    :param plugin_name:
+    :return: list of column numbers
+    """
+    return [idx for plugin, idx in PLUGINS_DIFF_PARAM_1 if plugin == plugin_name]
+
+
+def value_key(value):
+    """
+    Hash a single cell so values that compare equal get the same key
+    :param value:
+    :return: str
+    """
+    return hashlib.sha1(json.dumps(value, default=unicode)).hexdigest()
+
+
+def row_fingerprint(values):
+    """
+    Hash the plugin values of a row
+    :param values: the row without any VolUtility columns
+    :return: str
+    """
+    return hashlib.sha1(json.dumps(values, default=unicode)).hexdigest()
+
+
+def fingerprint_columns(columns):
+    """
+    Positions of the plugin columns in a stored output
+    :param columns:
+    :return: list
+    """
+    return [position for position, column in enumerate(columns) if column not in volutility_columns]
+
+
+def build_key_sets(plugin_name, rows):
+    """
+    Hashed key set for every diff column of a plugin output
+    :param plugin_name:
+    :param rows:
+    :return: dict of column number to set of keys
+    """
+    key_sets = {}
+    for idx in diff_columns(plugin_name):
+        key_sets[idx] = set(value_key(row[idx - 1]) for row in rows if len(row) >= idx)
+    return key_sets
+
+
+def split_keys(key_lists, limit=max_part_keys):
+    """
+    Split named key lists into parts holding at most limit keys between them
+    :param key_lists: dict of name to list of keys
+    :param limit:
+    :return: list of dicts of name to list of keys, always at least one
+    """
+    parts = [{}]
+    room = limit
+    for name, keys in sorted(key_lists.items()):
+        offset = 0
+        while offset < len(keys):
+            if not room:
+                parts.append({})
+                room = limit
+            taken = keys[offset:offset + room]
+            parts[-1].setdefault(name, []).extend(taken)
+            offset += len(taken)
+            room -= len(taken)
+    return parts
+
+
+class BaselineIndex(object):
+    def __init__(self, db):
+        """
+        Golden image plugin outputs as hashed key sets, from output files or baseline sessions.
+        Each output is indexed once, the key sets are kept in the database and in memory.
+        :param db: Database instance
+        :return:
+        """
+        self.db = db
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def load(self, gi_path, plugin_name):
+        """
+        The key sets for a golden image plugin output, building them if the file changed
+        :param gi_path:
+        :param plugin_name:
+        :return: dict of column number to set of keys or None if there is no output file
+        """
+        source = gi_path + plugin_name
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+        version = (stat.st_size, stat.st_mtime)
+
+        with self.lock:
+            cached = self.indexes.get(source)
+            if cached and cached[0] == version:
+                return cached[1]
+
+            stored = self.db.get_baseline_index(source, stat.st_size, stat.st_mtime)
+            if stored:
+                key_sets = dict((int(idx), set(keys)) for idx, keys in stored['columns'].items())
+            else:
+                logger.debug('Indexing golden image output {0}'.format(source))
+                with open(source) as data_file:
+                    output = json.load(data_file)
+                key_sets = build_key_sets(plugin_name, output['rows'])
+                self.db.store_baseline_index(source, stat.st_size, stat.st_mtime,
+                                             {'plugin_name': plugin_name,
+                                              'columns': dict((str(idx), list(keys))
+                                                              for idx, keys in key_sets.items())})
+
+            self.indexes[source] = (version, key_sets)
+            return key_sets
+
+    def is_new(self, gi_path, plugin_name, idx, value):
+        """
+        check if a value is missing from a golden image column
+        :param gi_path:
+        :param plugin_name:
+        :param idx: column number from PLUGINS_DIFF_PARAM_1
+        :param value:
+        :return: bool
+        """
+        key_sets = self.load(gi_path, plugin_name)
+        if key_sets is None:
+            return False
+        return value_key(value) not in key_sets.get(idx, set())
+
+    def register(self, session_id):
+        """
+        Make a session a baseline, fingerprinting the stored output of every finished plugin
+        :param session_id:
+        :return: bool
+        """
+        self.db.update_session(session_id, {'baseline_status': 'Building'})
+        try:
+            self.db.drop_baseline(session_id)
+            for plugin in self.db.get_plugin_summaries(session_id):
+                if plugin.get('status') not in ['completed', 'complete']:
+                    continue
+                self.index_plugin(session_id, plugin)
+        except Exception as error:
+            logger.error('Unable to build baseline from {0}: {1}'.format(session_id, error))
+            self.db.update_session(session_id, {'baseline_status': 'Failed: {0}'.format(error)})
+            return False
+
+        with self.lock:
+            for source in [source for source in self.indexes if source.startswith('session/{0}/'.format(session_id))]:
+                del self.indexes[source]
+        self.db.update_session(session_id, {'baseline_status': 'Ready', 'baseline_created': datetime.now()})
+        return True
+
+    def index_plugin(self, session_id, plugin):
+        """
+        Fingerprint one stored plugin output of a baseline session
+        :param session_id:
+        :param plugin: plugin summary
+        :return:
+        """
+        plugin_name = plugin['plugin_name'].lower()
+        stored = self.db.get_pluginbyid(plugin['_id'], load_rows=False)
+        positions = fingerprint_columns(stored['plugin_output']['columns'])
+        idx_list = diff_columns(plugin_name)
+        key_sets = dict((idx, set()) for idx in idx_list)
+        # diff_row only uses row fingerprints for plugins without diff columns
+        fingerprints = None if idx_list else set()
+        row_count = 0
+        for row in self.db.iter_plugin_rows(plugin['_id']):
+            row_count += 1
+            for idx in idx_list:
+                if len(row) > idx:
+                    key_sets[idx].add(value_key(row[idx]))
+            if fingerprints is not None:
+                fingerprints.add(row_fingerprint([row[position] for position in positions if position < len(row)]))
+                if len(fingerprints) > max_fingerprints:
+                    logger.warning('{0} has too many rows to fingerprint, diffing columns only'.format(plugin_name))
+                    fingerprints = None
+
+        key_lists = dict((str(idx), list(keys)) for idx, keys in key_sets.items())
+        if fingerprints is not None:
+            key_lists['rows'] = list(fingerprints)
+        for part, keys in enumerate(split_keys(key_lists)):
+            rows = keys.pop('rows', []) if fingerprints is not None else None
+            self.db.store_baseline_plugin(session_id, plugin_name,
+                                          {'columns': keys, 'rows': rows, 'row_count': row_count}, part=part)
+
+    def load_baseline(self, baseline_id, plugin_name):
+        """
+        The fingerprints of a baseline plugin output
+        :param baseline_id:
+        :param plugin_name:
+        :return: dict with columns and rows or None if the baseline does not have the plugin
+        """
+        source = 'session/{0}/{1}'.format(baseline_id, plugin_name)
+        with self.lock:
+            if source not in self.indexes:
+                parts = self.db.get_baseline_plugin(baseline_id, plugin_name)
+                stored = None
+                if parts:
+                    stored = {'columns': {}, 'rows': set() if parts[0]['rows'] is not None else None}
+                    for part in parts:
+                        for idx, keys in part['columns'].items():
+                            stored['columns'].setdefault(int(idx), set()).update(keys)
+                        if stored['rows'] is not None:
+                            stored['rows'].update(part['rows'])
+                self.indexes[source] = stored
+            return self.indexes[source]
+
+    def diff_row(self, baseline_id, plugin_name, row, fingerprint):
+        """
+        Diff a numbered output row against a baseline session.
+        Plugins in PLUGINS_DIFF_PARAM_1 are compared on their diff column, everything else on the whole row.
+        :param baseline_id:
+        :param plugin_name:
+        :param row:
+        :param fingerprint: row_fingerprint of the plugin values
+        :return: str
+        """
+        baseline = self.load_baseline(baseline_id, plugin_name)
+        if not baseline:
+            return ''
+        idx_list = diff_columns(plugin_name)
+        for idx in idx_list:
+            if len(row) > idx and value_key(row[idx]) not in baseline['columns'].get(idx, set()):
+                return 'New Param %u' % (idx - 1)
+        if not idx_list and baseline['rows'] is not None and fingerprint not in baseline['rows']:
+            return 'New Row'
+        return ''
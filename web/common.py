@@ -6,6 +6,8 @@ import tempfile
 import shutil
 import ConfigParser
 import hashlib
+import threading
+import Queue
 
 try:
     from subprocess import getoutput
@@ -77,6 +79,53 @@ def checksum_md5(file_path):
             md5.update(chunk)
     return md5.hexdigest()
 
+
+def multi_hash(file_path, algorithms=('md5', 'sha1', 'sha256'), chunk_size=16 * 1024 * 1024, progress=None):
+    """
+    Hash a file once with several algorithms.
+    Each digest runs on its own thread, hashlib releases the GIL so they run alongside the reads.
+    :param file_path:
+    :param algorithms:
+    :param chunk_size: bytes per read
+    :param progress: called with (bytes_read, total_bytes) after each read
+    :return: dict of algorithm: hexdigest
+    """
+    total_size = os.path.getsize(file_path)
+    hashers = dict((name, hashlib.new(name)) for name in algorithms)
+    # Small queues keep at most a few chunks in memory
+    queues = dict((name, Queue.Queue(maxsize=4)) for name in algorithms)
+
+    def digest(name):
+        while True:
+            chunk = queues[name].get()
+            if chunk is None:
+                return
+            hashers[name].update(chunk)
+
+    threads = []
+    for name in algorithms:
+        thread = threading.Thread(target=digest, args=(name,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    bytes_read = 0
+    try:
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                for name in algorithms:
+                    queues[name].put(chunk)
+                bytes_read += len(chunk)
+                if progress:
+                    progress(bytes_read, total_size)
+    finally:
+        for name in algorithms:
+            queues[name].put(None)
+        for thread in threads:
+            thread.join()
+
+    return dict((name, hashers[name].hexdigest()) for name in algorithms)
+
 def parse_config():
     config_dict = {}
     config = ConfigParser.ConfigParser(allow_no_value=True)
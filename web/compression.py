@@ -0,0 +1,226 @@
+import zlib
+import shutil
+import logging
+import tempfile
+from collections import deque
+
+from web.common import parse_config
+
+logger = logging.getLogger(__name__)
+config = parse_config()
+
+try:
+    import zstandard
+    ZSTD = True
+except ImportError:
+    ZSTD = False
+
+if 'storage' in config:
+    storage_config = config['storage']
+else:
+    storage_config = {}
+
+# Uncompressed bytes handed to the compressor at a time
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def default_codec():
+    """
+    The codec new files are written with from the storage config
+    :return: 'zstd', 'zlib' or None
+    """
+    codec = storage_config.get('compression', 'auto').lower()
+    if codec == 'auto':
+        return 'zstd' if ZSTD else 'zlib'
+    if codec == 'zstd' and not ZSTD:
+        logger.warning('zstandard is not installed, compressing with zlib')
+        return 'zlib'
+    if codec in ['zstd', 'zlib']:
+        return codec
+    return None
+
+
+class Compressor(object):
+    def __init__(self, codec):
+        if codec == 'zstd':
+            self.stream = zstandard.ZstdCompressor(level=3).compressobj()
+        else:
+            self.stream = zlib.compressobj(6)
+
+    def compress(self, data):
+        return self.stream.compress(data)
+
+    def flush(self):
+        return self.stream.flush()
+
+
+class Decompressor(object):
+    def __init__(self, codec, source, read_size=CHUNK_SIZE):
+        """
+        File like reader that decompresses source with bounded output, a small input can not expand
+        into more than the size asked for in one call
+        :param codec:
+        :param source: file like object with the compressed data
+        :param read_size: compressed bytes read from source at a time
+        :return:
+        """
+        self.source = source
+        self.read_size = read_size
+        self.finished = False
+        if codec == 'zstd':
+            self.stream = None
+            self.reader = zstandard.ZstdDecompressor().stream_reader(source, read_size=read_size)
+        elif codec == 'zlib':
+            self.stream = zlib.decompressobj()
+        else:
+            raise IOError('Unknown compression {0}'.format(codec))
+
+    def read(self, size):
+        """
+        Decompress up to size bytes
+        :param size: positive number of bytes
+        :return: str, empty once the stream is done
+        """
+        if self.stream is None:
+            return self.reader.read(size)
+        while not self.finished:
+            # Input left over from the last call goes first, it stopped because the output hit the bound
+            data = self.stream.unconsumed_tail or self.source.read(self.read_size)
+            if not data:
+                # Out of input, drain anything zlib still holds
+                data = self.stream.decompress('', size)
+                if not data:
+                    self.finished = True
+                    data = self.stream.flush()
+                return data
+            data = self.stream.decompress(data, size)
+            if data:
+                return data
+        return ''
+
+
+def read_chunks(file_data, chunk_size=CHUNK_SIZE):
+    """
+    Split a string or file like object into chunks
+    :param file_data:
+    :param chunk_size:
+    :return: generator
+    """
+    if hasattr(file_data, 'read'):
+        while True:
+            chunk = file_data.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for offset in range(0, len(file_data), chunk_size):
+            yield file_data[offset:offset + chunk_size]
+
+
+class DecompressedFile(object):
+    """
+    Read only view of a compressed GridOut that decompresses as it is read.
+    Anything else is passed through to the GridOut, length and md5 are those of the original data.
+    Seeking backwards spools the file to a temporary file once.
+    """
+    def __init__(self, grid_out):
+        self.grid_out = grid_out
+        self.decompressor = Decompressor(grid_out.compression, grid_out, grid_out.chunk_size)
+        self.buffer = deque()
+        self.offset = 0
+        self.buffered = 0
+        self.position = 0
+        self.finished = False
+        self.spool = None
+
+    def __getattr__(self, name):
+        return getattr(self.grid_out, name)
+
+    @property
+    def length(self):
+        return self.grid_out.original_length
+
+    @property
+    def md5(self):
+        return getattr(self.grid_out, 'original_md5', None)
+
+    def fill(self, size):
+        while not self.finished and (size < 0 or self.buffered < size):
+            data = self.decompressor.read(CHUNK_SIZE)
+            if data:
+                self.buffer.append(data)
+                self.buffered += len(data)
+            else:
+                self.finished = True
+
+    def read(self, size=-1):
+        if self.spool:
+            return self.spool.read(size)
+        if size is None:
+            size = -1
+        self.fill(size)
+        wanted = self.buffered if size < 0 else min(size, self.buffered)
+        # Take from the front of the buffered chunks, only the part handed back is copied
+        parts = []
+        remaining = wanted
+        while remaining:
+            chunk = self.buffer[0]
+            part = chunk[self.offset:self.offset + remaining]
+            parts.append(part)
+            remaining -= len(part)
+            self.offset += len(part)
+            if self.offset == len(chunk):
+                self.buffer.popleft()
+                self.offset = 0
+        self.buffered -= wanted
+        self.position += wanted
+        return ''.join(parts)
+
+    def make_spool(self):
+        """
+        Decompress everything to a temporary file for random access
+        :return:
+        """
+        position = self.position
+        self.grid_out.seek(0)
+        self.decompressor = Decompressor(self.grid_out.compression, self.grid_out, self.grid_out.chunk_size)
+        self.buffer = deque()
+        self.offset = 0
+        self.buffered = 0
+        self.finished = False
+        self.position = 0
+        spool = tempfile.TemporaryFile()
+        shutil.copyfileobj(self, spool, CHUNK_SIZE)
+        spool.seek(position)
+        self.spool = spool
+
+    def seek(self, offset, whence=0):
+        if not self.spool:
+            if whence == 0 and offset >= self.position:
+                # Forward seeks just decompress and discard
+                while self.position < offset:
+                    if not self.read(min(CHUNK_SIZE, offset - self.position)):
+                        break
+                return
+            self.make_spool()
+        self.spool.seek(offset, whence)
+
+    def tell(self):
+        if self.spool:
+            return self.spool.tell()
+        return self.position
+
+    def get_size(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        if self.spool:
+            self.spool.close()
+        self.grid_out.close()
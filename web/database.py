@@ -1,13 +1,262 @@
+import re
 import json
+import logging
+import hashlib
+import threading
+from datetime import datetime
 import pymongo
+from pymongo.errors import OperationFailure
 from bson.objectid import ObjectId
+from bson.son import SON
 from gridfs import GridFS
 from common import parse_config
+from compression import default_codec, read_chunks, Compressor, DecompressedFile, CHUNK_SIZE
 
+logger = logging.getLogger(__name__)
 config = parse_config()
 
+# Session fields shown on the session list
+session_summary_fields = {'session_name': 1, 'status': 1, 'hash_status': 1, 'session_profile': 1, 'created': 1,
+                          'modified': 1}
+
+# Plugin fields needed to list plugins, everything but the output
+plugin_summary_fields = {'plugin_name': 1, 'type': 1, 'status': 1, 'row_count': 1, 'created': 1, 'help_string': 1,
+                         'session_id': 1}
+
+# Rows counted when searching a stored output
+max_search_count = 10000
+
+
+# (collection attribute, keys, create_index options) built by Database.migrate_indexes
+managed_indexes = [
+    ('vol_sessions', [('created', pymongo.ASCENDING)], {}),
+
+    ('vol_comments', [('freetext', 'text')], {}),
+    ('vol_comments', [('session_id', pymongo.ASCENDING), ('created', pymongo.DESCENDING)], {}),
+
+    ('vol_plugins', [('$**', 'text')], {}),
+    ('vol_plugins', [('session_id', pymongo.ASCENDING), ('plugin_name', pymongo.ASCENDING)], {}),
+    ('vol_plugins', [('session_id', pymongo.ASCENDING), ('created', pymongo.DESCENDING)], {}),
+    ('vol_plugins', [('plugin_name', pymongo.ASCENDING)], {}),
+
+    ('vol_rows', [('plugin_id', pymongo.ASCENDING), ('index', pymongo.ASCENDING)], {}),
+    ('vol_rows', [('session_id', pymongo.ASCENDING)], {}),
+    ('vol_rows', [('search', 'text')], {}),
+
+    ('vol_datastore', [('session_id', pymongo.ASCENDING)], {}),
+    ('vol_datastore', [('file_id', pymongo.ASCENDING)], {}),
+
+    ('vol_files_meta', [('sess_id', pymongo.ASCENDING), ('file_meta', pymongo.ASCENDING)], {}),
+    ('vol_files_meta', [('filename', pymongo.ASCENDING)], {}),
+    ('vol_files_meta', [('sha256', pymongo.ASCENDING)], {}),
+
+    ('vol_file_refs', [('sess_id', pymongo.ASCENDING), ('file_meta', pymongo.ASCENDING)], {}),
+    ('vol_file_refs', [('blob_id', pymongo.ASCENDING)], {}),
+    ('vol_file_refs', [('filename', pymongo.ASCENDING)], {}),
+
+    ('vol_cache', [('cache_key', pymongo.ASCENDING)], {'unique': True}),
+    ('vol_cache', [('last_used', pymongo.ASCENDING)], {}),
+
+    ('vol_hashes', [('path', pymongo.ASCENDING), ('size', pymongo.ASCENDING), ('mtime', pymongo.ASCENDING)],
+     {'unique': True}),
+
+    ('vol_capabilities', [('plugin_name', pymongo.ASCENDING)], {'unique': True}),
+
+    ('vol_baselines', [('source', pymongo.ASCENDING)], {'unique': True}),
+    ('vol_baselines', [('baseline_id', pymongo.ASCENDING)], {}),
+
+    ('vol_diffs', [('diff_key', pymongo.ASCENDING)], {'unique': True}),
+    ('vol_diffs', [('session_ids', pymongo.ASCENDING)], {}),
+    ('vol_diff_sessions', [('diff_id', pymongo.ASCENDING)], {}),
+    ('vol_sessions', [('baseline_status', pymongo.ASCENDING)], {}),
+
+    ('vol_progress', [('plugin_id', pymongo.ASCENDING)], {'unique': True}),
+    ('vol_progress', [('session_id', pymongo.ASCENDING)], {}),
+
+    ('vol_jobs', [('status', pymongo.ASCENDING), ('priority', pymongo.ASCENDING), ('created', pymongo.ASCENDING)], {}),
+    ('vol_jobs', [('plugin_id', pymongo.ASCENDING), ('status', pymongo.ASCENDING)], {}),
+    ('vol_jobs', [('session_id', pymongo.ASCENDING), ('status', pymongo.ASCENDING)], {}),
+    ('vol_jobs', [('status', pymongo.ASCENDING), ('host', pymongo.ASCENDING)], {}),
+]
+
+
+# Indexes earlier versions built that no query uses, dropped by Database.migrate_indexes
+retired_indexes = [
+    ('vol_files_meta', [('session_id', pymongo.ASCENDING)]),
+]
+
+
+def index_name(keys):
+    """
+    The name MongoDB gives an index created without one
+    :param keys:
+    :return: str
+    """
+    return '_'.join('{0}_{1}'.format(field, direction) for field, direction in keys)
+
+
+def sort_value(value):
+    """
+    Value used to order a cell, numbers sort as numbers the rest as lower case text
+    :param value:
+    :return:
+    """
+    try:
+        number = int(value)
+        if -2 ** 63 <= number < 2 ** 63:
+            return number
+        return float(number)
+    except (TypeError, ValueError):
+        return str(value).lower()
+
+
+def cell_text(value):
+    """
+    The text of a cell as it is shown, for the search field
+    :param value:
+    :return: unicode
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
+def row_document(plugin_id, session_id, index, row):
+    """
+    A single stored output row
+    :param plugin_id:
+    :param session_id:
+    :param index: 0 based position in the output
+    :param row:
+    :return: dict
+    """
+    return {'plugin_id': plugin_id,
+            'session_id': session_id,
+            'index': index,
+            'row': row,
+            'sort': dict(('c{0}'.format(column), sort_value(value)) for column, value in enumerate(row)),
+            'search': u' '.join(cell_text(value) for value in row).lower()}
+
+
+class SessionPages(object):
+    """
+    Session list that only queries the slice it is asked for, so the Django Paginator pages in the database
+    """
+    def __init__(self, database, sort_key='created', direction=pymongo.ASCENDING):
+        self.database = database
+        self.sort_key = sort_key
+        self.direction = direction
+        self.total = None
+
+    def count(self):
+        if self.total is None:
+            self.total = self.database.count_sessions()
+        return self.total
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self.database.get_sessions(skip=index, limit=1,
+                                              sort_key=self.sort_key, direction=self.direction)[0]
+        start = index.start or 0
+        stop = self.count() if index.stop is None else index.stop
+        return self.database.get_sessions(skip=start, limit=max(stop - start, 0),
+                                          sort_key=self.sort_key, direction=self.direction)
+
+
+class FileReference(object):
+    """
+    A stored file as seen through one reference to its deduplicated blob.
+    The reference supplies the id, session, pid and filename, reads go to the blob.
+    """
+    def __init__(self, database, reference):
+        self.database = database
+        self.reference = reference
+        self.blob = None
+
+    def open_blob(self):
+        if self.blob is None:
+            self.blob = self.database.get_blob(self.reference['blob_id'])
+        return self.blob
+
+    def __getattr__(self, name):
+        if name in self.reference:
+            return self.reference[name]
+        return getattr(self.open_blob(), name)
+
+    def __iter__(self):
+        return iter(self.open_blob())
+
+
+class PluginOutputWriter(object):
+    def __init__(self, database, session_id, plugin_id, inline_rows=5000):
+        """
+        Collects plugin rows as they are produced.
+        Small outputs stay inline, once inline_rows is passed the rows go to the rows collection as they arrive.
+        :param database: Database instance
+        :param session_id:
+        :param plugin_id:
+        :param inline_rows:
+        :return:
+        """
+        self.database = database
+        self.session_id = ObjectId(session_id)
+        self.plugin_id = ObjectId(plugin_id)
+        self.inline_rows = inline_rows
+        self.columns = []
+        self.rows = []
+        self.row_count = 0
+        self.rowstore = False
+
+    def set_columns(self, columns):
+        self.columns = columns
+
+    def add_rows(self, rows):
+        if not self.rowstore:
+            self.rows.extend(rows)
+            if len(self.rows) <= self.inline_rows:
+                self.row_count = len(self.rows)
+                return
+            # Too big to keep, switch to the rows collection
+            self.rowstore = True
+            self.database.drop_rows(self.plugin_id)
+            rows = self.rows
+            self.rows = []
+
+        self.database.create_rows(self.plugin_id, self.session_id, rows, self.row_count)
+        self.row_count += len(rows)
+
+    def close(self):
+        """
+        finish the output
+        :return: dict of values for update_plugin
+        """
+        if not self.rowstore:
+            return {'plugin_output': {'columns': self.columns, 'rows': self.rows}}
+        return {'plugin_output': {'columns': self.columns, 'rows': []},
+                'rowstore': 'True',
+                'row_count': self.row_count}
+
+    def abort(self):
+        """
+        drop anything written so far
+        :return:
+        """
+        if self.rowstore:
+            self.database.drop_rows(self.plugin_id)
+        self.rows = []
+        self.row_count = 0
+
+
 class Database():
-    def __init__(self):
+    def __init__(self, migrate=True):
+        """
+        Connect to mongo, forked processes need a Database of their own as a MongoClient is not fork safe
+        :param migrate: build missing indexes in the background, only the web process needs to
+        :return:
+        """
         # Create the connection
         if config['valid']:
             mongo_uri = config['database']['mongo_uri']
@@ -29,13 +278,74 @@ class Database():
         self.vol_sessions = voldb.sessions
         self.vol_comments = voldb.comments
         self.vol_plugins = voldb.plugins
+        self.vol_rows = voldb.plugin_rows
         self.vol_datastore = voldb.datastore
+        self.vol_jobs = voldb.jobs
+        self.vol_cache = voldb.result_cache
+        self.vol_hashes = voldb.image_hashes
+        self.vol_capabilities = voldb.plugin_capabilities
+        self.vol_progress = voldb.plugin_progress
+        self.vol_baselines = voldb.baseline_index
+        self.vol_diffs = voldb.session_diffs
+        self.vol_diff_sessions = voldb.session_diff_results
         self.vol_files = GridFS(voldbfs)
+        self.vol_files_meta = voldbfs.fs.files
+        self.vol_file_refs = voldb.file_refs
+
+        # Build anything missing from the managed index set without holding up startup
+        self.index_report = None
+        if migrate:
+            migration = threading.Thread(target=self.migrate_indexes, name='volutility-indexes')
+            migration.daemon = True
+            migration.start()
+
+    ##
+    # Indexes
+    ##
+
+    def migrate_indexes(self):
+        """
+        Create any index in managed_indexes the database does not have yet
+        :return: list of (collection, index name, error or None)
+        """
+        report = []
+        for collection_name, keys, options in managed_indexes:
+            collection = getattr(self, collection_name)
+            name = index_name(keys)
+            try:
+                if name in collection.index_information():
+                    continue
+                logger.info('Building index {0} on {1}'.format(name, collection.full_name))
+                collection.create_index(keys, background=True, **options)
+                report.append((collection.full_name, name, None))
+            except Exception as error:
+                logger.error('Unable to build index {0} on {1}: {2}'.format(name, collection.full_name, error))
+                report.append((collection.full_name, name, str(error)))
 
-        # Indexes
-        self.vol_comments.create_index([('freetext', 'text')])
+        for collection_name, keys in retired_indexes:
+            collection = getattr(self, collection_name)
+            name = index_name(keys)
+            try:
+                if name in collection.index_information():
+                    logger.info('Dropping index {0} on {1}'.format(name, collection.full_name))
+                    collection.drop_index(name)
+            except Exception as error:
+                logger.error('Unable to drop index {0} on {1}: {2}'.format(name, collection.full_name, error))
 
-        self.vol_plugins.create_index([('$**', 'text')])
+        # Per column sort indexes from earlier versions cost every row insert, sorts no longer use them
+        try:
+            for name in self.vol_rows.index_information():
+                if '_sort.c' in name:
+                    logger.info('Dropping index {0} on {1}'.format(name, self.vol_rows.full_name))
+                    self.vol_rows.drop_index(name)
+        except Exception as error:
+            logger.error('Unable to drop sort indexes on {0}: {1}'.format(self.vol_rows.full_name, error))
+
+        if report:
+            logger.info('Index migration built {0} of {1} missing indexes'.format(
+                len([row for row in report if not row[2]]), len(report)))
+        self.index_report = report
+        return report
 
     ##
     # Sessions
@@ -44,6 +354,23 @@ class Database():
         sessions = self.vol_sessions.find()
         return [x for x in sessions]
 
+    def get_sessions(self, skip=0, limit=30, sort_key='created', direction=pymongo.ASCENDING):
+        """
+        A page of the session list with only the listed fields
+        :param skip:
+        :param limit:
+        :param sort_key:
+        :param direction:
+        :return: list
+        """
+        if limit <= 0:
+            return []
+        sessions = self.vol_sessions.find({}, session_summary_fields).sort(sort_key, direction).skip(skip).limit(limit)
+        return [x for x in sessions]
+
+    def count_sessions(self):
+        return self.vol_sessions.estimated_document_count()
+
     def get_session(self, session_id):
         session_id = ObjectId(session_id)
         session = self.vol_sessions.find_one({'_id': session_id})
@@ -58,6 +385,17 @@ class Database():
         self.vol_sessions.update_one({'_id': session_id}, {"$set": new_values })
         return True
 
+    ##
+    # Image Hashes
+    ##
+
+    def get_image_hashes(self, path, size, mtime):
+        return self.vol_hashes.find_one({'path': path, 'size': size, 'mtime': mtime})
+
+    def store_image_hashes(self, path, size, mtime, hashes):
+        self.vol_hashes.update_one({'path': path, 'size': size, 'mtime': mtime}, {"$set": hashes}, upsert=True)
+        return True
+
     ##
     # Comments
     ##
@@ -75,17 +413,20 @@ class Database():
         comment_id = self.vol_comments.insert_one(comment_data).inserted_id
         return comment_id
 
-    def search_comments(self, search_text, session_id=None):
-        results = []
-        rows = self.vol_comments.find({"$text": {"$search": search_text}})
-        for row in rows:
-            if session_id:
-                session_id = ObjectId(session_id)
-                if row['session_id'] == session_id:
-                    results.append(row)
-            else:
-                results.append(row)
-        return results
+    def search_comments(self, search_text, session_id=None, skip=0, limit=100):
+        """
+        Comments matching a text search, newest first
+        :param search_text:
+        :param session_id: only search this session
+        :param skip:
+        :param limit:
+        :return: list
+        """
+        query = {"$text": {"$search": search_text}}
+        if session_id:
+            query['session_id'] = ObjectId(session_id)
+        rows = self.vol_comments.find(query).sort("created", -1).skip(skip).limit(limit)
+        return [row for row in rows]
 
     ##
     # Plugins
@@ -102,22 +443,59 @@ class Database():
 
         return result_rows
 
-    def get_pluginbyid(self, plugin_id):
+    def get_plugin_summaries(self, session_id):
+        """
+        Plugin list for a session without any plugin output
+        :param session_id:
+        :return: list
+        """
+        session_id = ObjectId(session_id)
+        plugin_output = self.vol_plugins.find({'session_id': session_id}, plugin_summary_fields).sort("created", -1)
+        return [row for row in plugin_output]
+
+    def watch_plugins(self, session_id):
+        """
+        Change stream of plugin updates for a session
+        :param session_id:
+        :return: ChangeStream or None when the server is not a replica set
+        """
+        session_id = ObjectId(session_id)
+        pipeline = [{'$match': {'fullDocument.session_id': session_id}},
+                    {'$project': dict(('fullDocument.{0}'.format(field), 1) for field in ['_id'] + plugin_summary_fields.keys())}]
+        try:
+            stream = self.vol_plugins.watch(pipeline, full_document='updateLookup', max_await_time_ms=1000)
+        except (AttributeError, OperationFailure):
+            return None
+        # Older drivers can only block on the next change
+        if not hasattr(stream, 'try_next'):
+            stream.close()
+            return None
+        return stream
+
+    def get_pluginbyid(self, plugin_id, load_rows=True):
         plugin_id = ObjectId(plugin_id)
         plugin_output = self.vol_plugins.find_one({'_id': plugin_id})
-        if 'largedoc' in plugin_output:
-            large_document_id = plugin_output['plugin_output']
-            large_document = self.get_filebyid(large_document_id)
-            plugin_output['plugin_output'] = json.loads(large_document.read())
-        return plugin_output
+        return self.load_output(plugin_output, load_rows=load_rows)
 
-    def get_plugin_byname(self, plugin_name, session_id):
+    def get_plugin_byname(self, plugin_name, session_id, load_rows=True):
         session_id = ObjectId(session_id)
         plugin_output = self.vol_plugins.find_one({'session_id': session_id, 'plugin_name': plugin_name})
+        return self.load_output(plugin_output, load_rows=load_rows)
+
+    def load_output(self, plugin_output, load_rows=True):
+        """
+        Fill in plugin_output rows held outside the plugin document
+        :param plugin_output:
+        :param load_rows: False leaves rowstore rows to be paged with get_plugin_rows
+        :return:
+        """
         if plugin_output and 'largedoc' in plugin_output:
             large_document_id = plugin_output['plugin_output']
             large_document = self.get_filebyid(large_document_id)
             plugin_output['plugin_output'] = json.loads(large_document.read())
+        if plugin_output and 'rowstore' in plugin_output and load_rows:
+            rows = self.vol_rows.find({'plugin_id': plugin_output['_id']}, {'row': 1}).sort('index', pymongo.ASCENDING)
+            plugin_output['plugin_output']['rows'] = [row['row'] for row in rows]
         return plugin_output
 
     def create_plugin(self, plugin_data):
@@ -126,68 +504,564 @@ class Database():
         plugin_id = self.vol_plugins.insert_one(plugin_data).inserted_id
         return plugin_id
 
-    def search_plugins(self, search_text, session_id=None, plugin_name=None):
-        results = []
-        rows = self.vol_plugins.find({"$text": {"$search": search_text}})
-        for row in rows:
-            if session_id:
-                session_id = ObjectId(session_id)
-                if row['session_id'] == session_id:
-                    results.append(row)
-            # This is the session filter from the main page.
-            elif plugin_name:
-                if row['plugin_name'] == plugin_name:
-                    if search_text in str(row['plugin_output']):
-                        results.append(row['session_id'])
+    def plugin_search(self, search_text, session_id=None, plugin_name=None):
+        """
+        Text search split so no plugin is matched twice, plugin documents for inline outputs
+        and the rows collection for large outputs
+        :param search_text:
+        :param session_id: only search this session
+        :param plugin_name: only search this plugin, matches the text as a phrase
+        :return: (query on vol_plugins, sorted list of matching rowstore plugin ids)
+        """
+        if plugin_name:
+            search_text = '"{0}"'.format(search_text.replace('"', ''))
+        query = {"$text": {"$search": search_text}}
+        if session_id:
+            query['session_id'] = ObjectId(session_id)
+        if plugin_name:
+            query['plugin_name'] = plugin_name
 
-            else:
-                results.append(row)
-        return results
+        rowstore_query = dict(query, rowstore='True')
+        query['rowstore'] = {'$exists': False}
+        found = set(row['_id'] for row in self.vol_plugins.find(rowstore_query, {'_id': 1}))
+
+        # Rows copied into the result cache have no session
+        row_query = {"$text": {"$search": search_text},
+                     'session_id': ObjectId(session_id) if session_id else {'$ne': None}}
+        if plugin_name:
+            row_query['plugin_id'] = {'$in': [row['_id'] for row in self.vol_plugins.find(
+                {'plugin_name': plugin_name, 'rowstore': 'True'}, {'_id': 1})]}
+        pipeline = [{'$match': row_query}, {'$group': {'_id': '$plugin_id'}}]
+        found.update(row['_id'] for row in self.vol_rows.aggregate(pipeline))
+        return query, sorted(found)
+
+    def search_plugin_ids(self, search_text, session_id=None, plugin_name=None, skip=0, limit=0):
+        """
+        Ids of plugins whose output matches a text search, filtered and paged in the query
+        :param search_text:
+        :param session_id: only search this session
+        :param plugin_name: only search this plugin, matches the text as a phrase
+        :param skip:
+        :param limit: 0 for every match
+        :return: (sorted list of plugin ids, total matches)
+        """
+        query, rowstore_ids = self.plugin_search(search_text, session_id=session_id, plugin_name=plugin_name)
+        total = self.vol_plugins.count_documents(query) + len(rowstore_ids)
+        # Both sides are in id order, only the ids up to the end of the page are needed from each
+        cursor = self.vol_plugins.find(query, {'_id': 1}).sort('_id', pymongo.ASCENDING)
+        if limit:
+            cursor = cursor.limit(skip + limit)
+            rowstore_ids = rowstore_ids[:skip + limit]
+        plugin_ids = sorted([row['_id'] for row in cursor] + rowstore_ids)
+        if limit:
+            return plugin_ids[skip:skip + limit], total
+        return plugin_ids[skip:], total
+
+    def search_plugins(self, search_text, session_id=None, plugin_name=None, skip=0, limit=100):
+        """
+        Plugins whose output matches a text search
+        :param search_text:
+        :param session_id: only search this session
+        :param plugin_name: only search this plugin, returns the matching session ids. This is the session filter
+                            from the main page.
+        :param skip:
+        :param limit:
+        :return: list of plugin summaries or session ids
+        """
+        if plugin_name:
+            plugin_ids, total = self.search_plugin_ids(search_text, session_id=session_id, plugin_name=plugin_name)
+            return self.vol_plugins.distinct('session_id', {'_id': {'$in': plugin_ids}})
+        plugin_ids, total = self.search_plugin_ids(search_text, session_id=session_id, skip=skip, limit=limit)
+        return self.get_plugin_summaries_byid(plugin_ids)
+
+    def get_plugin_summaries_byid(self, plugin_ids):
+        rows = self.vol_plugins.find({'_id': {'$in': plugin_ids}}, plugin_summary_fields).sort('_id', pymongo.ASCENDING)
+        return [row for row in rows]
 
     def update_plugin(self, plugin_id, new_values):
         plugin_id = ObjectId(plugin_id)
-        if len(str(new_values)) > 12000000:
-            print "Storing Large Document in GridFS"
-            large_document = json.dumps(new_values['plugin_output'])
-            large_document_id = self.create_file(large_document, 'sess_id', 'sha256', 'filename', pid=None, file_meta=None)
-            new_values['plugin_output'] = large_document_id
-            new_values['largedoc'] = 'True'
+        update = {"$set": new_values}
+
+        if 'plugin_output' in new_values and 'rowstore' not in new_values:
+            # Output replaced, drop rows from an earlier run
+            self.drop_rows(plugin_id)
+            update["$unset"] = {'largedoc': '', 'rowstore': ''}
+            if new_values['plugin_output'] and len(str(new_values)) > 12000000:
+                logger.info('Storing large output for {0} in the rows collection'.format(plugin_id))
+                plugin = self.vol_plugins.find_one({'_id': plugin_id}, {'session_id': 1})
+                rows = new_values['plugin_output']['rows']
+                self.create_rows(plugin_id, plugin['session_id'], rows, 0)
+                new_values['plugin_output'] = {'columns': new_values['plugin_output']['columns'], 'rows': []}
+                new_values['rowstore'] = 'True'
+                new_values['row_count'] = len(rows)
+                del update["$unset"]['rowstore']
+            elif new_values['plugin_output']:
+                new_values['row_count'] = len(new_values['plugin_output']['rows'])
+            else:
+                new_values['row_count'] = None
+
+        self.vol_plugins.update_one({'_id': plugin_id}, update)
+        return True
+
+    ##
+    # Plugin Rows
+    ##
+
+    def create_rows(self, plugin_id, session_id, rows, start_index):
+        if not rows:
+            return True
+        self.vol_rows.insert_many([row_document(plugin_id, session_id, start_index + offset, row)
+                                   for offset, row in enumerate(rows)], ordered=False)
+        return True
 
-        self.vol_plugins.update_one({'_id': plugin_id}, {"$set": new_values})
+    def drop_rows(self, plugin_id):
+        plugin_id = ObjectId(plugin_id)
+        self.vol_rows.delete_many({'plugin_id': plugin_id})
         return True
 
+    def get_plugin_row(self, plugin_id, index):
+        """
+        return a single output row by its 0 based position
+        :param plugin_id:
+        :param index:
+        :return: list or None
+        """
+        plugin_id = ObjectId(plugin_id)
+        plugin = self.vol_plugins.find_one({'_id': plugin_id}, {'rowstore': 1, 'plugin_output': 1, 'largedoc': 1})
+        if plugin and 'rowstore' not in plugin:
+            rows = self.load_output(plugin)['plugin_output']['rows']
+            return rows[index] if 0 <= index < len(rows) else None
+        row = self.vol_rows.find_one({'plugin_id': plugin_id, 'index': index})
+        return row['row'] if row else None
+
+    def get_plugin_rows(self, plugin_id, start=0, length=25, sort_column=None, reverse=False, search_text=None):
+        """
+        Page through stored rows, filtering and sorting in the database
+        :param plugin_id:
+        :param start:
+        :param length: -1 for every row
+        :param sort_column: column index, None keeps output order
+        :param reverse:
+        :param search_text: case insensitive substring match
+        :return: (rows, number of rows matching the search, at most max_search_count when searching)
+        """
+        plugin_id = ObjectId(plugin_id)
+        query = {'plugin_id': plugin_id}
+        if search_text:
+            query['search'] = {'$regex': re.escape(search_text.lower())}
+
+        direction = pymongo.DESCENDING if reverse else pymongo.ASCENDING
+        # Column 0 is the row number. Other columns are sorted from the plugin_id index, spilling to disk if needed
+        if sort_column in [None, 0]:
+            sort = SON([('index', direction)])
+        else:
+            sort = SON([('sort.c{0}'.format(sort_column), direction), ('index', direction)])
+
+        pipeline = [{'$match': query},
+                    {'$sort': sort},
+                    {'$skip': start}]
+        if length >= 0:
+            pipeline.append({'$limit': length})
+        pipeline.append({'$project': {'row': 1}})
+        rows = [row['row'] for row in self.vol_rows.aggregate(pipeline, allowDiskUse=True)]
+
+        if search_text:
+            # An unanchored match has to scan the rows, stop counting once the page count is meaningless
+            filtered_count = self.vol_rows.count_documents(query, limit=max_search_count)
+        else:
+            filtered_count = self.vol_rows.count_documents(query)
+        return rows, filtered_count
+
+    def copy_rows(self, from_id, to_id, session_id, batch_size=5000):
+        """
+        Copy stored rows to another owner in batches
+        :param from_id: plugin or cache entry id
+        :param to_id:
+        :param session_id: session of the new owner, None for cache entries
+        :param batch_size:
+        :return: (row count, approximate size in bytes)
+        """
+        from_id = ObjectId(from_id)
+        to_id = ObjectId(to_id)
+        if session_id:
+            session_id = ObjectId(session_id)
+        row_count = 0
+        size = 0
+        batch = []
+        for row in self.vol_rows.find({'plugin_id': from_id}).sort('index', pymongo.ASCENDING):
+            del row['_id']
+            row['plugin_id'] = to_id
+            row['session_id'] = session_id
+            size += len(row['search'])
+            batch.append(row)
+            if len(batch) >= batch_size:
+                self.vol_rows.insert_many(batch, ordered=False)
+                row_count += len(batch)
+                batch = []
+        if batch:
+            self.vol_rows.insert_many(batch, ordered=False)
+            row_count += len(batch)
+        return row_count, size
+
+    def iter_plugin_rows(self, plugin_id, batch_size=5000):
+        """
+        Every output row of a plugin in order without holding rowstore rows in memory
+        :param plugin_id:
+        :param batch_size:
+        :return: generator
+        """
+        plugin_id = ObjectId(plugin_id)
+        plugin = self.vol_plugins.find_one({'_id': plugin_id}, {'rowstore': 1, 'plugin_output': 1, 'largedoc': 1})
+        if not plugin or not plugin.get('plugin_output'):
+            return
+        if 'rowstore' not in plugin:
+            for row in self.load_output(plugin)['plugin_output']['rows']:
+                yield row
+            return
+        rows = self.vol_rows.find({'plugin_id': plugin_id}, {'row': 1}).sort('index', pymongo.ASCENDING)
+        for row in rows.batch_size(batch_size):
+            yield row['row']
+
+    ##
+    # Plugin Progress
+    ##
+
+    def get_progress(self, plugin_id):
+        plugin_id = ObjectId(plugin_id)
+        return self.vol_progress.find_one({'plugin_id': plugin_id}, {'_id': 0})
+
+    def update_progress(self, plugin_id, session_id, new_values):
+        plugin_id = ObjectId(plugin_id)
+        new_values['session_id'] = ObjectId(session_id)
+        self.vol_progress.update_one({'plugin_id': plugin_id}, {'$set': new_values}, upsert=True)
+        return True
+
+    ##
+    # Plugin Capabilities
+    ##
+
+    def get_plugin_capability(self, plugin_name):
+        return self.vol_capabilities.find_one({'plugin_name': plugin_name})
+
+    def set_plugin_capability(self, plugin_name, new_values):
+        new_values['updated'] = datetime.now()
+        self.vol_capabilities.update_one({'plugin_name': plugin_name}, {'$set': new_values}, upsert=True)
+        return True
+
+    ##
+    # Baseline Index
+    ##
+
+    def get_baseline_index(self, source, size, mtime):
+        return self.vol_baselines.find_one({'source': source, 'size': size, 'mtime': mtime})
+
+    def store_baseline_index(self, source, size, mtime, new_values):
+        new_values.update({'size': size, 'mtime': mtime, 'updated': datetime.now()})
+        self.vol_baselines.update_one({'source': source}, {'$set': new_values}, upsert=True)
+        return True
+
+    def get_baselines(self):
+        """
+        Sessions registered as golden image baselines
+        :return: list
+        """
+        sessions = self.vol_sessions.find({'baseline_status': 'Ready'}, session_summary_fields).sort('created', 1)
+        return [x for x in sessions]
+
+    def get_baseline_plugin(self, baseline_id, plugin_name):
+        """
+        Every stored part of a baseline plugin output
+        :param baseline_id:
+        :param plugin_name:
+        :return: list of documents in part order
+        """
+        baseline_id = ObjectId(baseline_id)
+        parts = self.vol_baselines.find({'baseline_id': baseline_id, 'plugin_name': plugin_name}).sort('part', 1)
+        return [x for x in parts]
+
+    def store_baseline_plugin(self, baseline_id, plugin_name, new_values, part=0):
+        """
+        Store one part of a baseline plugin output, large key lists are split over parts
+        to stay under the document size limit
+        :param baseline_id:
+        :param plugin_name:
+        :param new_values:
+        :param part:
+        :return:
+        """
+        baseline_id = ObjectId(baseline_id)
+        new_values.update({'baseline_id': baseline_id, 'plugin_name': plugin_name, 'part': part,
+                           'updated': datetime.now()})
+        source = 'session/{0}/{1}/{2}'.format(baseline_id, plugin_name, part)
+        self.vol_baselines.update_one({'source': source}, {'$set': new_values}, upsert=True)
+        return True
+
+    def drop_baseline(self, baseline_id):
+        baseline_id = ObjectId(baseline_id)
+        self.vol_baselines.delete_many({'baseline_id': baseline_id})
+        return True
+
+    ##
+    # Session Diffs
+    ##
+
+    def get_diff(self, diff_key):
+        return self.vol_diffs.find_one({'diff_key': diff_key})
+
+    def get_diffbyid(self, diff_id):
+        diff_id = ObjectId(diff_id)
+        return self.vol_diffs.find_one({'_id': diff_id})
+
+    def create_diff(self, diff_data):
+        diff_data['session_ids'] = [ObjectId(session_id) for session_id in diff_data['session_ids']]
+        diff_id = self.vol_diffs.insert_one(diff_data).inserted_id
+        return diff_id
+
+    def update_diff(self, diff_id, new_values):
+        diff_id = ObjectId(diff_id)
+        self.vol_diffs.update_one({'_id': diff_id}, {'$set': new_values})
+        return True
+
+    def drop_diff(self, diff_id):
+        diff_id = ObjectId(diff_id)
+        self.vol_diff_sessions.delete_many({'diff_id': diff_id})
+        self.vol_diffs.delete_one({'_id': diff_id})
+        return True
+
+    def get_diff_sessions(self, diff_id):
+        """
+        The per session results of a diff
+        :param diff_id:
+        :return: list in the order they were stored
+        """
+        diff_id = ObjectId(diff_id)
+        results = self.vol_diff_sessions.find({'diff_id': diff_id}, {'_id': 0, 'diff_id': 0}).sort('_id', 1)
+        return [x for x in results]
+
+    def store_diff_session(self, diff_id, result):
+        """
+        Store the result for one compared session on its own, so a diff of many sessions
+        never has to fit in a single document
+        :param diff_id:
+        :param result:
+        :return:
+        """
+        result['diff_id'] = ObjectId(diff_id)
+        self.vol_diff_sessions.insert_one(result)
+        return True
+
+    ##
+    # Result Cache
+    ##
+
+    def get_cache_entry(self, cache_key):
+        return self.vol_cache.find_one({'cache_key': cache_key})
+
+    def create_cache_entry(self, cache_data):
+        cache_id = self.vol_cache.insert_one(cache_data).inserted_id
+        return cache_id
+
+    def update_cache_entry(self, cache_id, new_values):
+        cache_id = ObjectId(cache_id)
+        self.vol_cache.update_one({'_id': cache_id}, {"$set": new_values})
+        return True
+
+    def drop_cache_entry(self, cache_id):
+        cache_id = ObjectId(cache_id)
+        self.drop_rows(cache_id)
+        self.vol_cache.delete_one({'_id': cache_id})
+        return True
+
+    def cache_size(self):
+        results = [row for row in self.vol_cache.aggregate([{'$group': {'_id': None, 'size': {'$sum': '$size'}}}])]
+        if results:
+            return results[0]['size']
+        return 0
+
+    def get_cache_lru(self, limit=10):
+        results = self.vol_cache.find({}, {'size': 1}).sort('last_used', pymongo.ASCENDING).limit(limit)
+        return [row for row in results]
 
     ##
     # File System
     ##
     def get_filebyid(self, file_id):
         file_id = ObjectId(file_id)
-        file_object = self.vol_files.get(file_id)
+        reference = self.vol_file_refs.find_one({'_id': file_id})
+        if reference:
+            return FileReference(self, reference)
+        # Files stored before deduplication are their own blob
+        return self.get_blob(file_id)
+
+    def get_blob(self, blob_id):
+        file_object = self.vol_files.get(ObjectId(blob_id))
+        # Compressed files decompress as they are read
+        if getattr(file_object, 'compression', None):
+            return DecompressedFile(file_object)
         return file_object
 
     def list_files(self, session_id):
-        session_id = ObjectId(session_id)
-        results = self.vol_files.find({'session_id': session_id})
-        return [row for row in results]
+        return self.search_files({'sess_id': session_id})
 
     def search_files(self, search_query):
-        results = self.vol_files.find(search_query)
-        return [row for row in results]
+        search_query = dict(search_query)
+        # Files record their session as sess_id
+        if 'session_id' in search_query:
+            search_query['sess_id'] = search_query.pop('session_id')
+        if 'sess_id' in search_query and ObjectId.is_valid(search_query['sess_id']):
+            search_query['sess_id'] = ObjectId(search_query['sess_id'])
 
-    def get_strings(self, file_id):
-        file_id = ObjectId(file_id)
-        results = self.vol_files.find_one({'filename': '{0}_strings.txt'.format(str(file_id))})
+        results = [FileReference(self, row) for row in self.vol_file_refs.find(search_query)]
+        # Files stored before deduplication, blobs carry a ref_count
+        search_query['ref_count'] = {'$exists': False}
+        results.extend(self.vol_files.find(search_query))
         return results
 
+    def get_strings(self, file_id):
+        filename = '{0}_strings.txt'.format(str(file_id))
+        reference = self.vol_file_refs.find_one({'filename': filename})
+        if reference:
+            return FileReference(self, reference)
+        return self.vol_files.find_one({'filename': filename, 'ref_count': {'$exists': False}})
+
     def create_file(self, file_data, session_id, sha256, filename, pid=None, file_meta=None):
+        """
+        Store a file, reusing the stored copy of any file with the same sha256
+        :param file_data: str or file like object
+        :param session_id:
+        :param sha256:
+        :param filename:
+        :param pid:
+        :param file_meta:
+        :return: file_id of the reference
+        """
+        if len(session_id) == 24:
+            session_id = ObjectId(session_id)
+        if not re.match('^[0-9a-f]{64}$', str(sha256)) and isinstance(file_data, basestring):
+            sha256 = hashlib.sha256(file_data).hexdigest()
+
+        blob_id = None
+        if re.match('^[0-9a-f]{64}$', str(sha256)):
+            blob_id = self.claim_blob(sha256)
+        if not blob_id:
+            blob_id = self.create_blob(file_data, session_id, sha256, filename, pid=pid, file_meta=file_meta)
+        return self.create_reference(blob_id, session_id, sha256, filename, pid=pid, file_meta=file_meta)
+
+    def ingest_file(self, file_source, session_id, filename, pid=None, file_meta=None, chunk_size=CHUNK_SIZE):
+        """
+        Store a file from disk or an upload without holding it in memory.
+        The file is hashed in chunks first and only written if no copy is stored yet.
+        :param file_source: path or seekable file like object
+        :param session_id:
+        :param filename:
+        :param pid:
+        :param file_meta:
+        :param chunk_size:
+        :return: file_id of the reference
+        """
         if len(session_id) == 24:
             session_id = ObjectId(session_id)
-        file_id = self.vol_files.put(file_data, filename=filename, sess_id=session_id, sha256=sha256, pid=pid, file_meta=file_meta)
-        return file_id
+        if isinstance(file_source, basestring):
+            file_object = open(file_source, 'rb')
+        else:
+            file_object = file_source
+
+        try:
+            sha256 = hashlib.sha256()
+            md5 = hashlib.md5()
+            for chunk in read_chunks(file_object, chunk_size):
+                sha256.update(chunk)
+                md5.update(chunk)
+            sha256 = sha256.hexdigest()
+
+            blob_id = self.claim_blob(sha256)
+            if not blob_id:
+                file_object.seek(0)
+                blob_id = self.create_blob(file_object, session_id, sha256, filename, pid=pid, file_meta=file_meta)
+        finally:
+            if file_object is not file_source:
+                file_object.close()
+
+        return self.create_reference(blob_id, session_id, sha256, filename, pid=pid, file_meta=file_meta,
+                                     md5=md5.hexdigest())
+
+    def claim_blob(self, sha256):
+        """
+        Take a reference on the stored copy of a file
+        :param sha256:
+        :return: blob_id or None if there is no copy
+        """
+        # A blob whose count already hit 0 is being deleted, never revive it
+        blob = self.vol_files_meta.find_one_and_update({'sha256': sha256, 'ref_count': {'$gt': 0}},
+                                                       {'$inc': {'ref_count': 1}},
+                                                       {'_id': 1})
+        if blob:
+            return blob['_id']
+        return None
+
+    def create_reference(self, blob_id, session_id, sha256, filename, pid=None, file_meta=None, md5=None):
+        reference = {'blob_id': blob_id,
+                     'sha256': sha256,
+                     'filename': filename,
+                     'sess_id': session_id,
+                     'pid': pid,
+                     'file_meta': file_meta,
+                     'uploadDate': datetime.now()}
+        if md5:
+            reference['md5'] = md5
+        return self.vol_file_refs.insert_one(reference).inserted_id
+
+    def create_blob(self, file_data, session_id, sha256, filename, pid=None, file_meta=None):
+        """
+        Write the stored copy of a file with one reference, file like objects are written a chunk at a time
+        :return: blob_id
+        """
+        codec = default_codec()
+        if not codec:
+            file_id = self.vol_files.put(file_data, filename=filename, sess_id=session_id, sha256=sha256, pid=pid,
+                                         file_meta=file_meta, ref_count=1)
+            return file_id
+
+        # Compress chunk by chunk straight into GridFS
+        grid_in = self.vol_files.new_file(filename=filename, sess_id=session_id, sha256=sha256, pid=pid,
+                                          file_meta=file_meta, compression=codec, ref_count=1)
+        compressor = Compressor(codec)
+        md5 = hashlib.md5()
+        length = 0
+        try:
+            for chunk in read_chunks(file_data):
+                md5.update(chunk)
+                length += len(chunk)
+                grid_in.write(compressor.compress(chunk))
+            grid_in.write(compressor.flush())
+            grid_in.original_length = length
+            grid_in.original_md5 = md5.hexdigest()
+        except Exception:
+            grid_in.abort()
+            raise
+        grid_in.close()
+        return grid_in._id
+
+    def release_blob(self, blob_id):
+        """
+        Drop one reference to a blob, deleting it with the last one
+        :param blob_id:
+        :return:
+        """
+        blob = self.vol_files_meta.find_one_and_update({'_id': blob_id},
+                                                       {'$inc': {'ref_count': -1}},
+                                                       {'ref_count': 1},
+                                                       return_document=pymongo.ReturnDocument.AFTER)
+        if blob and blob['ref_count'] <= 0:
+            self.vol_files.delete(blob_id)
 
     def drop_file(self, file_id):
         file_id = ObjectId(file_id)
-        self.vol_files.delete(file_id)
+        reference = self.vol_file_refs.find_one_and_delete({'_id': file_id})
+        if reference:
+            self.release_blob(reference['blob_id'])
+        else:
+            self.vol_files.delete(file_id)
         return True
 
     ##
@@ -212,6 +1086,64 @@ class Database():
 
 
 
+    ##
+    # Jobs
+    ##
+
+    def get_job(self, job_id):
+        job_id = ObjectId(job_id)
+        return self.vol_jobs.find_one({'_id': job_id})
+
+    def search_jobs(self, search_query):
+        results = self.vol_jobs.find(search_query)
+        return [row for row in results]
+
+    def get_jobs_byplugin(self, plugin_id, status_list):
+        plugin_id = ObjectId(plugin_id)
+        results = self.vol_jobs.find({'plugin_id': plugin_id, 'status': {'$in': status_list}})
+        return [row for row in results]
+
+    def create_job(self, job_data):
+        job_data['session_id'] = ObjectId(job_data['session_id'])
+        job_data['plugin_id'] = ObjectId(job_data['plugin_id'])
+        job_id = self.vol_jobs.insert_one(job_data).inserted_id
+        return job_id
+
+    def claim_job(self, search_query, new_values):
+        """
+        Atomically take the highest priority job matching the query
+        :param search_query:
+        :param new_values:
+        :return: the claimed job or None
+        """
+        return self.vol_jobs.find_one_and_update(search_query,
+                                                 {"$set": new_values},
+                                                 sort=[('priority', pymongo.ASCENDING), ('created', pymongo.ASCENDING)],
+                                                 return_document=pymongo.ReturnDocument.AFTER)
+
+    def update_job(self, job_id, new_values):
+        job_id = ObjectId(job_id)
+        self.vol_jobs.update_one({'_id': job_id}, {"$set": new_values})
+        return True
+
+    def add_job_file(self, job_id, file_id, size=0):
+        job_id = ObjectId(job_id)
+        self.vol_jobs.update_one({'_id': job_id}, {"$addToSet": {'stored_files': ObjectId(file_id)},
+                                                   "$inc": {'stored_bytes': size}})
+        return True
+
+    def count_jobs(self, search_query):
+        return self.vol_jobs.count_documents(search_query)
+
+    def count_running_byimage(self):
+        """
+        Number of running jobs per image path
+        :return: dict
+        """
+        results = self.vol_jobs.aggregate([{'$match': {'status': 'running'}},
+                                           {'$group': {'_id': '$image', 'count': {'$sum': 1}}}])
+        return dict((row['_id'], row['count']) for row in results)
+
     ##
     # Drop Session
     ##
@@ -220,13 +1152,23 @@ class Database():
 
         # Drop Plugins
         self.vol_plugins.delete_many({'session_id': session_id})
-        # Drop Files
-        results = self.vol_files.find({'session_id': session_id})
-        for row in results:
-            self.vol_files.delete(row['file_id'])
+        self.vol_rows.delete_many({'session_id': session_id})
+        self.vol_progress.delete_many({'session_id': session_id})
+        # Drop any baseline built from the session
+        self.drop_baseline(session_id)
+        # Drop diffs that include the session
+        for row in self.vol_diffs.find({'session_ids': session_id}, {'_id': 1}):
+            self.drop_diff(row['_id'])
+        # Drop Files, blobs go with their last reference
+        for reference in self.vol_file_refs.find({'sess_id': session_id}, {'_id': 1}):
+            self.drop_file(reference['_id'])
+        for row in self.vol_files_meta.find({'sess_id': session_id, 'ref_count': {'$exists': False}}, {'_id': 1}):
+            self.vol_files.delete(row['_id'])
         # Drop DataStore
         self.vol_datastore.delete_many({'session_id': session_id})
         # Drop Notes
         self.vol_comments.delete_many({'session_id': session_id})
+        # Drop queued jobs
+        self.vol_jobs.delete_many({'session_id': session_id, 'status': 'pending'})
         # Drop session
         self.vol_sessions.delete_many({'_id': session_id})
@@ -0,0 +1,181 @@
+import os
+import shutil
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+
+def open_files(directory):
+    """
+    Paths under a directory that a process of this user still has open, empty where /proc is not available
+    :param directory:
+    :return: set
+    """
+    in_use = set()
+    if not os.path.isdir('/proc'):
+        return in_use
+    uid = os.getuid()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        fd_dir = os.path.join('/proc', pid, 'fd')
+        try:
+            if os.stat(os.path.join('/proc', pid)).st_uid != uid:
+                continue
+            for fd in os.listdir(fd_dir):
+                path = os.readlink(os.path.join(fd_dir, fd))
+                if path.startswith(directory):
+                    in_use.add(path)
+        except OSError:
+            continue
+    return in_use
+
+
+class DumpHarvester(object):
+    def __init__(self, db, session_id, dump_dir, workers=4, poll_interval=1.0, settle=2, emit=None):
+        """
+        Store the files a plugin writes to its dump dir while it is still running.
+        A file is stored once it has stopped changing and no process has it open, then it is deleted.
+        :param db: Database instance
+        :param session_id:
+        :param dump_dir:
+        :param workers: threads hashing and storing files
+        :param poll_interval: seconds between directory scans
+        :param settle: scans a file has to stay the same size before it is stored
+        :param emit: progress callback, gets ('files', {'file_id': file_id, 'size': bytes}) for every stored file
+        :return:
+        """
+        self.db = db
+        self.session_id = session_id
+        self.dump_dir = dump_dir
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.emit = emit
+        self.pool = ThreadPool(workers)
+        self.seen = {}
+        self.pending = {}
+        self.stored = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.discarded = False
+        self.watcher = threading.Thread(target=self.watch, name='volutility-harvester')
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def watch(self):
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                self.scan(final=False)
+            except Exception as error:
+                logger.error('Dump dir scan failed for {0}: {1}'.format(self.dump_dir, error))
+
+    def scan(self, final=False):
+        """
+        Queue the files that are ready to store
+        :param final: the plugin has finished, store everything
+        :return:
+        """
+        if not os.path.isdir(self.dump_dir):
+            return
+        ready = []
+        for filename in os.listdir(self.dump_dir):
+            path = os.path.join(self.dump_dir, filename)
+            if filename in self.pending or not os.path.isfile(path):
+                continue
+            if final:
+                ready.append(filename)
+                continue
+            stat = os.stat(path)
+            state = (stat.st_size, stat.st_mtime)
+            previous, count = self.seen.get(filename, (None, 0))
+            count = count + 1 if previous == state else 0
+            self.seen[filename] = (state, count)
+            if count >= self.settle:
+                ready.append(filename)
+
+        if ready and not final:
+            in_use = open_files(self.dump_dir)
+            ready = [filename for filename in ready if os.path.join(self.dump_dir, filename) not in in_use]
+
+        with self.lock:
+            for filename in ready:
+                self.pending[filename] = self.pool.apply_async(self.store, (filename,))
+
+    def store(self, filename):
+        """
+        Hash and store a single file then remove it from the dump dir
+        :param filename:
+        :return: file_id
+        """
+        path = os.path.join(self.dump_dir, filename)
+        size = os.path.getsize(path)
+        file_id = self.db.ingest_file(path, self.session_id, filename)
+        os.remove(path)
+        with self.lock:
+            # A rerun into the same dump dir replaces the earlier copy
+            previous = self.stored.get(filename)
+            self.stored[filename] = file_id
+            self.pending.pop(filename, None)
+            if self.emit:
+                self.emit('files', {'file_id': file_id, 'size': size})
+        if previous:
+            self.db.drop_file(previous)
+        logger.debug('Stored dumped file {0}'.format(filename))
+        return file_id
+
+    def stop(self):
+        """
+        Stop watching and wait for any files being stored
+        :return:
+        """
+        self.stopped.set()
+        self.watcher.join()
+        with self.lock:
+            pending = self.pending.values()
+        for result in pending:
+            result.wait()
+
+    def finish(self):
+        """
+        Store whatever is left once the plugin is done and remove the dump dir
+        :return: dict of filename to file_id
+        """
+        self.stop()
+        self.scan(final=True)
+        with self.lock:
+            pending = self.pending.values()
+        self.pool.close()
+        self.pool.join()
+        for result in pending:
+            # Raises if a file could not be stored, the caller should discard the run
+            result.get()
+        shutil.rmtree(self.dump_dir, ignore_errors=True)
+        return dict(self.stored)
+
+    def drop(self, filename):
+        """
+        Drop a stored file the output does not use, discard will not drop it again
+        :param filename:
+        :return:
+        """
+        file_id = self.stored.pop(filename, None)
+        if file_id:
+            self.db.drop_file(file_id)
+
+    def discard(self):
+        """
+        Drop everything stored so far and remove the dump dir, for runs that failed.
+        Safe to call more than once and after finish.
+        :return:
+        """
+        if self.discarded:
+            return
+        self.discarded = True
+        self.stop()
+        self.pool.close()
+        self.pool.join()
+        for file_id in self.stored.values():
+            self.db.drop_file(file_id)
+        shutil.rmtree(self.dump_dir, ignore_errors=True)
@@ -0,0 +1,516 @@
+import os
+import time
+import shutil
+import socket
+import logging
+import threading
+import multiprocessing
+from datetime import datetime
+
+from web.common import parse_config
+from web.vol_pool import vol_pool
+
+logger = logging.getLogger(__name__)
+config = parse_config()
+
+if 'jobs' in config:
+    job_config = config['jobs']
+else:
+    job_config = {}
+
+# Lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 5
+PRIORITY_AUTORUN = 10
+
+# Statuses a job can end in
+FINISHED = ['completed', 'error', 'cancelled']
+
+# Plugins whose output keeps the rows of every earlier run, a run only writes it once it has finished
+append_plugins = ['dumpfiles', 'memdump', 'procdump', 'dlldump', 'vaddump', 'linux_find_file']
+
+# The job this process is running, set in the job child
+current_job = {}
+
+
+def pid_alive(pid):
+    """
+    check if a process id is still running on this host
+    :param pid:
+    :return: bool
+    """
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def process_rss(pid):
+    """
+    resident memory of a process in bytes, 0 where /proc is not available
+    :param pid:
+    :return: int
+    """
+    try:
+        with open('/proc/{0}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return 0
+
+
+def dir_size(path):
+    """
+    total size of the files under a directory
+    :param path:
+    :return: int bytes
+    """
+    total = 0
+    for root, subdir, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def record_dump_dir(dump_dir):
+    """
+    Tell the dispatcher where the current job writes files so it can be size limited
+    :param dump_dir:
+    :return:
+    """
+    if current_job:
+        current_job['db'].update_job(current_job['job_id'], {'dump_dir': dump_dir})
+        current_job['progress'].dump_dir = dump_dir
+
+
+def report_progress(event, data):
+    """
+    emit callback for plugin runs, passes row batches, scan progress and stored files to the current job
+    :param event:
+    :param data:
+    :return:
+    """
+    if current_job:
+        if event == 'files':
+            # Kept on the job so a cancelled run can drop them and the dump limit can count them
+            current_job['db'].add_job_file(current_job['job_id'], data['file_id'], data['size'])
+        current_job['progress'].emit(event, data)
+
+
+class PluginProgress(object):
+    def __init__(self, db, session_id, plugin_id, interval=5.0):
+        """
+        Progress of a plugin run, written to the database every interval while it runs
+        :param db:
+        :param session_id:
+        :param plugin_id:
+        :param interval: seconds between writes
+        :return:
+        """
+        self.db = db
+        self.session_id = session_id
+        self.plugin_id = plugin_id
+        self.interval = interval
+        self.started = datetime.now()
+        self.rows = 0
+        self.scanned = 0
+        self.image_size = 0
+        self.files_stored = 0
+        self.dump_dir = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def emit(self, event, data):
+        if event == 'rows':
+            self.rows += len(data)
+        elif event == 'progress':
+            self.scanned = data['scanned']
+            self.image_size = data['image_size']
+        elif event == 'files':
+            # Dumped files already stored and removed from the dump dir
+            self.files_stored += 1
+
+    def write(self, status):
+        files_dumped = self.files_stored
+        if self.dump_dir and os.path.exists(self.dump_dir):
+            files_dumped += sum(len(filenames) for root, subdir, filenames in os.walk(self.dump_dir))
+        self.db.update_progress(self.plugin_id, self.session_id, {'status': status,
+                                                                  'rows': self.rows,
+                                                                  'scanned': self.scanned,
+                                                                  'image_size': self.image_size,
+                                                                  'files_dumped': files_dumped,
+                                                                  'started': self.started,
+                                                                  'elapsed': (datetime.now() - self.started).total_seconds(),
+                                                                  'updated': datetime.now()})
+
+    def start(self):
+        self.write('running')
+        self.thread = threading.Thread(target=self.write_loop, name='volutility-progress')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write_loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write('running')
+            except Exception as error:
+                logger.warning('Unable to write progress for {0}: {1}'.format(self.plugin_id, error))
+
+    def stop(self, status):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.write(status)
+
+
+def run_job(db, runner, job, connect=None):
+    """
+    Child process entry point, runs the plugin and records the outcome on the job
+    :param db:
+    :param runner:
+    :param job:
+    :param connect: function returning a new Database for the child, the parent connection is not fork safe
+    :return:
+    """
+    if connect:
+        db = connect()
+    progress = PluginProgress(db, job['session_id'], job['plugin_id'])
+    current_job.update({'db': db, 'job_id': job['_id'], 'progress': progress})
+    vol_pool.job_id = str(job['_id'])
+    progress.start()
+    try:
+        result = runner(str(job['session_id']),
+                        str(job['plugin_id']),
+                        pid=job.get('pid'),
+                        plugin_options=job.get('plugin_options'))
+        if str(result).startswith('Error'):
+            status = 'error'
+        else:
+            status = 'completed'
+    except Exception as error:
+        logger.error('Job {0} failed: {1}'.format(job['_id'], error))
+        result = 'Error: {0}'.format(error)
+        status = 'error'
+
+    progress.stop(status)
+    db.update_job(job['_id'], {'status': status, 'result': str(result), 'finished': datetime.now()})
+
+
+class JobQueue(object):
+    def __init__(self, db, runner, max_per_host=4, max_per_image=2, poll_interval=1.0, timeout=0, max_rss=0,
+                 max_dump_size=0, connect=None):
+        """
+        Scheduler that all plugin execution goes through.
+        Jobs live in the database so they outlast the web process that queued them.
+        :param db: Database instance
+        :param runner: function(session_id, plugin_id, pid=None, plugin_options=None)
+        :param max_per_host: running jobs allowed on this host
+        :param max_per_image: running jobs allowed against a single image
+        :param poll_interval: seconds between dispatcher passes
+        :param timeout: seconds a job may run, 0 for no limit
+        :param max_rss: bytes of memory a job and its worker may use, 0 for no limit
+        :param max_dump_size: bytes a job may write to its dump dir, 0 for no limit
+        :param connect: function called in each job child to open its own Database
+        :return:
+        """
+        self.db = db
+        self.runner = runner
+        self.max_per_host = max_per_host
+        self.max_per_image = max_per_image
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self.max_dump_size = max_dump_size
+        self.connect = connect
+        self.hostname = socket.gethostname()
+        self.processes = {}
+        self.dispatcher = None
+        self.lock = threading.Lock()
+
+    def submit(self, session_id, plugin_id, priority=PRIORITY_NORMAL, pid=None, plugin_options=None, pin_host=False):
+        """
+        Queue a plugin run
+        :param session_id:
+        :param plugin_id:
+        :param priority: PRIORITY_INTERACTIVE runs ahead of PRIORITY_AUTORUN
+        :param pid:
+        :param plugin_options:
+        :param pin_host: only run on this host, for jobs that leave files behind locally
+        :return: job_id
+        """
+        session = self.db.get_session(session_id)
+        plugin = self.db.get_pluginbyid(plugin_id, load_rows=False)
+        job_data = {'session_id': session_id,
+                    'plugin_id': plugin_id,
+                    'plugin_name': plugin['plugin_name'],
+                    'plugin_status': plugin.get('status'),
+                    'image': session['session_path'],
+                    'priority': priority,
+                    'pid': pid,
+                    'plugin_options': plugin_options,
+                    'pin_host': self.hostname if pin_host else None,
+                    'status': 'pending',
+                    'host': None,
+                    'process_id': None,
+                    'result': None,
+                    'created': datetime.now(),
+                    'started': None,
+                    'finished': None}
+        job_id = self.db.create_job(job_data)
+        self.start()
+        return job_id
+
+    def wait(self, job_id, timeout=None):
+        """
+        Block until the job has finished
+        :param job_id:
+        :param timeout: seconds, None waits forever
+        :return: job document
+        """
+        self.start()
+        start_time = time.time()
+        while True:
+            job = self.db.get_job(job_id)
+            if not job or job['status'] in FINISHED:
+                return job
+            if timeout and time.time() - start_time > timeout:
+                return job
+            time.sleep(self.poll_interval)
+
+    def run(self, session_id, plugin_id, pid=None, plugin_options=None, pin_host=False):
+        """
+        Queue an interactive plugin run and wait for it
+        :return: the value run_plugin returned
+        """
+        job_id = self.submit(session_id, plugin_id,
+                             priority=PRIORITY_INTERACTIVE,
+                             pid=pid,
+                             plugin_options=plugin_options,
+                             pin_host=pin_host)
+        job = self.wait(job_id)
+        if not job:
+            return 'Error: Job {0} was removed'.format(job_id)
+        return job['result']
+
+    def cancel(self, plugin_id):
+        """
+        Cancel the queued or running jobs for a plugin
+        :param plugin_id:
+        :return: int jobs cancelled
+        """
+        cancelled = 0
+        for job in self.db.get_jobs_byplugin(plugin_id, ['pending', 'running']):
+            if job['status'] == 'pending':
+                # Only cancel it if no dispatcher claimed it in the meantime
+                if self.db.claim_job({'_id': job['_id'], 'status': 'pending'},
+                                     {'status': 'cancelled',
+                                      'result': 'Error: Plugin run cancelled',
+                                      'finished': datetime.now()}):
+                    self.release_plugin(job)
+                    cancelled += 1
+                    continue
+            # The dispatcher running it stops the process on its next pass
+            self.db.update_job(job['_id'], {'cancel': True})
+            cancelled += 1
+        return cancelled
+
+    def start(self):
+        """
+        Start the dispatcher thread for this process once
+        :return:
+        """
+        # Daemonic processes such as pool workers can not start children,
+        # the web process dispatcher picks their jobs up instead
+        if multiprocessing.current_process().daemon:
+            return
+        with self.lock:
+            if self.dispatcher and self.dispatcher.is_alive():
+                return
+            self.recover()
+            # Job children and the session pool can not start workers, they connect to the ones started here
+            vol_pool.start_workers()
+            self.dispatcher = threading.Thread(target=self.dispatch_loop, name='volutility-dispatcher')
+            self.dispatcher.daemon = True
+            self.dispatcher.start()
+
+    def recover(self):
+        """
+        Requeue jobs this host was running when its web process went away
+        :return:
+        """
+        for job in self.db.search_jobs({'status': 'running', 'host': self.hostname}):
+            if job['_id'] in self.processes or pid_alive(job['process_id']):
+                continue
+            if job.get('cancel'):
+                self.finish_cancelled(job, 'Plugin run cancelled')
+                continue
+            # Claimed by another process on this host that has not started it yet
+            if not job['process_id'] and job['started'] and (datetime.now() - job['started']).total_seconds() < 60:
+                continue
+            logger.info('Requeueing job {0} for plugin {1}'.format(job['_id'], job['plugin_id']))
+            self.db.update_job(job['_id'], {'status': 'pending', 'host': None, 'process_id': None, 'started': None})
+
+    def dispatch_loop(self):
+        while True:
+            try:
+                self.reap()
+                # Replace any worker that died so the next job finds its image warm
+                vol_pool.start_workers()
+                self.fill()
+            except Exception as error:
+                logger.error('Job dispatcher error: {0}'.format(error))
+            time.sleep(self.poll_interval)
+
+    def limit_reason(self, job, process):
+        """
+        Check a running job against cancellation and the configured limits
+        :param job:
+        :param process:
+        :return: str reason to stop it or None
+        """
+        if job.get('cancel'):
+            return 'Plugin run cancelled'
+        if self.timeout and job['started'] and (datetime.now() - job['started']).total_seconds() > self.timeout:
+            return 'Plugin run exceeded the {0} second timeout'.format(self.timeout)
+        if self.max_rss:
+            rss = process_rss(process.pid)
+            worker = self.job_worker(job)
+            if worker:
+                rss += process_rss(worker.pid)
+            if rss > self.max_rss:
+                return 'Plugin run exceeded the {0}MB memory limit'.format(self.max_rss / 1024 ** 2)
+        if self.max_dump_size:
+            # The harvester empties the dump dir as it goes, what it already stored counts too
+            dumped = job.get('stored_bytes', 0)
+            if job.get('dump_dir') and os.path.exists(job['dump_dir']):
+                dumped += dir_size(job['dump_dir'])
+            if dumped > self.max_dump_size:
+                return 'Plugin run exceeded the {0}MB dump directory limit'.format(self.max_dump_size / 1024 ** 2)
+        return None
+
+    def job_worker(self, job):
+        """
+        The volatility worker process doing the work for a job, if this process owns it and it is serving the job
+        :param job:
+        :return: multiprocessing.Process or None
+        """
+        session = self.db.get_session(job['session_id'])
+        if not session:
+            return None
+        if vol_pool.serving(session['session_profile'], session['session_path']) != str(job['_id']):
+            return None
+        return vol_pool.get_worker(session['session_profile'], session['session_path'])
+
+    def stop(self, job, process, reason):
+        """
+        Kill a job and the worker running its plugin
+        :param job:
+        :param process:
+        :param reason:
+        :return:
+        """
+        logger.warning('Stopping job {0}: {1}'.format(job['_id'], reason))
+        process.terminate()
+        process.join(5)
+        del self.processes[job['_id']]
+
+        # The worker keeps calculating after the job child is gone, unless it is busy with another job
+        session = self.db.get_session(job['session_id'])
+        if session:
+            vol_pool.stop_worker(session['session_profile'], session['session_path'], job_id=job['_id'])
+
+        self.finish_cancelled(job, reason)
+
+    def finish_cancelled(self, job, reason):
+        """
+        Record a stopped job and clean up anything it left on disk or in the database
+        :param job:
+        :param reason:
+        :return:
+        """
+        # Files the child stored after the job was last read
+        job = self.db.get_job(job['_id']) or job
+        if job.get('dump_dir') and os.path.exists(job['dump_dir']):
+            shutil.rmtree(job['dump_dir'], ignore_errors=True)
+        referenced = ''
+        if job.get('plugin_name', '').lower() in append_plugins:
+            # A run stopped just after writing its output already has rows pointing at its files
+            plugin = self.db.get_pluginbyid(job['plugin_id'])
+            referenced = str(plugin.get('plugin_output')) if plugin else ''
+        for file_id in job.get('stored_files', []):
+            if str(file_id) not in referenced:
+                self.db.drop_file(file_id)
+        self.db.update_job(job['_id'], {'status': 'cancelled',
+                                        'result': 'Error: {0}'.format(reason),
+                                        'finished': datetime.now()})
+        self.release_plugin(job)
+        self.db.update_progress(job['plugin_id'], job['session_id'], {'status': 'cancelled', 'updated': datetime.now()})
+
+    def release_plugin(self, job):
+        """
+        Put a plugin back after its job was cancelled
+        :param job:
+        :return:
+        """
+        if job.get('plugin_name', '').lower() in append_plugins:
+            # The output holds the rows of earlier runs and the files they stored, only the status changed
+            self.db.update_plugin(job['plugin_id'], {'status': job.get('plugin_status')})
+        else:
+            # Clearing the output drops any rows the run had already written
+            self.db.update_plugin(job['plugin_id'], {'status': 'cancelled', 'plugin_output': None})
+
+    def reap(self):
+        """
+        Collect finished children, stop any over their limits and catch any that died without reporting
+        :return:
+        """
+        for job_id, process in self.processes.items():
+            if process.is_alive():
+                job = self.db.get_job(job_id)
+                if job and job['status'] == 'running':
+                    reason = self.limit_reason(job, process)
+                    if reason:
+                        self.stop(job, process, reason)
+                continue
+            process.join()
+            del self.processes[job_id]
+            job = self.db.get_job(job_id)
+            if job and job['status'] == 'running':
+                self.db.update_job(job_id, {'status': 'error',
+                                            'result': 'Error: Job exited with code {0}'.format(process.exitcode),
+                                            'finished': datetime.now()})
+
+    def fill(self):
+        """
+        Start pending jobs until the host or image limits are reached
+        :return:
+        """
+        host_running = self.db.count_jobs({'status': 'running', 'host': self.hostname})
+        image_running = self.db.count_running_byimage()
+
+        while host_running < self.max_per_host:
+            full_images = [image for image, count in image_running.items() if count >= self.max_per_image]
+            job = self.db.claim_job({'status': 'pending',
+                                     'image': {'$nin': full_images},
+                                     'pin_host': {'$in': [None, self.hostname]}},
+                                    {'status': 'running',
+                                     'host': self.hostname,
+                                     'started': datetime.now()})
+            if not job:
+                return
+
+            process = multiprocessing.Process(target=run_job, args=(self.db, self.runner, job, self.connect))
+            process.start()
+            self.processes[job['_id']] = process
+            self.db.update_job(job['_id'], {'process_id': process.pid})
+
+            host_running += 1
+            image_running[job['image']] = image_running.get(job['image'], 0) + 1
@@ -0,0 +1,198 @@
+import re
+import json
+import hashlib
+import logging
+from datetime import datetime
+
+from pymongo.errors import DuplicateKeyError
+
+from web.common import parse_config
+
+logger = logging.getLogger(__name__)
+config = parse_config()
+
+if 'cache' in config:
+    cache_config = config['cache']
+else:
+    cache_config = {}
+
+
+# Seconds an entry may spend copying its rows before it is taken as abandoned and replaced
+copy_timeout = 3600
+
+
+def copy_started(entry):
+    """
+    When a cache entry started copying its rows in
+    :param entry:
+    :return: datetime or None once the rows are all there
+    """
+    if entry.get('copying'):
+        return entry['copying']
+    # Entries written before the copy was timestamped
+    if entry.get('ready') is False:
+        return entry['created']
+    return None
+
+
+def image_hash(session):
+    """
+    return the content hash for a session image or None if it was never hashed
+    :param session:
+    :return: str or None
+    """
+    file_hash = session.get('file_hash', '')
+    if re.match('^[0-9a-fA-F]{32}$', str(file_hash)):
+        return file_hash.lower()
+    return None
+
+
+class ResultCache(object):
+    def __init__(self, db, max_size=2 * 1024 ** 3, enabled=True):
+        """
+        Plugin results shared between sessions of the same image
+        :param db: Database instance
+        :param max_size: bytes kept before the least recently used entries are dropped
+        :param enabled:
+        :return:
+        """
+        self.db = db
+        self.max_size = max_size
+        self.enabled = enabled
+
+    def key(self, session, plugin_name, pid=None, plugin_options=None):
+        """
+        Build the cache key for a plugin run
+        :param session:
+        :param plugin_name:
+        :param pid:
+        :param plugin_options:
+        :return: str or None if the run can not be cached
+        """
+        if not self.enabled:
+            return None
+        file_hash = image_hash(session)
+        if not file_hash:
+            return None
+
+        options = {}
+        for option, value in (plugin_options or {}).items():
+            options[str(option).upper()] = str(value)
+        if pid:
+            options['PID'] = str(pid)
+
+        key_data = json.dumps([file_hash, session['session_profile'], plugin_name, options], sort_keys=True)
+        return hashlib.sha256(key_data).hexdigest()
+
+    def fetch(self, cache_key, session_id, plugin_id):
+        """
+        Copy a cached result into a plugin
+        :param cache_key:
+        :param session_id:
+        :param plugin_id:
+        :return: bool hit
+        """
+        entry = self.db.get_cache_entry(cache_key)
+        if entry and self.abandoned(entry):
+            self.db.drop_cache_entry(entry['_id'])
+            return False
+        # Rows still being copied in
+        if not entry or copy_started(entry):
+            return False
+
+        logger.debug('Result cache hit for {0}'.format(entry['plugin_name']))
+        new_values = {'created': datetime.now(), 'status': 'completed'}
+        if 'rowstore' in entry:
+            self.db.drop_rows(plugin_id)
+            row_count, size = self.db.copy_rows(entry['_id'], plugin_id, session_id)
+            new_values['plugin_output'] = {'columns': entry['plugin_output']['columns'], 'rows': []}
+            new_values['rowstore'] = 'True'
+            new_values['row_count'] = row_count
+        else:
+            new_values['plugin_output'] = entry['plugin_output']
+
+        self.db.update_plugin(plugin_id, new_values)
+        self.db.update_cache_entry(entry['_id'], {'last_used': datetime.now()})
+        return True
+
+    def store(self, cache_key, session, plugin_id):
+        """
+        Keep a finished plugin result for other sessions of the same image
+        :param cache_key:
+        :param session:
+        :param plugin_id:
+        :return:
+        """
+        plugin = self.db.get_pluginbyid(plugin_id, load_rows=False)
+        if not plugin or not plugin['plugin_output']:
+            return
+
+        entry = {'cache_key': cache_key,
+                 'file_hash': image_hash(session),
+                 'profile': session['session_profile'],
+                 'plugin_name': plugin['plugin_name'],
+                 'created': datetime.now(),
+                 'last_used': datetime.now()}
+
+        if 'rowstore' in plugin:
+            entry['plugin_output'] = {'columns': plugin['plugin_output']['columns'], 'rows': []}
+            entry['rowstore'] = 'True'
+            entry['size'] = 0
+            entry['copying'] = datetime.now()
+        else:
+            entry['plugin_output'] = plugin['plugin_output']
+            entry['size'] = len(str(plugin['plugin_output']))
+
+        try:
+            cache_id = self.db.create_cache_entry(entry)
+        except DuplicateKeyError:
+            existing = self.db.get_cache_entry(cache_key)
+            if not existing or not self.abandoned(existing):
+                return
+            # Replace an entry whose copy never finished
+            self.db.drop_cache_entry(existing['_id'])
+            entry.pop('_id', None)
+            try:
+                cache_id = self.db.create_cache_entry(entry)
+            except DuplicateKeyError:
+                return
+
+        if 'rowstore' in plugin:
+            try:
+                row_count, size = self.db.copy_rows(plugin_id, cache_id, None)
+            except Exception as error:
+                logger.error('Unable to copy rows into the result cache: {0}'.format(error))
+                self.db.drop_cache_entry(cache_id)
+                return
+            self.db.update_cache_entry(cache_id, {'size': size, 'copying': None})
+
+        self.evict()
+
+    def abandoned(self, entry):
+        """
+        check if an entry has been copying its rows for longer than copy_timeout, the copy was interrupted
+        :param entry:
+        :return: bool
+        """
+        started = copy_started(entry)
+        if not started or (datetime.now() - started).total_seconds() < copy_timeout:
+            return False
+        logger.warning('Cached result {0} never finished copying its rows'.format(entry['_id']))
+        return True
+
+    def evict(self):
+        """
+        Drop the least recently used entries until the cache fits
+        :return:
+        """
+        total = self.db.cache_size()
+        while total > self.max_size:
+            oldest = self.db.get_cache_lru()
+            if not oldest:
+                return
+            for entry in oldest:
+                if total <= self.max_size:
+                    return
+                logger.debug('Evicting cached result {0}'.format(entry['_id']))
+                self.db.drop_cache_entry(entry['_id'])
+                total -= entry['size']
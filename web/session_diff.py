@@ -0,0 +1,252 @@
+import json
+import hashlib
+import logging
+from datetime import datetime
+from itertools import groupby
+from collections import Counter
+
+from pymongo.errors import DuplicateKeyError
+
+from baseline import PLUGINS_DIFF_PARAM_1, value_key, row_fingerprint, fingerprint_columns
+
+logger = logging.getLogger(__name__)
+
+# Rows kept per session for each of added, removed and changed, the counts are always complete
+max_diff_rows = 250
+
+# Seconds before a diff that never finished is run again
+stale_after = 3600
+
+
+def diff_key(db, plugin_name, session_ids, key_columns):
+    """
+    Cache key for a diff, changes when any of the plugin outputs is rerun
+    :param db:
+    :param plugin_name:
+    :param session_ids: the first session is the reference
+    :param key_columns:
+    :return: str or None if a session does not have a finished run of the plugin
+    """
+    versions = []
+    for session_id in session_ids:
+        plugin = db.get_plugin_byname(plugin_name, session_id, load_rows=False)
+        if not plugin or plugin.get('status') not in ['completed', 'complete'] or not plugin.get('plugin_output'):
+            return None
+        versions.append([str(session_id), str(plugin['_id']), str(plugin.get('created'))])
+    key_data = json.dumps([plugin_name, versions, key_columns])
+    return hashlib.sha256(key_data).hexdigest()
+
+
+def default_key_columns(plugin_name, columns):
+    """
+    The golden image diff column for a plugin, otherwise the whole row
+    :param plugin_name:
+    :param columns: plugin columns without the VolUtility ones
+    :return: list of column names
+    """
+    for plugin, idx in PLUGINS_DIFF_PARAM_1:
+        if plugin == plugin_name and idx <= len(columns):
+            return [columns[idx - 1]]
+    return list(columns)
+
+
+def keyed_rows(db, plugin, key_columns):
+    """
+    Hash every row of a stored output on its key columns and its plugin values
+    :param db:
+    :param plugin:
+    :param key_columns: column names
+    :return: (plugin columns, list of (key, fingerprint, values) sorted by key)
+    """
+    all_columns = plugin['plugin_output']['columns']
+    positions = fingerprint_columns(all_columns)
+    columns = [all_columns[position] for position in positions]
+    missing = [name for name in key_columns if name not in columns]
+    if missing:
+        raise ValueError('{0} has no column {1}'.format(plugin['plugin_name'], ', '.join(missing)))
+    key_positions = [columns.index(name) for name in key_columns]
+
+    rows = []
+    for row in db.iter_plugin_rows(plugin['_id']):
+        values = [row[position] if position < len(row) else None for position in positions]
+        key = value_key([values[position] for position in key_positions])
+        rows.append((key, row_fingerprint(values), values))
+    rows.sort(key=lambda row: (row[0], row[1]))
+    return columns, rows
+
+
+def surplus_rows(rows, counts):
+    """
+    Rows left over once every fingerprint in counts has been matched once
+    :param rows: keyed rows sharing a key
+    :param counts: Counter of the fingerprints on the other side
+    :return: list of row values
+    """
+    counts = counts.copy()
+    surplus = []
+    for row in rows:
+        if counts[row[1]]:
+            counts[row[1]] -= 1
+        else:
+            surplus.append(row[2])
+    return surplus
+
+
+def merge_rows(reference, other):
+    """
+    Sort-merge two keyed row lists.
+    Rows sharing a key are compared as a multiset, so a duplicated row that loses a copy is still a removal.
+    Rows only in other are added, only in reference removed, a key with rows on both sides that differ is changed.
+    :param reference: keyed_rows of the reference session
+    :param other: keyed_rows of the compared session
+    :return: dict of added, removed and changed counts and rows
+    """
+    result = {'added': 0, 'removed': 0, 'changed': 0,
+              'rows': {'added': [], 'removed': [], 'changed': []}}
+
+    def keep(kind, value):
+        result[kind] += 1
+        if len(result['rows'][kind]) < max_diff_rows:
+            result['rows'][kind].append(value)
+
+    ref_groups = groupby(reference, key=lambda row: row[0])
+    other_groups = groupby(other, key=lambda row: row[0])
+    ref_group = next(ref_groups, None)
+    other_group = next(other_groups, None)
+
+    while ref_group or other_group:
+        if other_group is None or (ref_group and ref_group[0] < other_group[0]):
+            for row in ref_group[1]:
+                keep('removed', row[2])
+            ref_group = next(ref_groups, None)
+        elif ref_group is None or other_group[0] < ref_group[0]:
+            for row in other_group[1]:
+                keep('added', row[2])
+            other_group = next(other_groups, None)
+        else:
+            ref_rows = list(ref_group[1])
+            other_rows = list(other_group[1])
+            before = surplus_rows(ref_rows, Counter(row[1] for row in other_rows))
+            after = surplus_rows(other_rows, Counter(row[1] for row in ref_rows))
+            if before and after:
+                keep('changed', {'before': before[:max_diff_rows], 'after': after[:max_diff_rows]})
+            else:
+                for values in before:
+                    keep('removed', values)
+                for values in after:
+                    keep('added', values)
+            ref_group = next(ref_groups, None)
+            other_group = next(other_groups, None)
+
+    return result
+
+
+def diff_sessions(db, plugin_name, session_ids, key_columns=None):
+    """
+    Diff a plugin output of each session against the first session
+    :param db:
+    :param plugin_name:
+    :param session_ids: the first session is the reference
+    :param key_columns: column names identifying a row, defaults to default_key_columns
+    :return: dict
+    """
+    plugins = []
+    for session_id in session_ids:
+        plugin = db.get_plugin_byname(plugin_name, session_id, load_rows=False)
+        if not plugin or not plugin.get('plugin_output'):
+            raise ValueError('No {0} output for session {1}'.format(plugin_name, session_id))
+        plugins.append(plugin)
+
+    reference_columns = plugins[0]['plugin_output']['columns']
+    reference_columns = [reference_columns[position] for position in fingerprint_columns(reference_columns)]
+    if not key_columns:
+        key_columns = default_key_columns(plugin_name, reference_columns)
+
+    columns, reference = keyed_rows(db, plugins[0], key_columns)
+    results = {'plugin_name': plugin_name,
+               'reference': str(session_ids[0]),
+               'columns': columns,
+               'key_columns': key_columns,
+               'sessions': []}
+    for session_id, plugin in zip(session_ids[1:], plugins[1:]):
+        other = keyed_rows(db, plugin, key_columns)[1]
+        result = merge_rows(reference, other)
+        result['session_id'] = str(session_id)
+        results['sessions'].append(result)
+    return results
+
+
+def request_diff(db, plugin_name, session_ids, key_columns=None):
+    """
+    Find a cached diff or record a new one to be run
+    :param db:
+    :param plugin_name:
+    :param session_ids:
+    :param key_columns:
+    :return: (diff document, bool the diff still has to be run)
+    """
+    cache_key = diff_key(db, plugin_name, session_ids, key_columns)
+    if not cache_key:
+        raise ValueError('Every session needs a finished {0} run'.format(plugin_name))
+
+    diff = db.get_diff(cache_key)
+    if diff:
+        age = (datetime.now() - diff['created']).total_seconds()
+        if diff['status'] == 'completed' or (diff['status'] in ['pending', 'running'] and age < stale_after):
+            db.update_diff(diff['_id'], {'last_used': datetime.now()})
+            return diff, False
+        db.drop_diff(diff['_id'])
+
+    diff = {'diff_key': cache_key,
+            'plugin_name': plugin_name,
+            'session_ids': list(session_ids),
+            'key_columns': key_columns,
+            'status': 'pending',
+            'result': None,
+            'created': datetime.now(),
+            'last_used': datetime.now()}
+    try:
+        diff['_id'] = db.create_diff(diff)
+    except DuplicateKeyError:
+        # Someone else asked for the same diff first
+        return db.get_diff(cache_key), False
+    return diff, True
+
+
+def diff_result(db, diff):
+    """
+    The result of a diff with the per session results gathered back in
+    :param db:
+    :param diff: diff document
+    :return: dict or None if it has not finished
+    """
+    result = diff.get('result')
+    if diff['status'] != 'completed' or not result:
+        return result
+    result = dict(result)
+    result['sessions'] = db.get_diff_sessions(diff['_id'])
+    return result
+
+
+def run_diff(db, diff_id):
+    """
+    Background entry point, runs a recorded diff and stores the result.
+    Each compared session is stored separately, the diff itself only keeps the summary.
+    :param db:
+    :param diff_id:
+    :return:
+    """
+    diff = db.get_diffbyid(diff_id)
+    db.update_diff(diff_id, {'status': 'running'})
+    try:
+        result = diff_sessions(db, diff['plugin_name'], diff['session_ids'], diff['key_columns'])
+        summary = []
+        for session_result in result['sessions']:
+            summary.append({'session_id': session_result['session_id'], 'added': session_result['added'],
+                            'removed': session_result['removed'], 'changed': session_result['changed']})
+            db.store_diff_session(diff_id, session_result)
+        result['sessions'] = summary
+        db.update_diff(diff_id, {'status': 'completed', 'result': result, 'finished': datetime.now()})
+    except Exception as error:
+        logger.error('Unable to diff {0}: {1}'.format(diff['plugin_name'], error))
+        db.update_diff(diff_id, {'status': 'error', 'result': {'error': str(error)}})
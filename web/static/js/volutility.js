@@ -64,6 +64,36 @@ function spinnerControl(state, message){
 }
 
 
+/*
+Plugin Events:
+Subscribe to plugin status changes for the open session and replace the plugin table rows as they change.
+Falls back to pollplugins where the browser has no EventSource.
+ */
+
+var pluginEvents = null;
+
+function subscribePluginEvents(){
+    var session_id = $('#sessionID').html();
+    if (typeof session_id === "undefined" || typeof(EventSource) === "undefined"){
+        return;
+    }
+    pluginEvents = new EventSource('/ajaxhandler/pluginevents/?session_id=' + session_id);
+    pluginEvents.onmessage = function(event) {
+        var data = JSON.parse(event.data);
+        var row = $(document.getElementById(data['plugin_id']));
+        if (row.length){
+            row.replaceWith(data['html']);
+        } else {
+            $('#pluginTable').prepend(data['html']);
+        }
+    };
+}
+
+$(document).ready(function () {
+    subscribePluginEvents();
+});
+
+
 /*
 Alert Bar:
 Generates a dismissable alert bar at the top of tha page.
@@ -83,8 +113,10 @@ function alertBar(alertType, strong, message){
                            </div>';
 
     $('#alertTarget').after(alert_bar);
-    var session_id = $('#sessionID').html();
-    ajaxHandler('pollplugins', {'session_id':session_id}, false );
+    if (pluginEvents == null){
+        var session_id = $('#sessionID').html();
+        ajaxHandler('pollplugins', {'session_id':session_id}, false );
+    }
 
 }
 
@@ -141,8 +173,10 @@ function notifications(notifyType, add, plugin_id, msg){
              $('#errorcount').html(0);
             $('#notifyerror').html('<li><a href="#" onclick="notifications(\'error\', false, \'\', \'Clear All\'); return false">Clear All</a></li>');
         }
-    var session_id = $('#sessionID').html();
-    ajaxHandler('pollplugins', {'session_id':session_id}, false );
+    if (pluginEvents == null){
+        var session_id = $('#sessionID').html();
+        ajaxHandler('pollplugins', {'session_id':session_id}, false );
+    }
     }
 
 
@@ -262,6 +296,24 @@ function ajaxHandler(command, postFields, spinner) {
             }else if (command == "dropplugin"){
                 notifications('warning', true, postOptions['plugin_id'], 'Plugin Deleted');
 
+            // Cancel Plugin
+            }else if (command == "cancelplugin"){
+                if (data.substring(0,5) == 'Error'){
+                    notifications('error', true, postOptions['plugin_id'], data);
+                } else {
+                    notifications('warning', true, postOptions['plugin_id'], 'Plugin Cancelled');
+                }
+
+            // Baselines
+            }else if (command == "registerbaseline" || command == "setbaseline"){
+                if (data.substring(0,5) == 'Error'){
+                    notifications('error', true, '', data);
+                } else if (command == "registerbaseline"){
+                    notifications('warning', true, '', 'Building baseline');
+                } else {
+                    notifications('warning', true, '', 'Baseline updated, rerun plugins to diff');
+                }
+
             // Run Plugin
             } else if (command == 'runplugin') {
                 if (data.substring(0,5) == 'Error'){
@@ -0,0 +1,25 @@
+from web.baseline import split_keys
+
+
+def test_empty_lists_give_one_part():
+    assert split_keys({}) == [{}]
+
+
+def test_small_lists_stay_together():
+    assert split_keys({'1': ['a', 'b'], 'rows': ['c']}, limit=5) == [{'1': ['a', 'b'], 'rows': ['c']}]
+
+
+def test_parts_hold_at_most_limit_keys():
+    key_lists = {'1': range(5), '3': range(4), 'rows': range(7)}
+    parts = split_keys(key_lists, limit=4)
+    assert all(sum(len(keys) for keys in part.values()) <= 4 for part in parts)
+    assert len(parts) == 4
+
+
+def test_every_key_is_kept_in_order():
+    key_lists = {'1': range(5), 'rows': range(7)}
+    merged = {}
+    for part in split_keys(key_lists, limit=3):
+        for name, keys in part.items():
+            merged.setdefault(name, []).extend(keys)
+    assert merged == key_lists
@@ -0,0 +1,82 @@
+import io
+import os
+import zlib
+
+import pytest
+
+from web.compression import Compressor, Decompressor, DecompressedFile, read_chunks, ZSTD
+
+
+class GridOut(io.BytesIO):
+    """
+    Compressed GridOut as DecompressedFile sees it
+    """
+    def __init__(self, data, codec='zlib', chunk_size=1024):
+        compressor = Compressor(codec)
+        compressed = ''.join(compressor.compress(chunk) for chunk in read_chunks(data)) + compressor.flush()
+        io.BytesIO.__init__(self, compressed)
+        self.compression = codec
+        self.chunk_size = chunk_size
+        self.original_length = len(data)
+
+
+def sample_data():
+    return os.urandom(100000) + 'volutility' * 50000
+
+
+def test_read_chunks_string():
+    assert list(read_chunks('abcdefg', chunk_size=3)) == ['abc', 'def', 'g']
+
+
+def test_read_chunks_file():
+    assert list(read_chunks(io.BytesIO('abcdefg'), chunk_size=3)) == ['abc', 'def', 'g']
+
+
+def test_zlib_round_trip():
+    data = sample_data()
+    stored = DecompressedFile(GridOut(data))
+    assert stored.read(7) + stored.read(100000) + stored.read() == data
+    assert stored.read() == ''
+    assert stored.tell() == len(data)
+    assert stored.length == len(data)
+
+
+def test_iterates_whole_file():
+    data = sample_data()
+    assert ''.join(DecompressedFile(GridOut(data))) == data
+
+
+def test_decompressor_output_is_bounded():
+    # 16 MB of zeros compresses to a few KB, one read must not expand all of it
+    source = GridOut('\0' * 16 * 1024 ** 2, chunk_size=255 * 1024)
+    decompressor = Decompressor('zlib', source, source.chunk_size)
+    total = 0
+    while True:
+        data = decompressor.read(4096)
+        if not data:
+            break
+        assert len(data) <= 4096
+        total += len(data)
+    assert total == 16 * 1024 ** 2
+
+
+def test_seek_forward_and_back():
+    data = sample_data()
+    stored = DecompressedFile(GridOut(data))
+    stored.seek(500000)
+    assert stored.read(10) == data[500000:500010]
+    stored.seek(10)
+    assert stored.read(5) == data[10:15]
+    assert stored.tell() == 15
+
+
+def test_unknown_codec():
+    with pytest.raises(IOError):
+        Decompressor('lzma', io.BytesIO(''))
+
+
+@pytest.mark.skipif(not ZSTD, reason='zstandard is not installed')
+def test_zstd_round_trip():
+    data = sample_data()
+    stored = DecompressedFile(GridOut(data, codec='zstd'))
+    assert stored.read(7) + stored.read() == data
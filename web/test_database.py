@@ -0,0 +1,50 @@
+from web.database import Database
+
+
+class FilesMeta(object):
+    """
+    Just enough of the GridFS files collection for ref counting
+    """
+    def __init__(self, ref_counts):
+        self.ref_counts = ref_counts
+
+    def find_one_and_update(self, query, update, projection=None, return_document=None):
+        blob_id = query['_id']
+        if blob_id not in self.ref_counts:
+            return None
+        self.ref_counts[blob_id] += update['$inc']['ref_count']
+        return {'_id': blob_id, 'ref_count': self.ref_counts[blob_id]}
+
+
+class Files(object):
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, file_id):
+        self.deleted.append(file_id)
+
+
+class BlobDatabase(Database):
+    def __init__(self, ref_counts):
+        self.vol_files_meta = FilesMeta(ref_counts)
+        self.vol_files = Files()
+
+
+def test_release_keeps_shared_blob():
+    db = BlobDatabase({'blob': 2})
+    db.release_blob('blob')
+    assert db.vol_files_meta.ref_counts['blob'] == 1
+    assert db.vol_files.deleted == []
+
+
+def test_release_deletes_with_last_reference():
+    db = BlobDatabase({'blob': 2})
+    db.release_blob('blob')
+    db.release_blob('blob')
+    assert db.vol_files.deleted == ['blob']
+
+
+def test_release_missing_blob():
+    db = BlobDatabase({})
+    db.release_blob('blob')
+    assert db.vol_files.deleted == []
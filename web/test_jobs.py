@@ -0,0 +1,40 @@
+import os
+from datetime import datetime, timedelta
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'volgui.settings')
+
+from web.jobs import JobQueue
+
+
+def running_job(**values):
+    job = {'_id': 1, 'status': 'running', 'started': datetime.now(), 'cancel': False}
+    job.update(values)
+    return job
+
+
+def test_no_limits():
+    assert JobQueue(None, None).limit_reason(running_job(), None) is None
+
+
+def test_cancelled():
+    assert JobQueue(None, None).limit_reason(running_job(cancel=True), None) == 'Plugin run cancelled'
+
+
+def test_timeout():
+    queue = JobQueue(None, None, timeout=60)
+    assert queue.limit_reason(running_job(), None) is None
+    job = running_job(started=datetime.now() - timedelta(seconds=61))
+    assert 'timeout' in queue.limit_reason(job, None)
+
+
+def test_harvested_bytes_count_toward_dump_limit():
+    queue = JobQueue(None, None, max_dump_size=1024)
+    assert queue.limit_reason(running_job(stored_bytes=1024), None) is None
+    assert 'dump directory' in queue.limit_reason(running_job(stored_bytes=1025), None)
+
+
+def test_dump_dir_and_stored_bytes_add_up(tmpdir):
+    tmpdir.join('dumped.dmp').write('x' * 600)
+    queue = JobQueue(None, None, max_dump_size=1024)
+    assert queue.limit_reason(running_job(dump_dir=str(tmpdir)), None) is None
+    assert 'dump directory' in queue.limit_reason(running_job(dump_dir=str(tmpdir), stored_bytes=600), None)
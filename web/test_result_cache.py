@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+
+from web.result_cache import ResultCache, copy_started, copy_timeout, image_hash
+
+session = {'file_hash': 'D41D8CD98F00B204E9800998ECF8427E', 'session_profile': 'Win7SP1x64'}
+
+
+def test_image_hash():
+    assert image_hash(session) == 'd41d8cd98f00b204e9800998ecf8427e'
+    assert image_hash({'file_hash': 'Hashing 5%'}) is None
+    assert image_hash({}) is None
+
+
+def test_no_key_without_hash_or_when_disabled():
+    assert ResultCache(None).key({'session_profile': 'Win7SP1x64'}, 'pslist') is None
+    assert ResultCache(None, enabled=False).key(session, 'pslist') is None
+
+
+def test_key_ignores_option_order_and_types():
+    cache = ResultCache(None)
+    first = cache.key(session, 'dlldump', pid=4, plugin_options={'base': '0x10', 'regex': 'a'})
+    second = cache.key(session, 'dlldump', pid='4', plugin_options={'REGEX': 'a', 'BASE': '0x10'})
+    assert first == second
+
+
+def test_key_changes_with_the_run():
+    cache = ResultCache(None)
+    key = cache.key(session, 'pslist')
+    assert key != cache.key(session, 'psscan')
+    assert key != cache.key(session, 'pslist', pid=4)
+    assert key != cache.key(dict(session, session_profile='WinXPSP2x86'), 'pslist')
+    assert key != cache.key(dict(session, file_hash='0' * 32), 'pslist')
+
+
+def test_abandoned_copies():
+    cache = ResultCache(None)
+    started = datetime.now() - timedelta(seconds=copy_timeout + 1)
+    assert not cache.abandoned({'_id': 1, 'copying': None})
+    assert not cache.abandoned({'_id': 1, 'copying': datetime.now()})
+    assert cache.abandoned({'_id': 1, 'copying': started})
+    # Entries from before the copy was timestamped
+    assert copy_started({'ready': False, 'created': started}) == started
+    assert copy_started({'ready': True, 'created': started}) is None
@@ -0,0 +1,50 @@
+from web import session_diff
+from web.baseline import value_key, row_fingerprint
+
+
+def keyed(rows, key_position=0):
+    """
+    keyed_rows output for plain value lists
+    """
+    result = [(value_key([row[key_position]]), row_fingerprint(row), row) for row in rows]
+    result.sort(key=lambda row: (row[0], row[1]))
+    return result
+
+
+def test_identical_outputs():
+    rows = [['a', 1], ['b', 2]]
+    result = session_diff.merge_rows(keyed(rows), keyed(rows))
+    assert (result['added'], result['removed'], result['changed']) == (0, 0, 0)
+
+
+def test_added_and_removed_keys():
+    result = session_diff.merge_rows(keyed([['a', 1], ['b', 2]]), keyed([['b', 2], ['c', 3]]))
+    assert result['removed'] == 1
+    assert result['added'] == 1
+    assert result['rows']['removed'] == [['a', 1]]
+    assert result['rows']['added'] == [['c', 3]]
+
+
+def test_changed_key():
+    result = session_diff.merge_rows(keyed([['a', 1]]), keyed([['a', 2]]))
+    assert result['changed'] == 1
+    assert result['rows']['changed'] == [{'before': [['a', 1]], 'after': [['a', 2]]}]
+
+
+def test_duplicate_row_lost():
+    # Rows are compared as a multiset, one of two identical rows going away is a removal
+    result = session_diff.merge_rows(keyed([['b', 1], ['b', 1]]), keyed([['b', 1]]))
+    assert (result['added'], result['removed'], result['changed']) == (0, 1, 0)
+    assert result['rows']['removed'] == [['b', 1]]
+
+
+def test_duplicate_row_gained():
+    result = session_diff.merge_rows(keyed([['b', 1]]), keyed([['b', 1], ['b', 1]]))
+    assert (result['added'], result['removed'], result['changed']) == (1, 0, 0)
+
+
+def test_kept_rows_are_capped(monkeypatch):
+    monkeypatch.setattr(session_diff, 'max_diff_rows', 2)
+    result = session_diff.merge_rows(keyed([]), keyed([[name, 0] for name in 'abcde']))
+    assert result['added'] == 5
+    assert len(result['rows']['added']) == 2
@@ -4,14 +4,17 @@ import json
 from datetime import datetime
 from web.common import *
 import multiprocessing
+import time
+import threading
 import tempfile
-from common import parse_config, checksum_md5
+from common import parse_config, multi_hash
 from web.modules import __extensions__
 
 config = parse_config()
 logger = logging.getLogger(__name__)
 
 from django.shortcuts import render, redirect
+from django.template.loader import render_to_string
 from django.http import HttpResponse, JsonResponse, HttpResponseServerError, StreamingHttpResponse
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.views.decorators.csrf import csrf_exempt
@@ -29,34 +32,12 @@ use_gi = False
 gi_path = ''
 
 
-PLUGINS_DIFF_PARAM_1 = [
-['mutantscan',7],
-['ssdt',7],
-['callbacks',3],
-['moddump',2],
-['driverirp',8],
-['atoms',8],
-['pslist',3],
-['cmdline',3],
-['dlllist',5],
-['mac_psaux',1],
-['linux_psaux',1],
-['mac_list_files', 2],
-['mac_pid_hash_table',3],
-['mac_pgrp_hash_table',3],
-['mac_pstree',3],
-['mac_psxview',3],
-['mac_mount',1],
-['linux_psxview',3],
-['mac_psenv',1],
-['mac_pslist',3],
-['linux_pslist',3],
-['mac_tasks',3],
-['mac_lsof',1],
-['linux_lsof',3],
-['linux_proc_maps',2],
-['linux_elfs',2],
-]
+# Address options queued as hex strings, kernel addresses do not fit in a BSON int64
+address_options = ['INODE', 'base']
+
+# Plugins whose output is built from the files they write to a dump dir
+dump_plugins = ['dumpfiles', 'mac_dump_files', 'memdump', 'procdump', 'dlldump', 'vaddump', 'dumpregistry',
+                'dumpcerts', 'linux_find_file']
 
 
 ##
@@ -64,63 +45,113 @@ PLUGINS_DIFF_PARAM_1 = [
 ##
 import vol_interface
 from vol_interface import RunVol
+from vol_pool import vol_pool
+from jobs import JobQueue, job_config, record_dump_dir, report_progress, PRIORITY_AUTORUN
+from harvester import DumpHarvester
+from result_cache import ResultCache, cache_config
+from baseline import BaselineIndex, diff_columns, row_fingerprint
+from session_diff import request_diff, run_diff, diff_result
 
 try:
-    from web.database import Database
+    from web.database import Database, PluginOutputWriter, SessionPages
     db = Database()
 except Exception as e:
     logger.error("Unable to access mongo database: {0}".format(e))
 
 
-def session_creation(request, mem_image, session_id):
-    if 'auth' in config:
-        if config['auth']['enable'].lower() == 'true' and not request.user.is_authenticated:
-            return HttpResponse('Auth Required.')
-     # Get some vars
-    global gi_path
+def session_interface(session):
+    """
+    return a volatility interface for a session using any stored KDBG / DTB
+    :param session:
+    :return: RunVol like object
+    """
+    return vol_pool.get_interface(session['session_profile'],
+                                  session['session_path'],
+                                  image_conf=vol_interface.load_image_conf(session))
+
+
+def hash_image(session_id, mem_path):
+    """
+    MD5, SHA1 and SHA256 an image in one pass, recording progress on the session
+    :param session_id:
+    :param mem_path:
+    :return:
+    """
+    stat = os.stat(mem_path)
+    hashes = db.get_image_hashes(mem_path, stat.st_size, stat.st_mtime)
+    if not hashes:
+        last_percent = [0]
+
+        def progress(bytes_read, total_size):
+            percent = bytes_read * 100 / max(total_size, 1)
+            if percent >= last_percent[0] + 5:
+                last_percent[0] = percent
+                db.update_session(session_id, {'hash_status': 'Hashing {0}%'.format(percent)})
+
+        try:
+            hashes = multi_hash(mem_path, progress=progress)
+        except Exception as error:
+            logger.error('Unable to hash {0}: {1}'.format(mem_path, error))
+            db.update_session(session_id, {'hash_status': 'Hashing failed'})
+            return
+        db.store_image_hashes(mem_path, stat.st_size, stat.st_mtime, hashes)
+
+    db.update_session(session_id, {'file_hash': hashes['md5'],
+                                   'file_sha1': hashes['sha1'],
+                                   'file_sha256': hashes['sha256'],
+                                   'hash_status': None})
+
+
+def session_creation(session_options, mem_image, session_id):
+    """
+    Hash the image, find its profile and create the plugin entries for a new session
+    :param session_options: the create session form values
+    :param mem_image:
+    :param session_id:
+    :return:
+    """
+    # Get some vars
     new_session = db.get_session(session_id)
+    new_session['status'] = 'Processing'
+    db.update_session(session_id, {'status': 'Processing'})
     file_hash = False
-
-    if 'description' in request.POST:
-        new_session['session_description'] = request.POST['description']
-    if 'plugin_path' in request.POST:
-        new_session['plugin_path'] = request.POST['plugin_path']
-    if 'sess_path' in request.POST:
-        new_session['session_path'] = request.POST['sess_path']
-        gi_path = os.path.dirname(os.path.abspath(request.POST['sess_path'])) + '\\GoldenImage\\'
-    if 'file_hash' in request.POST:
+    hash_thread = None
+
+    if 'description' in session_options:
+        new_session['session_description'] = session_options['description']
+    if 'plugin_path' in session_options:
+        new_session['plugin_path'] = session_options['plugin_path']
+    if 'sess_path' in session_options:
+        new_session['session_path'] = session_options['sess_path']
+    if 'file_hash' in session_options:
         file_hash = True
-    if 'sess_os' in request.POST:
-        sess_os = request.POST['sess_os']
-    if 'use_gi' in request.POST:
-        logger.debug('Using GoldenImage for Image')
-        new_session['use_gi'] = 'True'
-        new_session['gi_path'] = gi_path
-        use_gi = True
-    else:
-        new_session['use_gi'] = 'False' 
-        new_session['gi_path'] = ''      
+    if 'sess_os' in session_options:
+        sess_os = session_options['sess_os']
+    new_session.update(baseline_values(session_options.get('baseline_id')))
 
     # Check for mem file
-    print "gi_path: %s" %(gi_path)
     if not os.path.exists(mem_image):
         logger.error('Unable to find an image file at {0}'.format(mem_image))
-        new_session['status'] = 'Unable to find an image file at {0}'.format(request.POST['sess_path'])
+        new_session['status'] = 'Unable to find an image file at {0}'.format(session_options['sess_path'])
+        db.update_session(session_id, new_session)
         return
     new_session['session_path'] = mem_image
-    # Generate FileHash (MD5 for now)
+    # Generate FileHash in the background while the profile is detected
     if file_hash:
-        logger.debug('Generating MD5 for Image')
-        # Update the status
-        new_session['status'] = 'Calculating MD5'
+        logger.debug('Generating Hashes for Image')
+        # The hash thread owns these fields from now on
+        new_session.pop('file_hash', None)
+        new_session['hash_status'] = 'Hashing 0%'
         db.update_session(session_id, new_session)
-        md5_hash = checksum_md5(new_session['session_path'])
-        new_session['file_hash'] = md5_hash
+        new_session.pop('hash_status')
+        hash_thread = threading.Thread(target=hash_image, args=(session_id, new_session['session_path']))
+        hash_thread.daemon = True
+        hash_thread.start()
 
     # Get a list of plugins we can use. and prepopulate the list.
-    if 'profile' in request.POST:
-        if request.POST['profile'] != 'AutoDetect':
-            profile = request.POST['profile']
+    if 'profile' in session_options:
+        if session_options['profile'] != 'AutoDetect':
+            profile = session_options['profile']
             new_session['session_profile'] = profile
         else:
             profile = None
@@ -129,6 +160,7 @@ def session_creation(request, mem_image, session_id):
 
     vol_int = RunVol(profile, new_session['session_path'])
     image_info = {}
+    image_conf = {}
     if not profile:
         logger.debug('AutoDetecting Profile')
         # kdbg scan to get a profile suggestion
@@ -143,9 +175,12 @@ def session_creation(request, mem_image, session_id):
             lines = kdbg_results['rows'][0][0]
             print "kdbglines: "
             print lines
-            for line in lines.split('\n'):
-                if 'Profile suggestion' in line:
-                    profiles.append(line.split(':')[1].strip())
+            # Keep the KDBG and KPCR kdbgscan found so later runs skip the scan
+            kdbg_blocks = vol_interface.parse_kdbgscan(lines)
+            for block in kdbg_blocks:
+                profiles.append(block['profile'])
+            if kdbg_blocks:
+                image_conf = kdbg_blocks[0]
 
         elif 'OSX' in sess_os:
             kdbg_results = vol_int.run_plugin('mac_get_profile', False, '', output_style='text')
@@ -177,12 +212,20 @@ def session_creation(request, mem_image, session_id):
 
         if len(profiles) == 0:
             logger.error('Unable to find a valid profile with kdbg scan')
-            return main_page(request, error_line='Unable to find a valid profile with kdbg scan')
+            db.update_session(session_id, {'status': 'Unable to find a valid profile with kdbg scan'})
+            return
         profile = profiles[0]
-        # Re initialize with correct profile
-        vol_int = RunVol(profile, new_session['session_path'])
+
+    # Re initialize with correct profile
+    image_conf.pop('profile', None)
+    vol_int = vol_pool.get_interface(profile, new_session['session_path'], image_conf=image_conf)
+    try:
+        image_conf.update(vol_int.warm_up())
+    except Exception as error:
+        logger.warning('Unable to locate KDBG / DTB for {0}: {1}'.format(new_session['session_path'], error))
+    new_session['image_conf'] = vol_interface.store_image_conf(new_session['session_path'], image_conf)
     # Get compatible plugins
-    plugin_list = vol_int.list_plugins()
+    plugin_list = vol_interface.cached_plugin_list(profile, new_session['session_path'])
     new_session['session_profile'] = profile
     new_session['image_info'] = image_info
     # Plugin Options
@@ -196,14 +239,15 @@ def session_creation(request, mem_image, session_id):
     else:
         auto_list = False
     # Merge Autorun from manual post with config
-    if 'auto_run' in request.POST:
-        run_list = request.POST['auto_run'].split(',')
+    if 'auto_run' in session_options:
+        run_list = session_options['auto_run'].split(',')
         if not auto_list:
             auto_list = run_list
         else:
             for run in run_list:
                 if run not in auto_list:
                     auto_list.append(run)
+    autorun_ids = []
     # For each plugin create the entry
     for plugin in plugin_list:
         plugin_name = plugin[0]
@@ -258,7 +302,66 @@ def session_creation(request, mem_image, session_id):
 
         if auto_list:
             if plugin_name in auto_list:
-                multiprocessing.Process(target=run_plugin, args=(session_id, plugin_id, use_gi, gi_path)).start()
+                autorun_ids.append(plugin_id)
+
+    # Hashing is part of the bounded ingest work, and autorun results are only cached once the hash is stored
+    if hash_thread:
+        hash_thread.join()
+
+    for plugin_id in autorun_ids:
+        job_queue.submit(session_id, plugin_id, priority=PRIORITY_AUTORUN)
+
+
+def session_creation_task(session_options, mem_image, session_id):
+    """
+    Pool entry point for session_creation, failures are recorded on the session
+    :param session_options:
+    :param mem_image:
+    :param session_id:
+    :return:
+    """
+    try:
+        session_creation(session_options, mem_image, session_id)
+    except Exception as error:
+        logger.error('Unable to create session for {0}: {1}'.format(mem_image, error))
+        db.update_session(session_id, {'status': 'Error: {0}'.format(error)})
+
+
+def session_diff_task(diff_id):
+    """
+    Pool entry point for a multi session diff, failures are recorded on the diff
+    :param diff_id:
+    :return:
+    """
+    run_diff(db, diff_id)
+
+
+def connect_db():
+    """
+    Open a database connection for a forked job child or pool process,
+    a MongoClient copied across a fork is not safe to use
+    :return: Database
+    """
+    global db
+    db = Database(migrate=False)
+    for shared in [baseline_index, result_cache, job_queue]:
+        shared.db = db
+    return db
+
+
+session_pool = None
+
+
+def get_session_pool():
+    """
+    Process pool used to ingest images, created on first use
+    :return: multiprocessing.Pool
+    """
+    global session_pool
+    if session_pool is None:
+        session_pool = multiprocessing.Pool(processes=int(job_config.get('session_workers', 4)),
+                                           initializer=connect_db)
+    return session_pool
 
 
 ##
@@ -323,10 +426,10 @@ def main_page(request, error_line=None):
     page_count = request.GET.get('count')
     if not page_count:
         page_count = 30
-    # Get All Sessions
-    session_list = db.get_allsessions()
+    # Sessions are fetched a page at a time
+    session_list = SessionPages(db)
     # Paginate
-    session_count = len(session_list)
+    session_count = session_list.count()
     first_session = int(page) * int(page_count) - int(page_count) + 1
     last_session = int(page) * int(page_count)
     paginator = Paginator(session_list, page_count)
@@ -345,12 +448,12 @@ def main_page(request, error_line=None):
                 plugin_dirs = line.split(' = ')[-1]
 
     # Profile_list for add session
-    RunVol('', '')
-    profile_list = vol_interface.profile_list()
+    profile_list = vol_interface.cached_profile_list()
 
     return render(request, 'index.html', {'session_list': sessions,
                                           'session_counts': [session_count, first_session, last_session],
                                           'profile_list': profile_list,
+                                          'baseline_list': db.get_baselines(),
                                           'plugin_dirs': plugin_dirs,
                                           'error_line': error_line,
                                           'reqauth': False
@@ -384,7 +487,7 @@ def session_page(request, session_id):
         extra_files.append({'filename': upload.filename, 'file_id': upload._id})
     plugin_list = []
     yara_list = os.listdir('yararules')
-    plugin_text = db.get_pluginbysession(session_id)
+    plugin_text = db.get_plugin_summaries(session_id)
     version_info = {'python': str(sys.version).split()[0],
                     'volatility': vol_interface.vol_version,
                     'volutility': volutility_version}
@@ -402,6 +505,7 @@ def session_page(request, session_id):
                                             'error_line': error_line,
                                             'version_info': version_info,
                                             'yara_list': yara_list,
+                                            'baseline_list': db.get_baselines(),
                                             'extra_files': extra_files})
 
 
@@ -433,12 +537,16 @@ def create_session(request):
                         dir_listing.append(os.path.join(root, name))
     else:
         dir_listing.append(request.POST['sess_path'])
+    # Autorun jobs queued by the pool are started from this process
+    job_queue.start()
+    session_options = dict(request.POST.items())
+    pool = get_session_pool()
     for mem_image in dir_listing:
-        # Create session in DB and set to pending
+        # Create session in DB and set to queued
         new_session = {'created': datetime.now(),
                        'modified': datetime.now(),
                        'file_hash': 'Not Selected',
-                       'status': 'Processing',
+                       'status': 'Queued',
                        'session_profile': request.POST['profile']
                        }
         if 'sess_name' in request.POST:
@@ -447,33 +555,40 @@ def create_session(request):
             new_session['session_name'] = mem_image.split('/')[-1]
         # Store it
         session_id = db.create_session(new_session)
-        # Run the multiprocessing
-        #PK p = multiprocessing.Process(target=session_creation, args=(request, mem_image, session_id)).start()
-        p = session_creation(request, mem_image, session_id)
+        # Ingest in the pool so the request returns straight away
+        pool.apply_async(session_creation_task, args=(session_options, mem_image, session_id))
         # Add search all on main page filter sessions that match.
     return redirect('/')
 
 def diff_plugin_single(gi_plugin_path, plugin_name, idx, new_param):
     """
-    return the results json from a plugin
+    return the diff of a single value against the golden image
     :param gi_plugin_path:
+    :param plugin_name:
+    :param idx: column number from PLUGINS_DIFF_PARAM_1
+    :param new_param:
     :return:
     """
     results = ''
-    output_gi = []
-    with open(gi_plugin_path + plugin_name) as data_file:    
-        output_GoldenImage = json.load(data_file)
-
-    new = True
-    for row in output_GoldenImage['rows']:
-        if ( new_param == row[idx-1]):
-            new = False
-                    
-    if new:            
+    if baseline_index.is_new(gi_plugin_path, plugin_name, idx, new_param):
         results = 'New Param %u'%(idx-1)
 
     return results
 
+
+def baseline_values(baseline_id):
+    """
+    Session values to diff against a baseline session, or to stop diffing when there is no baseline
+    :param baseline_id:
+    :return: dict
+    """
+    baseline = db.get_session(baseline_id) if baseline_id else None
+    if not baseline or baseline.get('baseline_status') != 'Ready':
+        return {'use_gi': 'False', 'gi_path': '', 'baseline_id': None, 'baseline_name': None}
+    logger.debug('Using baseline {0}'.format(baseline['session_name']))
+    return {'use_gi': 'True', 'gi_path': '', 'baseline_id': baseline['_id'], 'baseline_name': baseline['session_name']}
+
+
 def diff_plugin_empty(gi_plugin_path, plugin_name):
     """
     return the results json from a plugin
@@ -486,6 +601,193 @@ def diff_plugin_empty(gi_plugin_path, plugin_name):
 
 
 
+def json_unsupported(error):
+    """
+    check if a plugin error means it has no json output
+    :param error:
+    :return: bool
+    """
+    return 'unified output format has not been implemented' in str(error) or 'JSON output for trees' in str(error)
+
+
+def plugin_output_style(vol_int, plugin_name):
+    """
+    Pick the renderer for a plugin from the capability table, inspecting the plugin class the first time
+    :param vol_int:
+    :param plugin_name:
+    :return: 'json', 'text' or None if the plugin has no renderer we can store
+    """
+    capability = db.get_plugin_capability(plugin_name)
+    if not capability:
+        try:
+            capability = vol_int.plugin_capabilities(plugin_name)
+        except Exception as error:
+            logger.warning('Unable to inspect plugin {0}: {1}'.format(plugin_name, error))
+            capability = None
+        if not capability:
+            return 'json'
+        db.set_plugin_capability(plugin_name, capability)
+
+    if capability.get('json', True):
+        return 'json'
+    if capability.get('text', True):
+        return 'text'
+    return None
+
+
+def json_fallback(plugin_name):
+    """
+    Record that a plugin failed to render json so the next run goes straight to text
+    :param plugin_name:
+    :return:
+    """
+    logger.debug('Marking {0} as text only'.format(plugin_name))
+    db.set_plugin_capability(plugin_name, {'json': False})
+
+
+def result_columns(plugin_name, columns, session):
+    """
+    Add the VolUtility columns to a plugins output columns
+    :param plugin_name:
+    :param columns:
+    :param session:
+    :return: list
+    """
+    # Add Row ID Column
+    if columns[0] != '#':
+        columns.insert(0, '#')
+
+    # Add option to process hive keys
+    if plugin_name in ['hivelist', 'hivescan']:
+        columns.append('Extract Keys')
+
+    # Add option to process malfind
+    if plugin_name in ['malfind']:
+        columns.append('Extract Injected Code')
+
+    if (session['use_gi'] == 'True'):
+        if plugin_name not in ['dumpfiles', 'mac_dump_files', 'memdump', 'procdump', 'dlldump']:
+            columns.append('Diff')
+
+    return columns
+
+
+def result_row(plugin_name, plugin_id, row, counter, session):
+    """
+    Add the VolUtility values to a single output row
+    :param plugin_name:
+    :param plugin_id:
+    :param row:
+    :param counter: row number
+    :param session:
+    :return: list
+    """
+    # Add Row ID
+    if plugin_name == 'memdump':
+        if len(row) == 3:
+            row.insert(0, counter)
+    elif plugin_name in ['dumpfiles', 'mac_dump_files']:
+        if len(row) == 4:
+            row.insert(0, counter)
+    elif plugin_name in ['procdump', 'dlldump']:
+        if len(row) == 4:
+            row.insert(0, counter)
+    elif plugin_name in ['vaddump']:
+        if len(row) == 4:
+            row.insert(0, counter)
+    else:
+        row.insert(0, counter)
+
+    # Fingerprint the plugin values before any VolUtility columns are added
+    fingerprint = None
+    if session.get('baseline_id'):
+        fingerprint = row_fingerprint(row[1:])
+
+    if plugin_name in ['hivelist', 'hivescan']:
+        row.append('Use the "dumpregistry" plugin to view hive keys')
+
+    # Add option to process malfind
+    if plugin_name in ['malfind']:
+        ajax_string = "onclick=\"ajaxHandler('malfind_export', {'plugin_id':'" + str(plugin_id) + \
+                      "', 'rowid':'" + str(counter) + "'}, true )\"; return false"
+        row.append('<a class="text-success" href="#" ' + ajax_string + '>Extract Injected</a>')
+
+    if session.get('baseline_id'):
+        row.append(baseline_index.diff_row(session['baseline_id'], plugin_name, row, fingerprint))
+    elif (session['use_gi'] == 'True'):
+        gi_columns = diff_columns(plugin_name)
+        for c_idx in gi_columns:
+            row.append(diff_plugin_single(session['gi_path'], plugin_name, c_idx, row[c_idx]))
+        if not gi_columns:
+            row.append(diff_plugin_empty(session['gi_path'], plugin_name))
+
+    return row
+
+
+def stream_output(vol_int, session, plugin_id, plugin_name, pid=None, plugin_options=None):
+    """
+    Run a json plugin and write its rows to storage in batches while it runs
+    :param vol_int:
+    :param session:
+    :param plugin_id:
+    :param plugin_name:
+    :param pid:
+    :param plugin_options:
+    :return: dict of values for update_plugin
+    """
+    writer = PluginOutputWriter(db, session['_id'], plugin_id)
+    counter = [1]
+
+    def emit(event, data):
+        report_progress(event, data)
+        if event == 'columns':
+            writer.set_columns(result_columns(plugin_name, data, session))
+        elif event == 'rows':
+            for row in data:
+                result_row(plugin_name, plugin_id, row, counter[0], session)
+                counter[0] += 1
+            writer.add_rows(data)
+
+    try:
+        vol_int.stream_plugin(plugin_name, emit=emit, pid=pid, plugin_options=plugin_options)
+    except Exception:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def imageinfo_values(results):
+    """
+    Split the imageinfo text output into a dict for the session page
+    :param results:
+    :return: dict
+    """
+    imageinfo_text = results['rows'][0][1]
+    image_info = {}
+    for line in imageinfo_text.split('\n'):
+        try:
+            key, value = line.split(' : ')
+            image_info[key.strip()] = value.strip()
+        except Exception as error:
+            logger.warning('Error Getting imageinfo: {0}'.format(error))
+    return image_info
+
+
+def cacheable(plugin_name, session):
+    """
+    check if a plugin result can be shared with other sessions of the same image
+    :param plugin_name:
+    :param session:
+    :return: bool
+    """
+    # Stored files and golden image diffs belong to the session, malfind rows link to the plugin id
+    if plugin_name in dump_plugins or plugin_name in ['malfind']:
+        return False
+    if session['use_gi'] == 'True':
+        return False
+    return True
+
+
 def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
     """
     return the results json from a plugin
@@ -495,6 +797,45 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
     :param plugin_options:
     :return:
     """
+    harvesters = []
+    result = None
+    try:
+        result = execute_plugin(session_id, plugin_id, harvesters, pid=pid, plugin_options=plugin_options)
+        return result
+    finally:
+        # A run that raised or failed keeps none of the files it stored
+        if result is None or str(result).startswith('Error'):
+            for harvester in harvesters:
+                harvester.discard()
+
+
+def execute_plugin(session_id, plugin_id, harvesters, pid=None, plugin_options=None):
+    """
+    Run a plugin and store its output, the body of run_plugin
+    :param session_id:
+    :param plugin_id:
+    :param harvesters: list the DumpHarvester of every dump dir is added to
+    :param pid:
+    :param plugin_options:
+    :return: plugin name or an Error string
+    """
+    if plugin_options:
+        plugin_options = dict((option, int(value, 0) if option in address_options and isinstance(value, basestring)
+                               else value) for option, value in plugin_options.items())
+
+    def start_harvest(plugin_name):
+        """
+        Create a temp dump dir and store files from it while the plugin is running
+        :param plugin_name:
+        :return: dump_dir
+        """
+        logger.debug('{0} - Creating Temp Directory'.format(plugin_name))
+        dump_dir = tempfile.mkdtemp()
+        record_dump_dir(dump_dir)
+        harvesters.append(DumpHarvester(db, session_id, dump_dir,
+                                        workers=int(job_config.get('harvest_workers', 4)),
+                                        emit=report_progress))
+        return dump_dir
 
     def try_run(plugin_name, dump_dir=None, use_gi=False, gi_path='', output_style=None, pid=None, plugin_options=None):
         global plugin_style
@@ -504,10 +845,8 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
         if plugin_name == "vaddump":
            print "vaddump !!!!!!!!!!!!!!!!!!!!!!!!!"
            # Create Temp Dir
-           logger.debug('{0} - Creating Temp Directory'.format(plugin_name))
-           temp_dir = tempfile.mkdtemp()
-           dump_dir = temp_dir
-           rlts = vol_int.run_plugin(plugin_name, dump_dir=dump_dir, use_gi = use_gi, gi_path = gi_path, output_style="text", pid=pid, plugin_options=plugin_options) 
+           dump_dir = start_harvest(plugin_name)
+           rlts = vol_int.run_plugin(plugin_name, dump_dir=dump_dir, use_gi = use_gi, gi_path = gi_path, output_style="text", pid=pid, plugin_options=plugin_options, emit=report_progress)
            print "TRy RUN vaddump !!!!!!!!!!!!!!!!"
            return [rlts , dump_dir]
 
@@ -521,22 +860,22 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
                                          gi_path=gi_path,
                                          pid=pid,
                                          plugin_options=plugin_options,
-                                         output_style=plugin_style
+                                         output_style=plugin_style,
+                                         emit=report_progress
                                          )
 
             return [results, dump_dir]
 
         except Exception as error:
             logger.error('{0}'.format(error))
-            if 'unified output format has not been implemented' in str(error) or 'JSON output for trees' in str(error):
+            if json_unsupported(error):
+                json_fallback(plugin_name)
                 plugin_style = 'text'
                 return try_run(plugin_name, dump_dir=dump_dir, output_style='text', pid=pid, plugin_options=plugin_options)
 
             elif '--dump-dir' in str(error) or 'specify a dump directory' in str(error):
                 # Create Temp Dir
-                logger.debug('{0} - Creating Temp Directory'.format(plugin_name))
-                temp_dir = tempfile.mkdtemp()
-                dump_dir = temp_dir
+                dump_dir = start_harvest(plugin_name)
                 return try_run(plugin_name, dump_dir=dump_dir, output_style=output_style, pid=pid, plugin_options=plugin_options)
 
             else:
@@ -556,26 +895,66 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
         plugin_name = plugin_row['plugin_name'].lower()
         logger.debug('Running Plugin: {0}'.format(plugin_name))
         gi_path = session['gi_path'];
+
+        # Another session of the same image may already have this result
+        cache_key = None
+        if cacheable(plugin_name, session):
+            cache_key = result_cache.key(session, plugin_name, pid=pid, plugin_options=plugin_options)
+        if cache_key and result_cache.fetch(cache_key, session_id, plugin_id):
+            new_sess = {'modifed': datetime.now()}
+            if plugin_name == 'imageinfo':
+                new_sess['image_info'] = imageinfo_values(db.get_pluginbyid(plugin_id)['plugin_output'])
+            db.update_session(session_id, new_sess)
+            return plugin_row['plugin_name']
+
         # Set plugin status
         new_values = {'status': 'processing'}
         db.update_plugin(plugin_id, new_values)
         # set vol interface
-        vol_int = RunVol(session['session_profile'], session['session_path'])
+        vol_int = session_interface(session)
         #print "session_gi_path: %s"%(session['gi_path'])
-        # Run the plugin with json as normal
-        output_style = 'json'
+        # Run the plugin with json unless it is known not to support it
+        output_style = plugin_output_style(vol_int, plugin_name)
+        if not output_style:
+            # Nothing to render with, skip calculate instead of scanning for output we cannot store
+            db.update_plugin(plugin_id, {'status': 'error'})
+            logger.error('Error: {0} has no json or text output'.format(plugin_name))
+            return 'Error: Unable to Store Output for {0} - no json or text output'.format(plugin_name)
+
+        # Plain json plugins are streamed to storage as they run
+        if output_style == 'json' and plugin_name not in vol_interface.fixed_output and plugin_name not in dump_plugins:
+            try:
+                new_values = stream_output(vol_int, session, plugin_id, plugin_name,
+                                           pid=pid, plugin_options=plugin_options)
+                new_values['created'] = datetime.now()
+                new_values['status'] = 'completed'
+                db.update_plugin(plugin_id, new_values)
+                db.update_session(session_id, {'modifed': datetime.now()})
+                if cache_key:
+                    result_cache.store(cache_key, session, plugin_id)
+                return plugin_row['plugin_name']
+            except Exception as error:
+                if json_unsupported(error):
+                    json_fallback(plugin_name)
+                    output_style = 'text'
+                elif not ('--dump-dir' in str(error) or 'specify a dump directory' in str(error)):
+                    db.update_plugin(plugin_id, {'status': 'error'})
+                    logger.error('Error: Unable to run plugin {0} - {1}'.format(plugin_name, error))
+                    return 'Error: Unable to Store Output for {0} - {1}'.format(plugin_name, error)
 
         plugin_return = try_run(plugin_name,
                                     dump_dir=dump_dir,
-                                    output_style='json',
+                                    output_style=output_style,
                                     pid=pid,
                                     plugin_options=plugin_options,
                                     )
 
         results = plugin_return[0]
         dump_dir = plugin_return[1]
-        
+
         if 'error' in results:
+            for harvester in harvesters:
+                harvester.discard()
             new_values = {'status': 'error'}
             db.update_plugin(plugin_id, new_values)
             logger.error('Error: Unable to run plugin {0} - {1}'.format(plugin_name, results['error']))
@@ -586,7 +965,32 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
         # Files that dump output to disk
         ##
         if dump_dir:
-            file_list = os.listdir(dump_dir)
+            # Anything still in the dump dir is stored now, the rest was stored while the plugin ran
+            stored_files = {}
+            try:
+                for harvester in harvesters:
+                    stored_files.update(harvester.finish())
+            except Exception as error:
+                for harvester in harvesters:
+                    harvester.discard()
+                db.update_plugin(plugin_id, {'status': 'error'})
+                logger.error('Error: Unable to store dumped files for {0} - {1}'.format(plugin_name, error))
+                return 'Error: Unable to Store Output for {0} - {1}'.format(plugin_name, error)
+            file_list = stored_files.keys()
+            used_files = set()
+
+            def take_file(filename):
+                """
+                The stored file for a row, rows naming the same file share it
+                :param filename:
+                :return: file_id or None if the file was not stored
+                """
+                file_id = stored_files.get(filename)
+                if file_id:
+                    used_files.add(filename)
+                else:
+                    logger.warning('{0} output names {1} which was not stored'.format(plugin_name, filename))
+                return file_id
             '''
             I need to process the results and the items in the dump dir.
 
@@ -614,13 +1018,7 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
                         img_type = 'SharedCacheMap'
                     else:
                         img_type = 'N/A'
-                    file_data = open(os.path.join(dump_dir, filename), 'rb').read()
-                    sha256 = hashlib.sha256(file_data).hexdigest()
-                    # ToDo:
-                    # MIME type
-                    # SSDEEP
-                    # Header Bytes
-                    file_id = db.create_file(file_data, session_id, sha256, filename)
+                    file_id = take_file(filename)
                     results['rows'].append([plugin_options['PHYSOFFSET'],
                                             filename,
                                             img_type,
@@ -651,9 +1049,7 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
                         dump_file = row[-1].split("OK: ")[-1]
 
                         if dump_file in file_list:
-                            file_data = open(os.path.join(dump_dir, dump_file), 'rb').read()
-                            sha256 = hashlib.sha256(file_data).hexdigest()
-                            file_id = db.create_file(file_data, session_id, sha256, dump_file)
+                            file_id = take_file(dump_file)
                             row_file = '<a class="text-success" href="#" ' \
                                        'onclick="ajaxHandler(\'filedetails\', {\'file_id\':\'' + str(file_id) + \
                                        '\'}, false ); return false">' \
@@ -698,10 +1094,8 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
                         #print file_list
 
                         #PK if dump_file in file_list:
-                        if 1:
-                            file_data = open(os.path.join(dump_dir, dump_file), 'rb').read()
-                            sha256 = hashlib.sha256(file_data).hexdigest()
-                            file_id = db.create_file(file_data, session_id, sha256, dump_file)
+                        file_id = take_file(dump_file)
+                        if file_id:
                             row_file = '<a class="text-success" href="#" ' \
                                        'onclick="ajaxHandler(\'filedetails\', {\'file_id\':\'' + str(file_id) + \
                                        '\'}, false ); return false">' \
@@ -737,9 +1131,7 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
                         new_results['rows'].append([process, pid, 'Not Stored'])
                     else:
                         logger.debug('Store memdump file')
-                        file_data = open(os.path.join(dump_dir, dump_file), 'rb').read()
-                        sha256 = hashlib.sha256(file_data).hexdigest()
-                        file_id = db.create_file(file_data, session_id, sha256, dump_file)
+                        file_id = take_file(dump_file)
                         row_file = '<a class="text-success" href="#" ' \
                                    'onclick="ajaxHandler(\'filedetails\', {\'file_id\':\'' + str(file_id) + \
                                    '\'}, false ); return false">' \
@@ -751,9 +1143,7 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
             if plugin_row['plugin_name'] == 'dumpregistry':
                 results = {'columns': ['Hive Name', 'StoredFile'], 'rows': []}
                 for filename in file_list:
-                    file_data = open(os.path.join(dump_dir, filename), 'rb').read()
-                    sha256 = hashlib.sha256(file_data).hexdigest()
-                    file_id = db.create_file(file_data, session_id, sha256, filename)
+                    file_id = take_file(filename)
                     results['rows'].append([filename,
                                             '<a class="text-success" href="#" '
                                             'onclick="ajaxHandler(\'filedetails\', {\'file_id\':\'' + str(file_id) +
@@ -765,9 +1155,7 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
                 for row in results['rows']:
                     filename = row[5]
                     if filename in file_list:
-                        file_data = open(os.path.join(dump_dir, filename), 'rb').read()
-                        sha256 = hashlib.sha256(file_data).hexdigest()
-                        file_id = db.create_file(file_data, session_id, sha256, filename)
+                        file_id = take_file(filename)
                         row[-1] = '<a class="text-success" href="#" ' \
                                   'onclick="ajaxHandler(\'filedetails\', {\'file_id\':\'' + \
                                   str(file_id) + '\'}, false ); return false">' \
@@ -788,9 +1176,7 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
                 else:
                     for dump_file in file_list:
                         logger.debug('Store memdump file')
-                        file_data = open(os.path.join(temp_dir, dump_file), 'rb').read()
-                        sha256 = hashlib.sha256(file_data).hexdigest()
-                        file_id = db.create_file(file_data, session_id, sha256, dump_file)
+                        file_id = db.ingest_file(os.path.join(temp_dir, dump_file), session_id, dump_file)
                         row_file = '<a class="text-success" href="#" ' \
                               'onclick="ajaxHandler(\'filedetails\', {\'file_id\':\'' + str(file_id) + '\'}, false ); return false">' \
                               'File Details</a>'
@@ -799,8 +1185,11 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
                 results = new_results
             '''
 
-            # Remove the dumpdir
-            shutil.rmtree(dump_dir)
+            # Files no row points at
+            for harvester in harvesters:
+                for filename in harvester.stored.keys():
+                    if filename not in used_files:
+                        harvester.drop(filename)
 
         ##
         # Extra processing output
@@ -809,84 +1198,16 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
 
 
         if results:
-            # Start Counting
-            counter = 1
-
-            # Columns
-
-            # Add Row ID Column
-            if results['columns'][0] != '#':
-                results['columns'].insert(0, '#')
-
-            # Add option to process hive keys
-            if plugin_row['plugin_name'] in ['hivelist', 'hivescan']:
-                results['columns'].append('Extract Keys')
-
-            # Add option to process malfind
-            if plugin_row['plugin_name'] in ['malfind']:
-                results['columns'].append('Extract Injected Code')
-
-            if (session['use_gi'] == 'True'):
-                if plugin_name not in ['dumpfiles', 'mac_dump_files', 'memdump', 'procdump', 'dlldump']:
-                    results['columns'].append('Diff')
-                
-
+            results['columns'] = result_columns(plugin_name, results['columns'], session)
             # Now Rows
-            for row in results['rows']:
-                # Add Row ID
-                if plugin_name == 'memdump':
-                    if len(row) == 3:
-                        row.insert(0, counter)
-                elif plugin_name in ['dumpfiles', 'mac_dump_files']:
-                    if len(row) == 4:
-                        row.insert(0, counter)
-                elif plugin_name in ['procdump', 'dlldump']:
-                    if len(row) == 4:
-                        row.insert(0, counter)
-                elif plugin_name in ['vaddump']:
-                    if len(row) == 4:
-                        row.insert(0, counter)
-                else:
-                    row.insert(0, counter)
-
-                #if (session['use_gi'] == 'True'):
-                #    row.append(diff_plugin_empty(session['gi_path'], ''))
-
-                if plugin_row['plugin_name'] in ['hivelist', 'hivescan']:
-                    row.append('Use the "dumpregistry" plugin to view hive keys')
-
-                # Add option to process malfind
-                if plugin_row['plugin_name'] in ['malfind']:
-                    ajax_string = "onclick=\"ajaxHandler('malfind_export', {'plugin_id':'" + str(plugin_id) + \
-                                  "', 'rowid':'" + str(counter) + "'}, true )\"; return false"
-                    row.append('<a class="text-success" href="#" ' + ajax_string + '>Extract Injected</a>')
-
-
-                if (session['use_gi'] == 'True'):
-                         bFound = False
-                         for c_plug, c_idx in PLUGINS_DIFF_PARAM_1: 
-                               if plugin_row['plugin_name'] == c_plug:
-                                    row.append(diff_plugin_single(session['gi_path'], plugin_row['plugin_name'], c_idx, row[c_idx]))
-                                    bFound = True
-                         if not bFound:
-                               row.append(diff_plugin_empty(session['gi_path'], plugin_row['plugin_name']))
-
-
-
-                counter += 1
+            for counter, row in enumerate(results['rows'], 1):
+                result_row(plugin_name, plugin_id, row, counter, session)
 
         # Image Info
 
         image_info = False
         if plugin_name == 'imageinfo':
-            imageinfo_text = results['rows'][0][1]
-            image_info = {}
-            for line in imageinfo_text.split('\n'):
-                try:
-                    key, value = line.split(' : ')
-                    image_info[key.strip()] = value.strip()
-                except Exception as error:
-                    print 'Error Getting imageinfo: {0}'.format(error)
+            image_info = imageinfo_values(results)
 
         # update the plugin
         new_values = {'created': datetime.now(), 'plugin_output': results, 'status': 'completed'}
@@ -899,6 +1220,9 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
                 new_sess['image_info'] = image_info
             db.update_session(session_id, new_sess)
 
+            if cache_key:
+                result_cache.store(cache_key, session, plugin_id)
+
             return plugin_row['plugin_name']
 
         except Exception as error:
@@ -909,6 +1233,21 @@ def run_plugin(session_id, plugin_id, pid=None, plugin_options=None):
             return 'Error: Unable to Store Output for {0} - {1}'.format(plugin_name, error)
 
 
+baseline_index = BaselineIndex(db)
+
+result_cache = ResultCache(db,
+                           max_size=int(cache_config.get('max_size_mb', 2048)) * 1024 ** 2,
+                           enabled=cache_config.get('enable', 'True') == 'True')
+
+job_queue = JobQueue(db, run_plugin,
+                     max_per_host=int(job_config.get('max_per_host', 4)),
+                     max_per_image=int(job_config.get('max_per_image', 2)),
+                     timeout=int(job_config.get('timeout', 0)),
+                     max_rss=int(job_config.get('max_rss_mb', 0)) * 1024 ** 2,
+                     max_dump_size=int(job_config.get('max_dump_mb', 0)) * 1024 ** 2,
+                     connect=connect_db)
+
+
 def file_download(request, query_type, object_id):
     """
     return a file from the gridfs by id
@@ -924,8 +1263,10 @@ def file_download(request, query_type, object_id):
     if query_type == 'file':
         file_object = db.get_filebyid(object_id)
         file_name = '{0}.bin'.format(file_object.filename)
+        # Compressed files are decompressed chunk by chunk as they stream out
         response = StreamingHttpResponse((chunk for chunk in file_object), content_type='application/octet-stream')
         response['Content-Disposition'] = 'attachment; filename="{0}"'.format(file_name)
+        response['Content-Length'] = file_object.length
         return response
 
     if query_type == 'plugin':
@@ -948,6 +1289,87 @@ def file_download(request, query_type, object_id):
         return response
 
 
+def plugin_event(row):
+    """
+    Server sent event for a plugin row, carrying the re-rendered table row
+    :param row:
+    :return: str
+    """
+    event = {'plugin_id': str(row['_id']),
+             'plugin_name': row['plugin_name'],
+             'status': row.get('status'),
+             'html': render_to_string('plugin_poll.html', {'plugin_output': [row]})}
+    return 'data: {0}\n\n'.format(json.dumps(event))
+
+
+def plugin_events(session_id, lifetime=300, interval=2.0, keepalive=15):
+    """
+    Generator of plugin status changes for a session.
+    Uses a change stream where MongoDB runs as a replica set and falls back to polling the status projection.
+    The browser reconnects when the stream ends after lifetime seconds.
+    :param session_id:
+    :param lifetime:
+    :param interval: seconds between polls without a change stream
+    :param keepalive: seconds between keepalive comments
+    :return:
+    """
+    # Rows as the page rendered them
+    known = dict((str(row['_id']), (row.get('status'), row.get('created'))) for row in db.get_plugin_summaries(session_id))
+
+    def changed(row):
+        state = (row.get('status'), row.get('created'))
+        if known.get(str(row['_id'])) == state:
+            return False
+        known[str(row['_id'])] = state
+        return True
+
+    stream = db.watch_plugins(session_id)
+    started = last_sent = time.time()
+    yield 'retry: 2000\n\n'
+    try:
+        while time.time() - started < lifetime:
+            if stream:
+                change = stream.try_next()
+                rows = [change['fullDocument']] if change and change.get('fullDocument') else []
+            else:
+                time.sleep(interval)
+                rows = db.get_plugin_summaries(session_id)
+
+            for row in rows:
+                if changed(row):
+                    last_sent = time.time()
+                    yield plugin_event(row)
+
+            if time.time() - last_sent > keepalive:
+                last_sent = time.time()
+                yield ': keepalive\n\n'
+    finally:
+        if stream:
+            stream.close()
+
+
+def plugin_progress(request, plugin_id):
+    """
+    return the progress of a plugin run as json
+    :param request:
+    :param plugin_id:
+    :return:
+    """
+    if 'auth' in config:
+        if config['auth']['enable'].lower() == 'true' and not request.user.is_authenticated:
+            return HttpResponse('Auth Required.')
+
+    progress = db.get_progress(plugin_id)
+    if not progress:
+        return JsonResponse({'status': None})
+    progress['plugin_id'] = plugin_id
+    progress['session_id'] = str(progress['session_id'])
+    for key in ['started', 'updated']:
+        if progress.get(key):
+            progress[key] = progress[key].isoformat()
+    return JsonResponse(progress)
+
+
 @csrf_exempt
 def addfiles(request):
     if 'auth' in config:
@@ -962,11 +1384,8 @@ def addfiles(request):
 
     for upload in request.FILES.getlist('files[]'):
         logger.debug('Storing File: {0}'.format(upload.name))
-        file_data = upload.read()
-        sha256 = hashlib.sha256(file_data).hexdigest()
-
-        # Store file in GridFS
-        db.create_file(file_data, session_id, sha256, upload.name, pid=None, file_meta='ExtraFile')
+        # Store file in GridFS a chunk at a time
+        db.ingest_file(upload, session_id, upload.name, pid=None, file_meta='ExtraFile')
 
     # Return the new list
     extra_search = db.search_files({'file_meta': 'ExtraFile', 'sess_id': session_id})
@@ -1011,19 +1430,16 @@ def ajax_handler(request, command):
             # Get Current Session
             session_id = request.POST['session_id']
             session = db.get_session(session_id)
-            plugin_rows = db.get_pluginbysession(session_id)
+            plugin_rows = db.get_plugin_summaries(session_id)
             # Check for new registered plugins
             # Get compatible plugins
             profile = session['session_profile']
             session_path = session['session_path']
-            vol_int = RunVol(profile, session_path)
-            plugin_list = vol_int.list_plugins()
+            plugin_list = vol_interface.cached_plugin_list(profile, session_path)
             # Plugin Options
             plugin_filters = vol_interface.plugin_filters
             refresh_rows = False
-            existing_plugins = []
-            for row in plugin_rows:
-                existing_plugins.append(row['plugin_name'])
+            existing_plugins = set(row['plugin_name'] for row in plugin_rows)
 
             # For each plugin create the entry
             for plugin in plugin_list:
@@ -1048,12 +1464,22 @@ def ajax_handler(request, command):
                     refresh_rows = True
 
             if refresh_rows:
-                plugin_rows = db.get_pluginbysession(session_id)
+                plugin_rows = db.get_plugin_summaries(session_id)
 
             return render(request, 'plugin_poll.html', {'plugin_output': plugin_rows})
         else:
             return HttpResponseServerError
 
+    if command == 'pluginevents':
+        if 'session_id' in request.GET:
+            response = StreamingHttpResponse(plugin_events(request.GET['session_id']),
+                                             content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+        else:
+            return HttpResponseServerError
+
     if command == 'filtersessions':
         matching_sessions = []
         if ('pluginname' and 'searchterm') in request.POST:
@@ -1066,6 +1492,44 @@ def ajax_handler(request, command):
 
         return JsonResponse(matching_sessions, safe=False)
 
+    if command == 'searchplugins':
+        if 'search_text' in request.POST:
+            start = int(request.POST.get('start', 0))
+            length = max(min(int(request.POST.get('length', 25)), 500), 1)
+            plugin_ids, total = db.search_plugin_ids(request.POST['search_text'],
+                                                     session_id=request.POST.get('session_id') or None,
+                                                     plugin_name=request.POST.get('plugin_name') or None,
+                                                     skip=start, limit=length)
+            results = []
+            for row in db.get_plugin_summaries_byid(plugin_ids):
+                results.append({'plugin_id': str(row['_id']),
+                                'session_id': str(row['session_id']),
+                                'plugin_name': row['plugin_name'],
+                                'row_count': row.get('row_count')})
+            return JsonResponse({'total': total, 'start': start, 'results': results})
+        else:
+            return HttpResponseServerError
+
+    if command == 'diffsessions':
+        if 'session_ids' in request.POST and 'plugin_name' in request.POST:
+            session_ids = [session_id.strip() for session_id in request.POST['session_ids'].split(',')
+                           if session_id.strip()]
+            key_columns = [column.strip() for column in request.POST.get('key_columns', '').split(',')
+                           if column.strip()] or None
+            if len(session_ids) < 2:
+                return JsonResponse({'error': 'Diff needs at least two sessions'})
+            try:
+                diff, new_diff = request_diff(db, request.POST['plugin_name'], session_ids, key_columns)
+            except Exception as error:
+                return JsonResponse({'error': str(error)})
+            # Repeat the request to pick up the result once the diff has run
+            if new_diff:
+                get_session_pool().apply_async(session_diff_task, args=(diff['_id'],))
+            return JsonResponse({'diff_id': str(diff['_id']), 'status': diff['status'],
+                                 'result': diff_result(db, diff)})
+        else:
+            return HttpResponseServerError
+
     if command == 'dropplugin':
         if 'plugin_id' in request.POST:
             plugin_id = request.POST['plugin_id']
@@ -1074,10 +1538,33 @@ def ajax_handler(request, command):
             db.update_plugin(plugin_id, new_values)
             return HttpResponse('OK')
 
+    if command == 'cancelplugin':
+        if 'plugin_id' in request.POST:
+            if job_queue.cancel(request.POST['plugin_id']):
+                return HttpResponse('OK')
+            return HttpResponse('Error: No running job for this plugin')
+
+    if command == 'registerbaseline':
+        if 'session_id' in request.POST:
+            # Fingerprinting every stored output can take a while
+            baseline_thread = threading.Thread(target=baseline_index.register, args=(request.POST['session_id'],),
+                                               name='volutility-baseline')
+            baseline_thread.daemon = True
+            baseline_thread.start()
+            return HttpResponse('OK')
+
+    if command == 'setbaseline':
+        if 'session_id' in request.POST:
+            new_values = baseline_values(request.POST.get('baseline_id'))
+            if request.POST.get('baseline_id') and not new_values['baseline_id']:
+                return HttpResponse('Error: Baseline is not ready')
+            db.update_session(request.POST['session_id'], new_values)
+            return HttpResponse('OK')
+
     if command == 'runplugin':
         print "gi_path: %s"%(gi_path)
         if 'plugin_id' in request.POST and 'session_id' in request.POST:
-            plugin_name = run_plugin(request.POST['session_id'], request.POST['plugin_id'])
+            plugin_name = job_queue.run(request.POST['session_id'], request.POST['plugin_id'])
             return HttpResponse(plugin_name)
 
     if command == 'plugin_dir':
@@ -1090,6 +1577,8 @@ def ajax_handler(request, command):
         # Set Plugins
         if 'plugin_dir' in request.POST:
             plugin_dir = request.POST['plugin_dir']
+            # New plugins and profiles are picked up on the next request
+            vol_interface.invalidate_catalogue()
 
             if os.path.exists(volrc_file):
                 with open(volrc_file, 'a') as out:
@@ -1153,7 +1642,7 @@ def ajax_handler(request, command):
 
         # Else Generate and store
         session = db.get_session(session_id)
-        vol_int = RunVol(session['session_profile'], session['session_path'])
+        vol_int = session_interface(session)
         results = vol_int.run_plugin('vadtree', output_style='dot', use_gi=False, gi_path='', pid=pid)
 
         # Configure the output for svg with D3 and digraph-d3
@@ -1208,7 +1697,7 @@ def ajax_handler(request, command):
 
         # Else Generate and store
         session = db.get_session(session_id)
-        vol_int = RunVol(session['session_profile'], session['session_path'])
+        vol_int = session_interface(session)
         results = vol_int.run_plugin('pstree', False, '', output_style='dot', )
 
         # Configure the output for svg with D3 and digraph-d3
@@ -1258,7 +1747,7 @@ def ajax_handler(request, command):
         logger.debug('Running Timeline')
         session_id = request.POST['session_id']
         session = db.get_session(session_id)
-        vol_int = RunVol(session['session_profile'], session['session_path'])
+        vol_int = session_interface(session)
         results = vol_int.run_plugin('timeliner', output_style='dot')
 
         # Configure the output for svg with D3 and digraph-d3
@@ -1351,7 +1840,7 @@ def ajax_handler(request, command):
 
         try:
             session = db.get_session(session_id)
-            vol_int = RunVol(session['session_profile'], session['session_path'])
+            vol_int = session_interface(session)
 
             if yara_string:
                 results = vol_int.run_plugin('yarascan', output_style='json', pid=yara_pid, use_gi=False, gi_path='',  plugin_options={
@@ -1419,7 +1908,7 @@ def ajax_handler(request, command):
             db.drop_file(file_id)
 
             # Update plugin
-            db.update_plugin(plugin_id, plugin_details)
+            db.update_plugin(plugin_id, {'plugin_output': plugin_details['plugin_output']})
 
             return HttpResponse('OK')
 
@@ -1492,7 +1981,7 @@ def ajax_handler(request, command):
 
                     logger.debug('Running Plugin: dumpfiles with regex {0}'.format(regex))
 
-                    res = run_plugin(session_id, plugin_row['_id'], plugin_options={'PHYSOFFSET': None,
+                    res = job_queue.run(session_id, plugin_row['_id'], plugin_options={'PHYSOFFSET': None,
                                                                                     'NAME': True,
                                                                                     'REGEX': regex,
                                                                                     'UNSAFE': True})
@@ -1500,14 +1989,20 @@ def ajax_handler(request, command):
 
             if search_type == 'plugin':
                 results = {'columns': ['Plugin Name', 'View Results'], 'rows': []}
-                rows = db.search_plugins(search_text, session_id=session_id)
-                for row in rows:
+                start = max(int(request.POST.get('start', 0)), 0)
+                length = max(min(int(request.POST.get('length', 100)), 500), 1)
+                plugin_ids, total = db.search_plugin_ids(search_text, session_id=session_id, skip=start, limit=length)
+                for row in db.get_plugin_summaries_byid(plugin_ids):
                     results['rows'].append([row['plugin_name'], '<a href="#" onclick="ajaxHandler(\'pluginresults\', \{{\'plugin_id\':\'{0}\'}}, false ); return false">View Output</a>'.format(row['_id'])])
+                if start or start + len(plugin_ids) < total:
+                    # Say when the list is only part of the matches
+                    results['rows'].append(['Showing {0} to {1} of {2} matching plugins'.format(
+                        start + 1, start + len(plugin_ids), total), 'Refine the search to narrow the list'])
                 return render(request, 'plugin_output.html', {'plugin_results': results,
                                                               'bookmarks': [],
                                                               'plugin_id': 'None',
                                                               'plugin_name': 'Search Results',
-                                                              'resultcount': len(results['rows'])})
+                                                              'resultcount': total})
 
             if search_type == 'hash':
                 pass
@@ -1516,7 +2011,7 @@ def ajax_handler(request, command):
                 logger.debug('Registry Search')
                 try:
                     session = db.get_session(session_id)
-                    vol_int = RunVol(session['session_profile'], session['session_path'])
+                    vol_int = session_interface(session)
                     results = vol_int.run_plugin('printkey', output_style='json', plugin_options={'KEY': search_text})
                     return render(request, 'plugin_output.html', {'plugin_results': results,
                                                                   'bookmarks': [],
@@ -1559,19 +2054,49 @@ def ajax_handler(request, command):
 
         if 'plugin_id' in request.POST:
             plugin_id = request.POST['plugin_id']
-            plugin_results = db.get_pluginbyid(plugin_id)
-            output = plugin_results['plugin_output']['rows']
-            resultcount = len(plugin_results['plugin_output']['rows'])
+            # Large outputs are paged from the rows collection instead of loaded
+            plugin_results = db.get_pluginbyid(plugin_id, load_rows=False)
+            rowstore = 'rowstore' in plugin_results
+            if rowstore:
+                resultcount = plugin_results['row_count']
+            else:
+                resultcount = len(plugin_results['plugin_output']['rows'])
 
             # Get Bookmarks
-            try:
-                bookmarks = db.get_pluginbyid(plugin_id)['bookmarks']
-            except:
-                bookmarks = []
+            bookmarks = plugin_results.get('bookmarks', [])
 
         else:
             return JsonResponse({'error': 'No Plugin ID'})
 
+        # If we are paging with datatables
+        if 'pagination' in request.POST:
+            # Searching
+            if 'search[value]' in request.POST:
+                search_term = request.POST['search[value]']
+            else:
+                search_term = None
+
+            # Column Sort
+            col_index = int(request.POST['order[0][column]'])
+            if request.POST['order[0][dir]'] == 'asc':
+                direction = False
+            else:
+                direction = True
+
+        if rowstore:
+            if 'pagination' in request.POST:
+                paged_data, filtered_count = db.get_plugin_rows(plugin_id,
+                                                                start=start,
+                                                                length=length,
+                                                                sort_column=col_index,
+                                                                reverse=direction,
+                                                                search_text=search_term)
+            else:
+                paged_data, filtered_count = db.get_plugin_rows(plugin_id, start=start, length=length)
+            plugin_results['plugin_output']['rows'] = paged_data
+
+        output = plugin_results['plugin_output']['rows']
+
         # Extensions Here
         final_javascript = ''
         for extension in __extensions__:
@@ -1587,37 +2112,29 @@ def ajax_handler(request, command):
 
         # If we are paging with datatables
         if 'pagination' in request.POST:
-            paged_data = []
-
-            # Searching
-            if 'search[value]' in request.POST:
-                search_term = request.POST['search[value]']
-                # output = [r for r in output if search_term.lower() in r]
-                output = filter(lambda x: search_term.lower() in str(x).lower(), output)
-            else:
-                output = []
+            if not rowstore:
+                if search_term:
+                    output = filter(lambda x: search_term.lower() in str(x).lower(), output)
 
-            # Column Sort
-            col_index = int(request.POST['order[0][column]'])
-            if request.POST['order[0][dir]'] == 'asc':
-                direction = False
+                # Test column data for correct sort
+                try:
+                    output = sorted(output, key=lambda x: int(x[col_index]), reverse=direction)
+                except:
+                    output = sorted(output, key=lambda x: str(x[col_index]).lower(), reverse=direction)
+
+                filtered_count = len(output)
+                # Get number of Rows, DataTables asks for -1 to show everything
+                if length < 0:
+                    paged_data = output[start:]
+                else:
+                    paged_data = output[start:start+length]
             else:
-                direction = True
-
-            # Test column data for correct sort
-            try:
-                output = sorted(output, key=lambda x: int(x[col_index]), reverse=direction)
-            except:
-                output = sorted(output, key=lambda x: str(x[col_index]).lower(), reverse=direction)
-
-            # Get number of Rows
-            for row in output[start:start+length]:
-                paged_data.append(row)
+                paged_data = output
 
             datatables = {
                 "draw": int(request.POST['draw']),
                 "recordsTotal": resultcount,
-                "recordsFiltered": len(output),
+                "recordsFiltered": filtered_count,
                 "data": paged_data
             }
 
@@ -1625,7 +2142,8 @@ def ajax_handler(request, command):
 
         # Else return standard 25 rows
         else:
-            plugin_results['plugin_output']['rows'] = plugin_results['plugin_output']['rows'][start:length]
+            if not rowstore:
+                plugin_results['plugin_output']['rows'] = plugin_results['plugin_output']['rows'][start:length]
             rendered_data = render(request, 'plugin_output.html', {'plugin_results': plugin_results['plugin_output'],
                                                           'plugin_id': plugin_id,
                                                           'bookmarks': bookmarks,
@@ -1646,7 +2164,7 @@ def ajax_handler(request, command):
             row_id = int(row_id)
             # Get Bookmarks for plugin
             try:
-                bookmarks = db.get_pluginbyid(plugin_id)['bookmarks']
+                bookmarks = db.get_pluginbyid(plugin_id, load_rows=False)['bookmarks']
             except:
                 bookmarks = []
             # Update bookmarks
@@ -1667,15 +2185,14 @@ def ajax_handler(request, command):
             plugin_id, row_id = request.POST['row_id'].split('_')
             session_id = request.POST['session_id']
             row_id = int(row_id)
-            plugin_data = db.get_pluginbyid(plugin_id)['plugin_output']
-            row = plugin_data['rows'][row_id - 1]
+            row = db.get_plugin_row(plugin_id, row_id - 1)
             pid = row[3]
 
             plugin_row = db.get_plugin_byname('memdump', session_id)
 
             logger.debug('Running Plugin: memdump with pid {0}'.format(pid))
 
-            res = run_plugin(session_id, plugin_row['_id'], pid=pid)
+            res = job_queue.run(session_id, plugin_row['_id'], pid=pid)
             return HttpResponse(res)
 
     if command == 'dlldump':
@@ -1683,8 +2200,7 @@ def ajax_handler(request, command):
             plugin_id, row_id = request.POST['row_id'].split('_')
             session_id = request.POST['session_id']
             row_id = int(row_id)
-            plugin_data = db.get_pluginbyid(plugin_id)['plugin_output']
-            row = plugin_data['rows'][row_id - 1]
+            row = db.get_plugin_row(plugin_id, row_id - 1)
             #pid = row[1]
             pid = request.POST['pid']
             #offset = row[2]
@@ -1694,7 +2210,7 @@ def ajax_handler(request, command):
 
             logger.debug('Running Plugin: dlldump with pid {0} and base {1}'.format(pid, offset))
 
-            res = run_plugin(session_id, plugin_row['_id'], pid=pid, plugin_options={'base': int(offset,0)})
+            res = job_queue.run(session_id, plugin_row['_id'], pid=pid, plugin_options={'base': offset})
             return HttpResponse(res)
 
     if command == 'vaddump':
@@ -1702,8 +2218,7 @@ def ajax_handler(request, command):
             plugin_id, row_id = request.POST['row_id'].split('_')
             session_id = request.POST['session_id']
             row_id = int(row_id)
-            plugin_data = db.get_pluginbyid(plugin_id)['plugin_output']
-            row = plugin_data['rows'][row_id - 1]
+            row = db.get_plugin_row(plugin_id, row_id - 1)
             #pid = row[1]
             pid = request.POST['pid']
             #offset = row[2]
@@ -1715,10 +2230,10 @@ def ajax_handler(request, command):
 
             if offset != 0:
                 print "Running plugin vaddump %u %s"%(int(pid), offset)
-                res = run_plugin(session_id, plugin_row['_id'], pid=int(pid), plugin_options={'base': int(offset,0)})
+                res = job_queue.run(session_id, plugin_row['_id'], pid=int(pid), plugin_options={'base': offset})
             else:
                 print "Running plugin vaddump %u"%(int(pid))
-                res = run_plugin(session_id, plugin_row['_id'], pid=int(pid))                 
+                res = job_queue.run(session_id, plugin_row['_id'], pid=int(pid))                 
             return HttpResponse(res)
 
 
@@ -1727,15 +2242,14 @@ def ajax_handler(request, command):
             plugin_id, row_id = request.POST['row_id'].split('_')
             session_id = request.POST['session_id']
             row_id = int(row_id)
-            plugin_data = db.get_pluginbyid(plugin_id)['plugin_output']
-            row = plugin_data['rows'][row_id - 1]
+            row = db.get_plugin_row(plugin_id, row_id - 1)
             pid = row[3]
 
             plugin_row = db.get_plugin_byname('procdump', session_id)
 
             logger.debug('Running Plugin: dlldump with pid {0}:'.format(pid))
 
-            res = run_plugin(session_id, plugin_row['_id'], pid=pid)
+            res = job_queue.run(session_id, plugin_row['_id'], pid=pid)
             return HttpResponse(res)
 
     if command == 'apihooks':
@@ -1743,15 +2257,14 @@ def ajax_handler(request, command):
             plugin_id, row_id = request.POST['row_id'].split('_')
             session_id = request.POST['session_id']
             row_id = int(row_id)
-            plugin_data = db.get_pluginbyid(plugin_id)['plugin_output']
-            row = plugin_data['rows'][row_id - 1]
+            row = db.get_plugin_row(plugin_id, row_id - 1)
             pid = row[3]
 
             plugin_row = db.get_plugin_byname('apihooks', session_id)
             print('Running Plugin: apihooks with pid {0}:'.format(pid))
             logger.debug('Running Plugin: apihooks with pid {0}:'.format(pid))
 
-            res = run_plugin(session_id, plugin_row['_id'], pid=pid)
+            res = job_queue.run(session_id, plugin_row['_id'], pid=pid)
             return HttpResponse(res)
 
 
@@ -1760,15 +2273,14 @@ def ajax_handler(request, command):
             plugin_id, row_id = request.POST['row_id'].split('_')
             session_id = request.POST['session_id']
             row_id = int(row_id)
-            plugin_data = db.get_pluginbyid(plugin_id)['plugin_output']
-            row = plugin_data['rows'][row_id - 1]
+            row = db.get_plugin_row(plugin_id, row_id - 1)
             offset = row[1]
 
             plugin_row = db.get_plugin_byname('dumpfiles', session_id)
 
             logger.debug('Running Plugin: dumpfiles with offset {0}'.format(offset))
 
-            res = run_plugin(session_id, plugin_row['_id'], plugin_options={'PHYSOFFSET': str(offset),
+            res = job_queue.run(session_id, plugin_row['_id'], plugin_options={'PHYSOFFSET': str(offset),
                                                                             'NAME': True,
                                                                             'REGEX': None,
                                                                             'UNSAFE': True})
@@ -1779,9 +2291,7 @@ def ajax_handler(request, command):
             plugin_id, row_id = request.POST['row_id'].split('_')
             session_id = request.POST['session_id']
             row_id = int(row_id)
-            plugin_data = db.get_pluginbyid(plugin_id)['plugin_output']
-
-            row = plugin_data['rows'][row_id - 1]
+            row = db.get_plugin_row(plugin_id, row_id - 1)
 
             print "Base Row: ", row
 
@@ -1808,16 +2318,14 @@ def ajax_handler(request, command):
 
             logger.debug('Running Plugin: linux_find_file with inode {0}'.format(inode))
 
-            res = run_plugin(session_id, results_plugin['_id'], plugin_options={'INODE': int(inode, 0), 'OUTFILE': outfile})
+            res = job_queue.run(session_id, results_plugin['_id'], plugin_options={'INODE': inode, 'OUTFILE': outfile},
+                                pin_host=True)
 
 
             print "Checking for file"
 
             if os.path.exists(outfile):
-                file_data = open(outfile, 'rb').read()
-                print "FileData: ", file_data[:5]
-                sha256 = hashlib.sha256(file_data).hexdigest()
-                file_id = db.create_file(file_data, session_id, sha256, filename)
+                file_id = db.ingest_file(outfile, session_id, filename)
                 row.append('<a class="text-success" href="#" '
                            'onclick="ajaxHandler(\'filedetails\', {\'file_id\':\'' + str(file_id) +
                            '\'}, false ); return false">'
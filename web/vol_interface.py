@@ -2,6 +2,9 @@ import logging
 import sys
 import os
 import copy
+import time
+import threading
+import weakref
 import StringIO
 import json
 
@@ -39,6 +42,7 @@ import volatility.addrspace as addrspace
 import volatility.constants as constants
 import volatility.debug as debug
 import volatility.utils as utils
+import volatility.plugins.addrspaces.standard as standard
 
 
 logger = logging.getLogger(__name__)
@@ -51,6 +55,29 @@ def new_error(msg):
     raise Exception(msg)
 debug.error = new_error
 
+
+##
+# Patch the volatility load_as to hand plugins the address space a warm worker already loaded
+##
+# Keyed by (location, profile), entries go away with the RunVol that loaded them
+warm_spaces = weakref.WeakValueDictionary()
+original_load_as = utils.load_as
+
+
+def load_as(config, astype='virtual', **kwargs):
+    """
+    utils.load_as that returns the warm address space for the image when there is one
+    :param config:
+    :param astype:
+    :return: address space
+    """
+    if astype == 'virtual' and not kwargs:
+        addr_space = warm_spaces.get((config.LOCATION, config.PROFILE))
+        if addr_space is not None and config.DTB in [None, getattr(addr_space, 'dtb', None)]:
+            return addr_space
+    return original_load_as(config, astype=astype, **kwargs)
+utils.load_as = load_as
+
 # Stop these plugins being listed as we can or will not handle them
 plugin_filters = {
     "drop": ['crashdump', 'crashinfo', 'hibinfo', 'imagecopy', 'raw2dmp', 'volshell', 'strings', 'bioskbd', 'patcher', 'chromecookies', 'poolpeek', 'impscan', 'hivedump', 'pstree', 'yarascan', 'kdbgscan', 'kpcrscan', 'threads', 'malfind', 'bigpools', 'joblinks', 'vboxinfo', 'vmwareinfo', 'hpakinfo', 'hpakextract', 'notepad', 'shellbags', 'servicediff', 'shutdowntime', 'qemuinfo', 'truecryptmaster', 'truecryptpassphrase', 'truecryptsummary', 'multiscan', 'machoinfo', 'timeliner', 'pooltracker', 'moddump', 'mac_volshell', 'mac_yarascan'],
@@ -67,6 +94,24 @@ plugin_filters = {
 
 vol_version = constants.VERSION
 
+# run_plugin always renders these in a fixed style so they can not be streamed
+fixed_output = ['pstree', 'imageinfo', 'kdbgscan', 'iehistory', 'vaddump', 'memdump', 'dumpfiles']
+
+
+def json_value(value):
+    """
+    Convert a unified output value the way json.loads(parse_int=str) would
+    :param value:
+    :return:
+    """
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, (int, long)):
+        return str(long(value))
+    if isinstance(value, (float, basestring)):
+        return value
+    return str(value)
+
 
 def profile_list():
     """
@@ -80,12 +125,223 @@ def profile_list():
     return sorted(prof_list)
 
 
+def plugin_dirs():
+    """
+    Directories Volatility loads plugins from, the VolUtility plugins and any added in the volatilityrc
+    :return: list
+    """
+    dirs = [plugin_dir]
+    if os.path.exists(volrc_file):
+        with open(volrc_file) as volrc:
+            for line in volrc:
+                if line.strip().upper().startswith('PLUGINS'):
+                    for path in line.split('=', 1)[1].strip().split(seperator):
+                        if path and path not in dirs:
+                            dirs.append(path)
+    return dirs
+
+
+def plugin_dirs_signature():
+    """
+    Modification times of the plugin directories, changes when plugins are added or removed
+    :return: tuple
+    """
+    signature = []
+    for path in plugin_dirs():
+        for root, subdirs, filenames in os.walk(path):
+            signature.append((root, os.stat(root).st_mtime))
+    return tuple(signature)
+
+
+# Profiles and per profile plugin lists, built on first use and dropped when the plugin directories change
+plugin_catalogue = {'signature': None, 'profiles': None, 'plugins': {}}
+catalogue_lock = threading.Lock()
+
+
+def invalidate_catalogue():
+    """
+    Forget the cached profiles and plugin lists, called when the plugin path changes
+    :return:
+    """
+    with catalogue_lock:
+        plugin_catalogue.update({'signature': None, 'profiles': None, 'plugins': {}})
+
+
+def check_catalogue():
+    """
+    Drop the catalogue if plugins were added or removed since it was built
+    :return:
+    """
+    signature = plugin_dirs_signature()
+    if signature != plugin_catalogue['signature']:
+        invalidate_catalogue()
+        plugin_catalogue['signature'] = signature
+
+
+def cached_profile_list():
+    """
+    profile_list built once per plugin path
+    :return: list
+    """
+    check_catalogue()
+    with catalogue_lock:
+        if plugin_catalogue['profiles'] is None:
+            # RunVol imports the plugin directories, profiles can live there too
+            RunVol('', '')
+            plugin_catalogue['profiles'] = profile_list()
+        return plugin_catalogue['profiles']
+
+
+def cached_plugin_list(profile, mem_path):
+    """
+    list of plugins valid for a profile, built once per plugin path
+    :param profile:
+    :param mem_path:
+    :return: list
+    """
+    check_catalogue()
+    with catalogue_lock:
+        if profile not in plugin_catalogue['plugins']:
+            plugin_catalogue['plugins'][profile] = RunVol(profile, mem_path).list_plugins()
+        return plugin_catalogue['plugins'][profile]
+
+
+# Config keys we can carry over between runs against the same image
+image_conf_keys = ['kdbg', 'dtb', 'kpcr']
+
+
+def parse_kdbgscan(kdbg_text):
+    """
+    Pull the profile suggestion, KDBG and KPCR out of each kdbgscan block
+    :param kdbg_text:
+    :return: list of dicts
+    """
+    blocks = []
+    current = None
+    for line in kdbg_text.split('\n'):
+        if line.startswith('*' * 10):
+            current = {}
+            blocks.append(current)
+            continue
+        if current is None or ':' not in line:
+            continue
+        key, value = line.split(':', 1)
+        key = key.strip()
+        value = value.strip()
+        try:
+            if key.startswith('Profile suggestion'):
+                current['profile'] = value
+            elif key == 'Offset (V)':
+                current['kdbg'] = int(value, 16)
+            elif key == 'KPCR' and 'kpcr' not in current:
+                current['kpcr'] = int(value.split()[0], 16)
+        except ValueError:
+            pass
+    return [block for block in blocks if 'profile' in block]
+
+
+def store_image_conf(mem_path, values):
+    """
+    Build the image_conf session entry.
+    Addresses are stored as hex strings as 64bit kernel addresses overflow a BSON int.
+    :param mem_path:
+    :param values: dict of image_conf_keys
+    :return: dict
+    """
+    stat = os.stat(mem_path)
+    image_conf = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    for key in image_conf_keys:
+        if values.get(key):
+            image_conf[key] = hex(values[key]).rstrip('L')
+    return image_conf
+
+
+def load_image_conf(session):
+    """
+    return the stored kdbg / dtb / kpcr for a session if the image has not changed
+    :param session:
+    :return: dict
+    """
+    image_conf = session.get('image_conf')
+    if not image_conf:
+        return {}
+    try:
+        stat = os.stat(session['session_path'])
+    except OSError:
+        return {}
+    if stat.st_size != image_conf.get('size') or stat.st_mtime != image_conf.get('mtime'):
+        logger.info('Image {0} has changed, ignoring stored KDBG/DTB'.format(session['session_path']))
+        return {}
+    return dict((key, int(image_conf[key], 16)) for key in image_conf_keys if image_conf.get(key))
+
+
+class ScanProgress(object):
+    """
+    Report how far into the image file a plugin has read.
+    Wraps the file address space read for the length of a plugin run, so it only belongs in a worker
+    that runs one plugin at a time.
+    """
+    def __init__(self, emit, mem_path, interval=2.0):
+        """
+        :param emit: called with ('progress', {'scanned': int, 'image_size': int}), None disables tracking
+        :param mem_path:
+        :param interval: minimum seconds between reports
+        :return:
+        """
+        self.emit = emit
+        self.interval = interval
+        self.scanned = 0
+        self.last_report = 0
+        self.original_read = None
+        try:
+            self.image_size = os.path.getsize(mem_path)
+        except OSError:
+            self.image_size = 0
+
+    def update(self, offset):
+        if offset > self.scanned:
+            self.scanned = offset
+        if time.time() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        self.last_report = time.time()
+        self.emit('progress', {'scanned': min(self.scanned, self.image_size) or self.scanned,
+                               'image_size': self.image_size})
+
+    def __enter__(self):
+        if not self.emit:
+            return self
+        self.original_read = vars(standard.FileAddressSpace).get('read')
+        original_read = standard.FileAddressSpace.read
+        tracker = self
+
+        def read(space, addr, length):
+            tracker.update(addr + length)
+            return original_read(space, addr, length)
+
+        standard.FileAddressSpace.read = read
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.emit:
+            return False
+        if self.original_read:
+            standard.FileAddressSpace.read = self.original_read
+        else:
+            del standard.FileAddressSpace.read
+        if exc_type is None:
+            self.report()
+        return False
+
+
 class RunVol:
-    def __init__(self, profile, mem_path):
+    def __init__(self, profile, mem_path, image_conf=None):
         """
         setup base config
         :param profile:
         :param mem_path:
+        :param image_conf: known kdbg, dtb and kpcr values for the image
         :return:
         """
         debug.setup()
@@ -94,6 +350,8 @@ class RunVol:
         self.osprofile = profile
         self.config = None
         self.addr_space = None
+        # Values Volatility had to scan for, reused on every later run
+        self.warm_conf = dict(image_conf or {})
         self.init_config()
 
     def init_config(self):
@@ -130,12 +388,34 @@ class RunVol:
         if self.osprofile:
             base_conf["profile"] = self.osprofile
 
+        base_conf.update(self.warm_conf)
+
         for key, value in base_conf.items():
             self.config.update(key, value)
 
         self.plugins = registry.get_plugin_classes(commands.Command, lower=True)
         return self.config
 
+    def warm_up(self):
+        """
+        Load the address space once and keep the DTB and KDBG it found.
+        Later plugin runs against the image get the same address space from load_as.
+        :return: dict
+        """
+        self.addr_space = original_load_as(self.config)
+        if getattr(self.addr_space, 'dtb', None):
+            self.warm_conf['dtb'] = self.addr_space.dtb
+
+        if self.addr_space.profile.metadata.get('os') == 'windows':
+            import volatility.win32.tasks as tasks
+            kdbg = tasks.get_kdbg(self.addr_space)
+            if kdbg:
+                self.warm_conf['kdbg'] = kdbg.obj_offset
+
+        self.init_config()
+        warm_spaces[(self.config.LOCATION, self.config.PROFILE)] = self.addr_space
+        return self.warm_conf
+
     def profile_list(self):
         """
         return a list of profiles
@@ -228,36 +508,158 @@ class RunVol:
         return results
 
 
-    def run_plugin(self, plugin_name, use_gi, gi_path, pid=None, dump_dir=None, plugin_options=None, hive_offset=None,  output_style="json"):
+    def set_plugin_options(self, plugin_name, pid=None, dump_dir=None, plugin_options=None, hive_offset=None):
         """
-        run a plugin and set config options
+        Reset the config and apply the options for a plugin run
         :param plugin_name:
         :param pid:
         :param dump_dir:
         :param plugin_options:
         :param hive_offset:
-        :param output_style:
-        :return: json
+        :return: plugin class or None
         """
-
         # Re Init the config to prevent conflict
         self.init_config()
         # Get Valid commands
         cmds = registry.get_plugin_classes(commands.Command, lower=True)
 
-        if plugin_name in cmds.keys():
-            command = cmds[plugin_name]
-            # Set Config options
-            self.config.REGEX = None
-            self.config.PID = pid
-            self.config.DUMP_DIR = dump_dir
-            self.config.HIVE_OFFSET = hive_offset
-            self.config.hive_offset = hive_offset
-            if plugin_options:
-                for option, value in plugin_options.iteritems():
-                    logger.debug('Setting Config {0} to {1}'.format(option, value))
-                    self.config.update(option, value)
+        if plugin_name not in cmds.keys():
+            return None
+
+        # Set Config options
+        self.config.REGEX = None
+        self.config.PID = pid
+        self.config.DUMP_DIR = dump_dir
+        self.config.HIVE_OFFSET = hive_offset
+        self.config.hive_offset = hive_offset
+        if plugin_options:
+            for option, value in plugin_options.iteritems():
+                logger.debug('Setting Config {0} to {1}'.format(option, value))
+                self.config.update(option, value)
+
+        return cmds[plugin_name]
+
+    def plugin_capabilities(self, plugin_name):
+        """
+        Inspect a plugin class for the renderers it implements
+        :param plugin_name:
+        :return: dict of json, text and dot support or None
+        """
+        cmds = registry.get_plugin_classes(commands.Command, lower=True)
+        if plugin_name not in cmds.keys():
+            return None
+        plugin_class = cmds[plugin_name]
+        # The base Command has every render_* and unified_output, only count what the plugin adds
+        unified_output = self.plugin_defines(plugin_class, 'unified_output')
+        # The base render_text draws the unified output as a table
+        return {'json': unified_output,
+                'text': unified_output or self.plugin_defines(plugin_class, 'render_text'),
+                'dot': self.plugin_defines(plugin_class, 'render_dot')}
+
+    def plugin_defines(self, plugin_class, method_name):
+        """
+        Check if a plugin class or one of its parents below Command defines a method
+        :param plugin_class:
+        :param method_name:
+        :return: bool
+        """
+        for parent in plugin_class.__mro__:
+            if parent is commands.Command:
+                break
+            if method_name in parent.__dict__:
+                return True
+        return False
+
+    def stream_json(self, plugin_class, emit, batch_size=5000):
+        """
+        Render unified output in batches of rows instead of one json document
+        :param plugin_class:
+        :param emit: called with ('columns', list) once then ('rows', list) per batch
+        :param batch_size:
+        :return: int row count
+        """
+        plugin = plugin_class(copy.deepcopy(self.config))
+        grid = plugin.unified_output(plugin.calculate())
+        emit('columns', [column.name for column in grid.columns])
+
+        row_count = 0
+        batch = []
+        # Walk the generator ourselves, populating the TreeGrid would hold every row
+        for level, item in grid._generator:
+            if level > 0:
+                raise NotImplementedError('JSON output for trees has not yet been implemented')
+            batch.append([json_value(value) for value in item])
+            row_count += 1
+            if len(batch) >= batch_size:
+                emit('rows', batch)
+                batch = []
+
+        if batch:
+            emit('rows', batch)
+        return row_count
+
+    def stream_plugin(self, plugin_name, emit=None, batch_size=5000, pid=None, dump_dir=None, plugin_options=None,
+                      hive_offset=None):
+        """
+        run a plugin and pass its json rows to emit as they are produced
+        :param plugin_name:
+        :param emit: called with ('columns', list) once, ('rows', list) per batch and ('progress', dict)
+        :param batch_size:
+        :param pid:
+        :param dump_dir:
+        :param plugin_options:
+        :param hive_offset:
+        :return: int row count
+        """
+        command = self.set_plugin_options(plugin_name, pid=pid, dump_dir=dump_dir, plugin_options=plugin_options,
+                                          hive_offset=hive_offset)
+        if not command:
+            raise Exception('Error: Not a valid plugin')
+
+        columns = []
+
+        def modified_emit(event, data):
+            if event == 'columns':
+                columns.extend(data)
+            elif event == 'rows' and plugin_name not in ['mftparser']:
+                data = self.result_modifier({'columns': columns, 'rows': data})['rows']
+            emit(event, data)
+
+        with ScanProgress(modified_emit, self.memdump):
+            return self.stream_json(command, modified_emit, batch_size=batch_size)
+
+    def run_plugin(self, plugin_name, use_gi, gi_path, pid=None, dump_dir=None, plugin_options=None, hive_offset=None,  output_style="json", emit=None):
+        """
+        run a plugin and set config options
+        :param plugin_name:
+        :param pid:
+        :param dump_dir:
+        :param plugin_options:
+        :param hive_offset:
+        :param output_style:
+        :param emit: called with ('progress', dict) while the plugin reads the image
+        :return: json
+        """
+        with ScanProgress(emit, self.memdump):
+            return self.render_plugin(plugin_name, pid=pid, dump_dir=dump_dir, plugin_options=plugin_options,
+                                      hive_offset=hive_offset, output_style=output_style)
+
+    def render_plugin(self, plugin_name, pid=None, dump_dir=None, plugin_options=None, hive_offset=None,
+                      output_style="json"):
+        """
+        run a plugin with the renderer for its output style
+        :param plugin_name:
+        :param pid:
+        :param dump_dir:
+        :param plugin_options:
+        :param hive_offset:
+        :param output_style:
+        :return: json
+        """
+        command = self.set_plugin_options(plugin_name, pid=pid, dump_dir=dump_dir, plugin_options=plugin_options,
+                                          hive_offset=hive_offset)
 
+        if command:
             # Plugins with specific output types
             if plugin_name == 'pstree':
                 output_data = self.get_dot(command)
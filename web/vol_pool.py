@@ -0,0 +1,358 @@
+import os
+import time
+import errno
+import logging
+import hashlib
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing.connection import Listener, Client
+
+from django.conf import settings
+
+from web.common import parse_config
+
+logger = logging.getLogger(__name__)
+config = parse_config()
+
+if 'workers' in config:
+    worker_config = config['workers']
+else:
+    worker_config = {}
+
+
+def serving_path(address):
+    """
+    File a worker keeps the id of the job it is serving in
+    :param address:
+    :return: str
+    """
+    return address + '.job'
+
+
+def set_serving(address, job_id):
+    """
+    Record the job a worker is serving, None when it is idle
+    :param address:
+    :param job_id:
+    :return:
+    """
+    try:
+        with open(serving_path(address), 'w') as serving:
+            serving.write(job_id or '')
+    except IOError as error:
+        logger.warning('Unable to record the job for worker {0}: {1}'.format(address, error))
+
+
+def worker_main(address, authkey, max_images):
+    """
+    Entry point for a long lived volatility worker.
+    Keeps a warm RunVol for the most recently used images and serves one request at a time.
+    :param address:
+    :param authkey:
+    :param max_images:
+    :return:
+    """
+    from web.vol_interface import RunVol
+
+    warm_images = OrderedDict()
+
+    # A dead worker can leave its socket behind
+    if os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address, family='AF_UNIX', backlog=16, authkey=authkey)
+    # A killed worker leaves the job it was serving behind
+    set_serving(address, None)
+    logger.info('Volatility worker listening on {0}'.format(address))
+
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as error:
+            logger.error('Worker failed to accept connection: {0}'.format(error))
+            continue
+
+        try:
+            request = conn.recv()
+            image_key = (request['profile'], request['mem_path'])
+
+            # Move the image to the front of the LRU or load it
+            vol_int, image_stat = warm_images.pop(image_key, (None, None))
+            current_stat = os.stat(request['mem_path'])
+            current_stat = (current_stat.st_size, current_stat.st_mtime)
+            if vol_int is None or image_stat != current_stat:
+                logger.debug('Loading {0} into worker {1}'.format(image_key, address))
+                vol_int = RunVol(request['profile'], request['mem_path'], image_conf=request['image_conf'])
+                try:
+                    vol_int.warm_up()
+                except Exception as error:
+                    logger.warning('Unable to warm address space for {0}: {1}'.format(request['mem_path'], error))
+            warm_images[image_key] = (vol_int, current_stat)
+
+            while len(warm_images) > max_images:
+                old_key, old_image = warm_images.popitem(last=False)
+                logger.debug('Evicting {0} from worker {1}'.format(old_key, address))
+
+            set_serving(address, request.get('job'))
+            method = getattr(vol_int, request['method'])
+            if request.get('stream'):
+                # Hand batches back to the caller as the method produces them
+                request['kwargs']['emit'] = lambda event, data: conn.send({'stream': (event, data)})
+            result = method(*request['args'], **request['kwargs'])
+            conn.send({'result': result})
+
+        except Exception as error:
+            try:
+                conn.send({'error': str(error)})
+            except Exception:
+                pass
+        finally:
+            set_serving(address, None)
+            conn.close()
+
+
+class PooledRunVol(object):
+    """
+    Stand in for RunVol that sends every call to the pool worker holding the image.
+    """
+    def __init__(self, pool, profile, mem_path, image_conf=None):
+        self.pool = pool
+        self.osprofile = profile
+        self.memdump = mem_path
+        self.image_conf = image_conf
+
+    def call(self, method, *args, **kwargs):
+        return self.pool.call(self.osprofile, self.memdump, self.image_conf, method, *args, **kwargs)
+
+    def run_plugin(self, *args, **kwargs):
+        return self.call('run_plugin', *args, **kwargs)
+
+    def list_plugins(self):
+        return self.call('list_plugins')
+
+    def warm_up(self):
+        return self.call('warm_up')
+
+    def stream_plugin(self, *args, **kwargs):
+        return self.call('stream_plugin', *args, **kwargs)
+
+    def plugin_capabilities(self, plugin_name):
+        return self.call('plugin_capabilities', plugin_name)
+
+
+class VolPool(object):
+    def __init__(self, pool_size=4, max_images=2, socket_dir=None):
+        """
+        Pool of worker processes that keep images loaded between plugin runs
+        :param pool_size: number of worker processes
+        :param max_images: images each worker keeps warm
+        :param socket_dir: where the worker sockets live
+        :return:
+        """
+        self.pool_size = pool_size
+        self.max_images = max_images
+        self.socket_dir = socket_dir or tempfile.gettempdir()
+        self.authkey = hashlib.sha256(settings.SECRET_KEY).digest()
+        # Only the process that built the pool is allowed to start workers
+        self.owner_pid = os.getpid()
+        self.workers = {}
+        # Set in a job child so workers know which job a request belongs to
+        self.job_id = None
+
+    def _address(self, index):
+        # Every web process owns its own workers, processes forked from it inherit owner_pid and find them
+        return os.path.join(self.socket_dir, 'volutility-{0}-worker-{1}.sock'.format(self.owner_pid, index))
+
+    def remove_stale(self):
+        """
+        Remove sockets and job files left by workers of web processes that have exited
+        :return:
+        """
+        for filename in os.listdir(self.socket_dir):
+            parts = filename.split('-')
+            if len(parts) < 3 or parts[0] != 'volutility' or parts[2] != 'worker' or not parts[1].isdigit():
+                continue
+            try:
+                os.kill(int(parts[1]), 0)
+                continue
+            except OSError as error:
+                # Still running under another user
+                if error.errno == errno.EPERM:
+                    continue
+            try:
+                os.remove(os.path.join(self.socket_dir, filename))
+            except OSError:
+                pass
+
+    def _worker_index(self, profile, mem_path):
+        """
+        The same image always maps to the same worker so it stays warm
+        :param profile:
+        :param mem_path:
+        :return: int
+        """
+        image_key = '{0}|{1}'.format(profile, mem_path)
+        return int(hashlib.md5(image_key).hexdigest(), 16) % self.pool_size
+
+    def start_worker(self, index):
+        """
+        start a worker if it is not already running
+        :param index:
+        :return: bool
+        """
+        if os.getpid() != self.owner_pid:
+            return False
+
+        worker = self.workers.get(index)
+        if worker and worker.is_alive():
+            return True
+
+        address = self._address(index)
+        worker = multiprocessing.Process(target=worker_main, args=(address, self.authkey, self.max_images))
+        worker.daemon = True
+        worker.start()
+        self.workers[index] = worker
+        logger.info('Started Volatility worker {0} (pid {1})'.format(index, worker.pid))
+        return True
+
+    def start_workers(self):
+        """
+        Start any worker that is not running so processes forked from the owner can reach them
+        :return: bool
+        """
+        if worker_config.get('enable', 'True') != 'True':
+            return False
+        if not self.workers and os.getpid() == self.owner_pid:
+            self.remove_stale()
+        started = True
+        for index in range(self.pool_size):
+            started = self.start_worker(index) and started
+        return started
+
+    def get_worker(self, profile, mem_path):
+        """
+        The worker process for an image if this process started it
+        :param profile:
+        :param mem_path:
+        :return: multiprocessing.Process or None
+        """
+        worker = self.workers.get(self._worker_index(profile, mem_path))
+        if worker and worker.is_alive():
+            return worker
+        return None
+
+    def serving(self, profile, mem_path):
+        """
+        The job the worker for an image is running a request for
+        :param profile:
+        :param mem_path:
+        :return: job id str or None when idle
+        """
+        try:
+            with open(serving_path(self._address(self._worker_index(profile, mem_path)))) as serving:
+                return serving.read() or None
+        except IOError:
+            return None
+
+    def stop_worker(self, profile, mem_path, job_id=None):
+        """
+        Kill the worker for an image, dropping any run in progress, and start a fresh one
+        :param profile:
+        :param mem_path:
+        :param job_id: only kill the worker while it is serving this job, other images and jobs share workers
+        :return: bool
+        """
+        worker = self.get_worker(profile, mem_path)
+        if not worker:
+            return False
+        if job_id and self.serving(profile, mem_path) != str(job_id):
+            return False
+        index = self._worker_index(profile, mem_path)
+        logger.info('Stopping Volatility worker {0} (pid {1})'.format(index, worker.pid))
+        worker.terminate()
+        worker.join(5)
+        return self.start_worker(index)
+
+    def connect(self, profile, mem_path):
+        """
+        Get a connection to the worker for this image, starting it if needed
+        :param profile:
+        :param mem_path:
+        :return: Connection or None
+        """
+        index = self._worker_index(profile, mem_path)
+        address = self._address(index)
+        try:
+            return Client(address, family='AF_UNIX', authkey=self.authkey)
+        except Exception:
+            if not self.start_worker(index):
+                return None
+
+        # Give a new worker a moment to bind its socket
+        for attempt in range(50):
+            try:
+                return Client(address, family='AF_UNIX', authkey=self.authkey)
+            except Exception:
+                time.sleep(0.1)
+        return None
+
+    def call(self, profile, mem_path, image_conf, method, *args, **kwargs):
+        """
+        Run a RunVol method on the worker that holds the image
+        :param profile:
+        :param mem_path:
+        :param image_conf: known kdbg, dtb and kpcr used if the worker has to load the image
+        :param method:
+        :return: the method result
+        """
+        # emit callbacks stay in this process, the worker streams to them
+        emit = kwargs.pop('emit', None)
+
+        conn = self.connect(profile, mem_path)
+        if not conn:
+            raise Exception('Unable to reach a Volatility worker for {0}'.format(mem_path))
+        try:
+            conn.send({'profile': profile,
+                       'mem_path': mem_path,
+                       'image_conf': image_conf,
+                       'method': method,
+                       'stream': emit is not None,
+                       'job': self.job_id,
+                       'args': args,
+                       'kwargs': kwargs})
+            response = conn.recv()
+            while 'stream' in response:
+                emit(*response['stream'])
+                response = conn.recv()
+        except EOFError:
+            raise Exception('Volatility worker exited while running {0}'.format(method))
+        finally:
+            conn.close()
+
+        if 'error' in response:
+            raise Exception(response['error'])
+        return response['result']
+
+    def get_interface(self, profile, mem_path, image_conf=None):
+        """
+        return a RunVol like object for the image.
+        Falls back to a local RunVol when the pool is disabled or unreachable.
+        :param profile:
+        :param mem_path:
+        :param image_conf: known kdbg, dtb and kpcr for the image
+        :return: PooledRunVol or RunVol
+        """
+        if worker_config.get('enable', 'True') == 'True':
+            conn = self.connect(profile, mem_path)
+            if conn:
+                conn.close()
+                return PooledRunVol(self, profile, mem_path, image_conf=image_conf)
+            logger.warning('No Volatility worker available, running in process')
+
+        from web.vol_interface import RunVol
+        return RunVol(profile, mem_path, image_conf=image_conf)
+
+
+vol_pool = VolPool(pool_size=int(worker_config.get('pool_size', 4)),
+                   max_images=int(worker_config.get('max_images', 2)),
+                   socket_dir=worker_config.get('socket_dir') or None)